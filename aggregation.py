@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Statistics of test results computed in one pass over a report:
+
+    stats = aggregation.Stats(claims.Report())
+    print(stats.failed, stats.per_class['tests.foreman.api.test_x.XTestCase'])
+"""
+
+import collections
+import claims
+
+
+def method(class_name):
+    """
+    Returns way the test exercises the product (api, cli, ui, ...) from
+    its class name, e.g. tests.foreman.cli.test_syncplan.SyncPlanTestCase
+    """
+    parts = class_name.split('.')
+    return parts[2] if len(parts) > 2 else class_name
+
+
+class Counts(object):
+    """
+    Number of all, failed and claimed results in some group
+    """
+
+    __slots__ = ('all', 'failed', 'claimed')
+
+    def __init__(self):
+        self.all = 0
+        self.failed = 0
+        self.claimed = 0
+
+    @property
+    def ratio(self):
+        """
+        Failures ratio
+        """
+        return float(self.failed) / self.all if self.all else 0.0
+
+    def __repr__(self):
+        return 'Counts(all=%s, failed=%s, claimed=%s)' \
+            % (self.all, self.failed, self.claimed)
+
+
+class Stats(Counts):
+    """
+    Overall counts together with counts per claim reason, per test class,
+    per method, per tier and per distro
+    """
+
+    __slots__ = ('per_reason', 'per_class', 'per_method', 'per_tier', 'per_distro')
+
+    def __init__(self, report=()):
+        super(Stats, self).__init__()
+        self.per_reason = collections.Counter()
+        self.per_class = collections.defaultdict(Counts)
+        self.per_method = collections.defaultdict(Counts)
+        self.per_tier = collections.defaultdict(Counts)
+        self.per_distro = collections.defaultdict(Counts)
+        for case in report:
+            self.add(case)
+
+    @property
+    def unclaimed(self):
+        return self.failed - self.claimed
+
+    def add(self, case):
+        failed = case['status'] in claims.Case.FAIL_STATUSES
+        reason = case['testActions'][0].get('reason') if failed else None
+        groups = [self, self.per_class[case['className']],
+            self.per_method[method(case['className'])]]
+        if 'tier' in case:
+            groups.append(self.per_tier[case['tier']])
+        if 'distro' in case:
+            groups.append(self.per_distro[case['distro']])
+        for counts in groups:
+            counts.all += 1
+            if failed:
+                counts.failed += 1
+                if reason:
+                    counts.claimed += 1
+        if reason:
+            self.per_reason[reason] += 1
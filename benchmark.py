@@ -0,0 +1,1023 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Benchmarks of the claims machinery against local fake Jenkins. Run it
+from directory with config.yaml (Jenkins url and credentials from there
+are replaced by the fake server):
+
+    ./benchmark.py [benchmark ...] [param=value ...] [--repeat N] [--save FILE] [--compare FILE]
+
+Params (e.g. size=3000000000 for production_log) are passed to the
+selected benchmarks which take them. Results printed by the benchmarks
+can be saved as a baseline and later runs compared with it, timings
+slower than the baseline by more than --tolerance are reported as
+regressions (and the exit status is 1).
+"""
+
+import os
+import sys
+import re
+import io
+import inspect
+import argparse
+import contextlib
+import subprocess
+import time
+import logging
+import tempfile
+import threading
+import random
+import datetime
+import resource
+import json
+import collections
+import tracemalloc
+import requests
+import claims
+import aggregation
+import stability
+import history
+import cluster
+import claimstats
+import rungraph
+import statistics
+import numpy
+import tabulate
+import fake_jenkins
+import watch
+import pipeline
+import metrics
+
+
+def rss():
+    """
+    Current resident set size of this process in bytes
+    """
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return time.perf_counter() - start, out
+
+
+def fake_builds(jenkins, cases, build=1, **kwargs):
+    """
+    Populates fake Jenkins with one build of every tier x RHEL job
+    (kwargs are passed to generate_report)
+    """
+    for tier in claims.config['tiers']:
+        for rhel in claims.config['rhels']:
+            jenkins.add_build(claims.config['job'].format(tier, rhel), build,
+                fake_jenkins.generate_report(cases, seed=tier*10+rhel, **kwargs))
+    claims.config['url'] = jenkins.url
+    claims.config['bld'] = 'lastCompletedBuild'
+    claims.config['cache'] = None
+    claims.config._session = None
+
+
+def bench_report_fetch(cases=2000, latency=0.2):
+    """
+    Fetch all tiers x RHELs sequentially and with a pool of workers
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins:
+        fake_builds(jenkins, cases)
+
+        results = {}
+        for workers in (1, len(claims.config['tiers']) * len(claims.config['rhels'])):
+            claims.config['fetch_workers'] = workers
+            claims.config._session = None
+            duration, report = timed(lambda: claims.Report().load())
+            results[workers] = [(i['tier'], i['distro'], i['className'], i['name']) for i in report]
+            print("report_fetch: %s cases with %s workers in %.3f s" \
+                % (len(report), workers, duration))
+        orders = list(results.values())
+        assert all(i == orders[0] for i in orders), \
+            "All the fetch modes have to return same ordered list of cases"
+
+
+def bench_report_cache(cases=2000, latency=0.2):
+    """
+    Load report with empty and with populated per-build cache
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins, \
+            tempfile.TemporaryDirectory() as cache:
+        fake_builds(jenkins, cases)
+        claims.config['cache'] = cache
+        for state in ('cold', 'warm'):
+            duration, report = timed(lambda: claims.Report().load())
+            print("report_cache: %s cases from %s cache in %.3f s" \
+                % (len(report), state, duration))
+
+
+def bench_report_lazy(cases=2000, latency=0.2):
+    """
+    Time to the first case when iterating lazy report compared with
+    loading all of it, and requests needed for one tier only
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins:
+        fake_builds(jenkins, cases)
+        claims.config['fetch_workers'] = 1
+        start = time.perf_counter()
+        for case in claims.Report():
+            break
+        print("report_lazy: first case iterated in %.3f s" % (time.perf_counter() - start))
+        duration, report = timed(lambda: claims.Report().load())
+        print("report_lazy: all %s cases loaded in %.3f s" % (len(report), duration))
+        jenkins.requests = 0
+        duration, report = timed(lambda: list(claims.Report(tiers=[4])))
+        print("report_lazy: %s cases of tier 4 in %.3f s by %s requests" \
+            % (len(report), duration, jenkins.requests))
+
+
+def bench_unchanged(cases=2000, latency=0.2):
+    """
+    Repeated runs of claiming (as from cron) with state of processed
+    builds: first run, run without new builds, run after one new build.
+    Then production.log of lastCompletedBuild downloaded and revalidated.
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins, \
+            tempfile.TemporaryDirectory() as tmp:
+        fake_builds(jenkins, cases)
+        claims.config['cache'] = tmp
+        kb = fake_jenkins.generate_kb(100)
+
+        def run():
+            rules = claims.Ruleset(kb)
+            state = claims.BuildState(os.path.join(tmp, 'state.json'), rules.version)
+            report = claims.Report(fields=claims.Report.fields_for(rules), state=state)
+            state.update(report.builds, claims.claim_by_rules(report, rules))
+            state.save()
+            return len(report)
+
+        job = claims.config['job'].format(claims.config['tiers'][0], claims.config['rhels'][0])
+        for name in ('first run', 'unchanged', 'one new build'):
+            if name == 'one new build':
+                jenkins.add_build(job, 2, fake_jenkins.generate_report(cases, seed=1))
+            jenkins.requests = jenkins.bytes_sent = 0
+            duration, count = timed(run)
+            print("unchanged: %s, %s cases in %.3f s by %s requests (%.1f MB)" \
+                % (name, count, duration, jenkins.requests, jenkins.bytes_sent / 1024 / 1024))
+
+        with tempfile.NamedTemporaryFile(suffix='-production.log') as fp:
+            fake_jenkins.generate_production_log(fp.name, 10*1024*1024)
+            jenkins.builds[(job, 2)]['artifacts']['foreman-debug.tar.xz'] = \
+                fake_jenkins.generate_foreman_debug(fp.name, other=10*1024*1024)
+        for name in ('downloaded', 'revalidated'):
+            jenkins.requests = jenkins.bytes_sent = 0
+            log = claims.ProductionLog(job, 'lastCompletedBuild')
+            duration, times = timed(lambda: log.times)
+            print("unchanged: production.log of lastCompletedBuild %s in %.3f s by %s requests (%.1f MB)" \
+                % (name, duration, jenkins.requests, jenkins.bytes_sent / 1024 / 1024))
+
+
+def bench_watch(cases=2000, latency=0.05, grow=100):
+    """
+    Cycles of watch.py: first one, idle one with running builds, one
+    after 'grow' results were added to the report of every running build
+    (half of them to its last suite, half as a new suite) and idle one
+    after the builds finished
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins, \
+            tempfile.TemporaryDirectory() as tmp:
+        fake_builds(jenkins, 0)
+        claims.config['fetch_workers'] = len(claims.config['tiers']) * len(claims.config['rhels'])
+        kb = os.path.join(tmp, 'kb.json')
+        with open(kb, 'w') as fp:
+            json.dump(fake_jenkins.generate_kb(100), fp)
+        grown = {}
+        for tier in claims.config['tiers']:
+            for rhel in claims.config['rhels']:
+                job = claims.config['job'].format(tier, rhel)
+                report = fake_jenkins.generate_report(cases + grow, seed=tier*10+rhel)
+                grown[job] = report['suites'][0]['cases'][cases:]
+                del report['suites'][0]['cases'][cases:]
+                jenkins.add_build(job, 2, report, building=True)
+
+        watcher = watch.Watcher(os.path.join(tmp, 'state.json'), kb)
+        for name in ('first', 'idle running', 'grown', 'finished', 'idle'):
+            if name == 'grown':
+                for job, new in grown.items():
+                    suites = jenkins.builds[(job, 2)]['report']['suites']
+                    suites[-1]['cases'] += new[:grow // 2]
+                    suites.append({'cases': new[grow // 2:]})
+            if name == 'finished':
+                for job in grown:
+                    jenkins.builds[(job, 2)]['building'] = False
+            jenkins.requests = jenkins.bytes_sent = 0
+            duration, results = timed(watcher.cycle)
+            print("watch: %s cycle in %.3f s by %s requests (%.1f kB), %s claims" \
+                % (name, duration, jenkins.requests, jenkins.bytes_sent / 1024, len(results)))
+
+
+def bench_field_projection(cases=2000, latency=0.2, stdout_lines=200):
+    """
+    Load report with all the fields and with fields needed by claiming
+    rules only and match the rules, compare bytes transferred and time.
+    Second ruleset reads stdout, which is then fetched lazily for every
+    failure.
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins:
+        fake_builds(jenkins, cases, stdout_lines=stdout_lines)
+        claims.config['fetch_workers'] = len(claims.config['tiers']) * len(claims.config['rhels'])
+        kb = fake_jenkins.generate_kb(100)
+        for kind, rules in (('kb', claims.Ruleset(kb)),
+                ('kb+stdout', claims.Ruleset(kb + [{'field': 'stdout',
+                    'pattern': 'step 1000 of', 'reason': 'never'}]))):
+            results = {}
+            for name, fields in (('all fields', None),
+                    ('projected', claims.Report.fields_for(rules))):
+                jenkins.bytes_sent = jenkins.requests = 0
+                claims.config._session = None
+                start = time.perf_counter()
+                report = claims.Report(fields=fields).load()
+                loaded = time.perf_counter() - start
+                claims.claim_by_rules(report, rules, dryrun=True, cache=claims.MatchCache())
+                print("field_projection: %s cases, %s rules, %s: %.1f MB in %s requests, loaded in %.3f s, matched in %.3f s" \
+                    % (len(report), kind, name, jenkins.bytes_sent / 1024 / 1024,
+                        jenkins.requests, loaded, time.perf_counter() - start - loaded))
+                results[name] = [rules.position(i) for i in report
+                    if i['status'] in claims.Case.FAIL_STATUSES]
+            orders = list(results.values())
+            assert all(i == orders[0] for i in orders), \
+                "Projection must not change results of matching"
+
+
+def bench_report_stream(cases=20000, stdout_lines=200):
+    """
+    Peak memory of parsing one big test report at once (as pull_reports
+    used to) and of streaming its cases one by one
+    """
+    with fake_jenkins.FakeJenkins() as jenkins:
+        job = claims.config['job'].format(4, 7)
+        jenkins.add_build(job, 1, fake_jenkins.generate_report(
+            cases, stdout_lines=stdout_lines))
+        fake_builds(jenkins, 0, build=2)
+        url = '{0}/job/{1}/1/testReport/api/json'.format(jenkins.url, job)
+
+        def at_once():
+            req = claims.config.session.get(url, params=claims.config['pull_params'])
+            return len(json.loads(req.text)['suites'][0]['cases'])
+
+        def streamed():
+            return sum(1 for _ in claims.Report.pull_reports(job, 1))
+
+        for name, func in (('at once', at_once), ('streamed', streamed)):
+            tracemalloc.start()
+            duration, count = timed(func)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("report_stream: %s cases (%.1f MB) parsed %s in %.3f s, peak %.1f MB" \
+                % (count, jenkins.bytes_sent / 1024 / 1024, name, duration,
+                    peak / 1024 / 1024))
+            jenkins.bytes_sent = 0
+
+
+def bench_production_log(size=100*1024*1024, windows=500, verify=1):
+    """
+    Get records for many time windows from synthetic production.log by
+    from_to and compare it with linear scan over fully decoded log
+    (skip that with verify=0 for logs which do not fit into memory)
+    """
+    with tempfile.NamedTemporaryFile(suffix='-production.log') as fp:
+        first, last = fake_jenkins.generate_production_log(fp.name, size)
+        log = claims.ProductionLog(None, None, logfile=fp.name)
+        rss_before = rss()
+        duration, (times, _) = timed(lambda: log.index)
+        print("production_log: indexed %s MB into %s records in %.3f s using %s MB" \
+            % (size // 1024 // 1024, len(times), duration,
+                (rss() - rss_before) // 1024 // 1024))
+
+        rnd = random.Random(0)
+        span = int((last - first).total_seconds())
+        intervals = []
+        for _ in range(windows):
+            from_time = first + datetime.timedelta(seconds=rnd.randint(0, span))
+            intervals.append((from_time, from_time + datetime.timedelta(seconds=rnd.randint(1, 600))))
+
+        duration, out_indexed = timed(lambda: [log.from_to(f, t) for f, t in intervals])
+        print("production_log: %s windows by index in %.3f s" % (windows, duration))
+
+        if verify:
+            records = log.log
+            duration, out_linear = timed(lambda: [
+                [i for i in records if f <= i['time'] <= t] for f, t in intervals])
+            print("production_log: %s windows by linear scan in %.3f s" % (windows, duration))
+            assert out_linear == out_indexed, "from_to have to return same records as linear scan"
+
+
+def bench_production_log_parse(size=32*1024*1024, logs=8, workers=4):
+    """
+    Index production.log of all tier x RHEL jobs in this process and by
+    pool of worker processes (each log split into chunks)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(logs):
+            files.append(os.path.join(tmp, '%s-production.log' % i))
+            fake_jenkins.generate_production_log(files[-1], size)
+        out = {}
+        chunk_size = claims.ProductionLog.CHUNK_SIZE
+        claims.ProductionLog.CHUNK_SIZE = min(chunk_size, size // workers + 1)
+        try:
+            for count in (1, workers):
+                parsed = [claims.ProductionLog(None, None, logfile=i) for i in files]
+                duration, _ = timed(claims.ProductionLog.load_all, parsed, count)
+                out[count] = [(list(i._times), list(i._offsets)) for i in parsed]
+                print("production_log_parse: %s logs of %s MB indexed by %s process(es) in %.3f s" \
+                    " (%s records, %s MB of results, %s CPUs)" % (logs, size // 1024 // 1024, count,
+                        duration, sum(len(i.times) for i in parsed),
+                        sum(len(i._times) * 16 for i in parsed) // 1024 // 1024, os.cpu_count()))
+        finally:
+            claims.ProductionLog.CHUNK_SIZE = chunk_size
+        assert out[1] == out[workers], "Workers have to index same records"
+
+
+def bench_foreman_debug(size=50*1024*1024, other=50*1024*1024):
+    """
+    Get production.log out of foreman-debug.tar.xz by downloading it and
+    extracting whole archive with tar and by streaming extraction
+    """
+    job = claims.config['job'].format(1, 7)
+    with fake_jenkins.FakeJenkins() as jenkins, \
+            tempfile.NamedTemporaryFile(suffix='-production.log') as log:
+        fake_jenkins.generate_production_log(log.name, size)
+        jenkins.add_build(job, 1, fake_jenkins.generate_report(0), artifacts={
+            'foreman-debug.tar.xz': fake_jenkins.generate_foreman_debug(log.name, other)})
+        claims.config['url'] = jenkins.url
+        claims.config['cache'] = None
+        url = '%s/job/%s/1/artifact/foreman-debug.tar.xz' % (jenkins.url, job)
+
+        def untar():
+            with tempfile.NamedTemporaryFile() as archive, \
+                    tempfile.TemporaryDirectory() as tmpdir:
+                for chunk in claims.config.session.get(url, stream=True).iter_content(1024):
+                    archive.write(chunk)
+                archive.flush()
+                subprocess.check_call(['tar', '-xf', archive.name, '--directory', tmpdir])
+                return os.path.getsize(os.path.join(
+                    tmpdir, 'foreman-debug', 'var', 'log', 'foreman', 'production.log'))
+
+        def stream():
+            with tempfile.NamedTemporaryFile() as fp:
+                claims.ForemanDebug(job, 1).extract('var/log/foreman/production.log', fp)
+                return fp.tell()
+
+        duration, extracted = timed(untar)
+        print("foreman_debug: download and tar -xf in %.3f s" % duration)
+        duration, streamed = timed(stream)
+        print("foreman_debug: streaming extraction in %.3f s" % duration)
+        assert extracted == streamed == os.path.getsize(log.name), \
+            "Whole production.log have to be extracted"
+
+
+def bench_claim_by_rules(rules=1000, cases=2000):
+    """
+    Find matching rule for every failure by evaluating rule dicts rule
+    by rule (as claim_by_rules used to) and by compiled Ruleset
+    """
+    report = [claims.Case(i) for i in
+        fake_jenkins.generate_report(cases, fail_ratio=1.0)['suites'][0]['cases']]
+    kb = fake_jenkins.generate_kb(rules)
+
+    def uncompiled():
+        out = {}
+        for rule in kb:
+            for case in report:
+                if id(case) not in out and case.matches_to_rule(rule):
+                    out[id(case)] = rule['reason']
+        return out
+
+    def compiled():
+        ruleset = claims.Ruleset(kb)
+        out = {}
+        for case in report:
+            rule = ruleset.match(case)
+            if rule is not None:
+                out[id(case)] = rule['reason']
+        return out
+
+    duration, out_uncompiled = timed(uncompiled)
+    print("claim_by_rules: %s rules x %s failures by rule dicts in %.3f s" \
+        % (len(kb), cases, duration))
+    duration, out_compiled = timed(compiled)
+    print("claim_by_rules: %s rules x %s failures by compiled Ruleset in %.3f s" \
+        % (len(kb), cases, duration))
+    assert out_uncompiled == out_compiled, "Both ways have to find same rules"
+
+
+def bench_cluster(rules=1000, cases=20000, similarity=0.8):
+    """
+    Match rules against every failure and once per cluster of failures
+    with the same normalized error, then merge similar clusters
+    """
+    report = []
+    for job in range(len(claims.config['tiers']) * len(claims.config['rhels'])):
+        report += [claims.Case(i, build_url='http://jenkins/job/%s/1' % job)
+            for i in fake_jenkins.generate_report(cases // 8, fail_ratio=1.0,
+                stdout_lines=0, seed=job)['suites'][0]['cases']]
+    ruleset = claims.Ruleset(fake_jenkins.generate_kb(rules))
+
+    def per_failure():
+        return {id(i): ruleset.match(i) for i in report}
+
+    def per_cluster():
+        out = {}
+        groups = cluster.clusters(report, [i for i in ruleset.fields if i in cluster.ERROR_FIELDS],
+            [i for i in ruleset.fields if i not in cluster.ERROR_FIELDS])
+        for group in groups:
+            rule = ruleset.match(group.cases[0])
+            out.update((id(i), rule) for i in group)
+        return groups, out
+
+    duration, out_plain = timed(per_failure)
+    print("cluster: %s rules x %s failures matched one by one in %.3f s" % (len(ruleset), len(report), duration))
+    duration, (groups, out_clustered) = timed(per_cluster)
+    print("cluster: %s rules x %s clusters (%s to %s failures) clustered and matched in %.3f s" \
+        % (len(ruleset), len(groups), len(groups[-1]), len(groups[0]), duration))
+    assert out_plain == out_clustered, "Clusters have to match same rules"
+    for clusters in (False, True):
+        duration, _ = timed(claims.claim_by_rules, report, ruleset, dryrun=True,
+            cache=claims.MatchCache(), clusters=clusters)
+        print("cluster: claim_by_rules %s in %.3f s" % ('clustered' if clusters else 'one by one', duration))
+
+    # Same errors reported from different places
+    rnd = random.Random(0)
+    for case in report:
+        case['errorStackTrace'] += '\n%s' % rnd.choice(['in setUp', 'in tearDown',
+            'during cleanup', 'in fixture', 'on capsule', 'on satellite'])
+    duration, similar = timed(cluster.clusters, report, threshold=similarity)
+    print("cluster: %s failures in %s clusters, %s after merging similar (>= %s) in %.3f s" \
+        % (len(report), len(cluster.clusters(report)), len(similar), similarity, duration))
+    assert all(len({cluster.normalize(i['errorDetails']) for i in c}) == 1 for c in similar), \
+        "Only the same errors have to be merged"
+
+
+def bench_rule_profile(rules=1000, cases=2000, evil=26, budget=1.0):
+    """
+    Match rules with and without profiling, then with a catastrophically
+    backtracking rule added, without and with time budget for it
+    """
+    report = [claims.Case(i) for i in fake_jenkins.generate_report(
+        cases, fail_ratio=1.0, stdout_lines=0)['suites'][0]['cases']]
+    kb = fake_jenkins.generate_kb(rules)
+    ruleset = claims.Ruleset(kb)
+    duration, out_plain = timed(lambda: [ruleset.match(i) for i in report])
+    print("rule_profile: %s rules x %s failures matched in %.3f s" % (rules, len(report), duration))
+    profile = ruleset.enable_profile()
+    duration, out_profiled = timed(lambda: [ruleset.match(i) for i in report])
+    print("rule_profile: matched with profile in %.3f s" % duration)
+    assert out_plain == out_profiled, "Profiling must not change matching"
+    assert sum(i[3] for i in profile.rows() if '/' not in i[0]) == len([i for i in out_plain if i])
+    slowest = profile.rows(top=1)[0]
+    print("rule_profile: slowest rule %s (%s) %.3f s in %s evaluations" % (slowest[0], slowest[1], slowest[4], slowest[2]))
+
+    # First failure has error which makes the evil rule backtrack
+    report[0]['errorDetails'] = 'a' * evil + '!'
+    kb = [{'field': 'errorDetails', 'pattern': '^(a+)+$', 'reason': 'evil'}] + kb
+    ruleset = claims.Ruleset(kb, budget=0)
+    duration, _ = timed(ruleset.match, report[0])
+    print("rule_profile: rule backtracking over %s characters without budget in %.3f s" % (evil, duration))
+    ruleset = claims.Ruleset(kb, budget=budget)
+    duration, out_budget = timed(lambda: [ruleset.match(i) for i in report])
+    print("rule_profile: all failures with %s s budget for risky patterns in %.3f s" % (budget, duration))
+    assert out_budget[1:] == out_plain[1:], "Budget must not change other matches"
+    ruleset.matchers[0].guard.close()
+
+
+def bench_metrics(cases=2000, latency=0, rules=100, spans=100000):
+    """
+    Load report and claim by rules with metrics disabled and enabled
+    (written to Prometheus file), then time empty spans
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins, \
+            tempfile.TemporaryDirectory() as tmp:
+        fake_builds(jenkins, cases)
+        claims.config['headers'] = None
+        ruleset = claims.Ruleset(fake_jenkins.generate_kb(rules))
+
+        def run():
+            report = claims.Report(fields=claims.Report.fields_for(ruleset))
+            return sorted((i.case['url'], i.reason) for i in claims.claim_by_rules(
+                report, ruleset, cache=claims.MatchCache()))
+
+        duration, out_disabled = timed(run)
+        print("metrics: %s claims with metrics disabled in %.3f s" % (len(out_disabled), duration))
+        fake_builds(jenkins, cases)   # unclaimed again
+        recorder = metrics.enable(os.path.join(tmp, 'claims.prom'))
+        duration, out_enabled = timed(run)
+        duration_save, _ = timed(metrics.save)
+        print("metrics: %s claims with metrics enabled in %.3f s, saved in %.3f s" \
+            % (len(out_enabled), duration, duration_save))
+        assert out_disabled == out_enabled, "Metrics must not change claims"
+        phases = collections.defaultdict(lambda: [0, 0.0, 0])
+        for (name, _), values in recorder.phases.items():
+            phases[name][0] += values[0]
+            phases[name][1] += values[2]
+            phases[name][2] += values[3]
+        for name, (calls, seconds, size) in sorted(phases.items(), key=lambda i: -i[1][1]):
+            print("metrics:   %-24s %6s calls %8.3f s self %10s bytes" % (name, calls, seconds, size))
+        metrics.disable()
+
+    for state in ('disabled', 'enabled'):
+        if state == 'enabled':
+            metrics.enable(os.devnull)
+        duration, _ = timed(lambda: [metrics.span('claim', tier='t1', distro='el7').__enter__()
+            .__exit__(None, None, None) for _ in range(spans)])
+        print("metrics: span %s costs %.2f us" % (state, duration / spans * 1e6))
+    metrics.disable()
+
+
+def bench_match_cache(rules=1000, cases=2000, builds=3):
+    """
+    Match same failures repeated in several builds of all tiers x RHELs
+    without and with MatchCache
+    """
+    report = []
+    for build in range(builds):
+        for job in range(len(claims.config['tiers']) * len(claims.config['rhels'])):
+            report += [claims.Case(i) for i in fake_jenkins.generate_report(
+                cases // builds // 8, fail_ratio=1.0, seed=job)['suites'][0]['cases']]
+    ruleset = claims.Ruleset(fake_jenkins.generate_kb(rules))
+    cache = claims.MatchCache()
+    duration, out_plain = timed(lambda: [ruleset.match(i) for i in report])
+    print("match_cache: %s failures without cache in %.3f s" % (len(report), duration))
+    duration, out_cached = timed(lambda: [ruleset.match(i, cache) for i in report])
+    print("match_cache: %s failures with cache in %.3f s (%s)" % (len(report), duration, cache))
+    assert out_plain == out_cached, "Cache have to return same rules"
+
+
+def bench_push_claims(claims_count=200, latency=0.05, error_ratio=0.05):
+    """
+    Claim failures one by one with push_claim and in bulk with push_claims
+    (against server which fails some requests and rotates crumb)
+    """
+    cases = fake_jenkins.generate_report(claims_count, fail_ratio=1.0)['suites'][0]['cases']
+    with fake_jenkins.FakeJenkins(latency=latency, crumb_ttl=50,
+            error_ratio=error_ratio) as jenkins:
+        claims.config['url'] = jenkins.url
+        claims.config['headers'] = None
+        claims.config['claim_backoff'] = 0.1
+        claims.config._session = None
+        for i in cases:
+            i['url'] = '%s/job/x/1/testReport/junit/%s/%s' % (jenkins.url, i['className'], i['name'])
+
+        def one_by_one():
+            failed = 0
+            for case in [claims.Case(dict(i, testActions=[{'reason': None}])) for i in cases]:
+                try:
+                    case.push_claim('reason "quoted"')
+                except requests.HTTPError:
+                    failed += 1
+            return failed
+
+        def bulk():
+            results = claims.push_claims(
+                [(claims.Case(dict(i, testActions=[{'reason': None}])), 'reason "quoted"') for i in cases])
+            return len([i for i in results if not i.ok])
+
+        duration, failed = timed(one_by_one)
+        print("push_claims: %s claims one by one in %.3f s, %s failed" % (len(cases), duration, failed))
+        duration, failed = timed(bulk)
+        print("push_claims: %s claims in bulk with %s workers in %.3f s, %s failed" \
+            % (len(cases), claims.config['claim_workers'], duration, failed))
+
+
+def bench_pipeline(cases=2000, latency=0.05, rules=100):
+    """
+    Claim failures of all the jobs by claim_by_rules (fetch everything,
+    then match, then claim) and by the pipeline doing all of it at once
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins:
+        fake_builds(jenkins, cases)
+        claims.config['headers'] = None
+        ruleset = claims.Ruleset(fake_jenkins.generate_kb(rules))
+
+        def run(func):
+            """
+            Returns duration, time of the first claim and claims made
+            """
+            before = len(jenkins.claims)
+            first = []
+            done = threading.Event()
+
+            def poll():
+                while not done.is_set() and len(jenkins.claims) == before:
+                    time.sleep(0.005)
+                first.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            poller = threading.Thread(target=poll)
+            poller.start()
+            out = func()
+            duration = time.perf_counter() - start
+            done.set()
+            poller.join()
+            return duration, first[0], sorted((i.case['url'], i.reason) for i in out)
+
+        duration, first, out_sequential = run(lambda: claims.claim_by_rules(
+            claims.Report(fields=claims.Report.fields_for(ruleset)), ruleset,
+            cache=claims.MatchCache()))
+        print("pipeline: %s claims by claim_by_rules in %.3f s, first after %.3f s" \
+            % (len(out_sequential), duration, first))
+        fake_builds(jenkins, cases)   # unclaimed again
+        claims.config['headers'] = None
+        runner = pipeline.Pipeline(ruleset, cache=claims.MatchCache())
+        duration, first, out_pipeline = run(runner.run)
+        print("pipeline: %s claims by pipeline in %.3f s, first after %.3f s, latency from" \
+            " fetch to claim median %.3f s, max %.3f s" % (len(out_pipeline), duration, first,
+                statistics.median(runner.latencies), max(runner.latencies)))
+        assert out_sequential == out_pipeline, "Pipeline have to make same claims"
+
+
+def bench_case_memory(cases=5000, builds=13):
+    """
+    Memory used by cases of several builds of all tiers x RHELs kept as
+    report dicts (as Case used to) and as Case objects
+    """
+    raw = json.dumps(fake_jenkins.generate_report(cases, stdout_lines=0))
+
+    def load(as_case):
+        out = []
+        for build in range(builds):
+            for tier in claims.config['tiers']:
+                for rhel in claims.config['rhels']:
+                    build_url = 'https://jenkins.example.com/job/%s/%s' \
+                        % (claims.config['job'].format(tier, rhel), build)
+                    for i in json.loads(raw)['suites'][0]['cases']:
+                        if as_case:
+                            case = claims.Case(i, build_url)
+                        else:
+                            case = collections.UserDict(i)
+                            class_name = i['className'].split('.')
+                            case['url'] = '%s/testReport/junit/%s/%s/%s' % (build_url,
+                                '.'.join(class_name[:-1]), class_name[-1], i['name'])
+                        case['tier'] = 't{}'.format(tier)
+                        case['distro'] = 'el{}'.format(rhel)
+                        out.append(case)
+        return out
+
+    for as_case in (False, True):
+        tracemalloc.start()
+        duration, out = timed(load, as_case)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("case_memory: %s cases as %s use %s MB (%.3f s)" % (len(out),
+            'Case' if as_case else 'dicts', size // 1024 // 1024, duration))
+        del out
+
+
+def bench_aggregation(cases=100000, legacy=1000):
+    """
+    Compute per-class and per-method failure counts the way claimstats.py
+    used to (for first 'legacy' cases only, it is quadratic) and by
+    aggregation.Stats
+    """
+    report = [claims.Case(i, 'https://jenkins.example.com/job/x/1')
+        for i in fake_jenkins.generate_report(cases, stdout_lines=0)['suites'][0]['cases']]
+
+    def old_way(report):
+        reports_fails = [i for i in report if i['status'] in claims.Case.FAIL_STATUSES]
+        per_class = {}
+        per_method = {}
+        for r in report:
+            for key, out in ((r['className'], per_class), (r['className'].split('.')[2], per_method)):
+                out.setdefault(key, {'all': 0, 'failed': 0})
+                out[key]['all'] += 1
+                if r in reports_fails:
+                    out[key]['failed'] += 1
+        return per_class, per_method
+
+    duration, (per_class, per_method) = timed(old_way, report[:legacy])
+    print("aggregation: %s cases by list lookups in %.3f s" % (legacy, duration))
+    stats = aggregation.Stats(report[:legacy])
+    assert per_class == {k: {'all': v.all, 'failed': v.failed} for k, v in stats.per_class.items()}
+    assert per_method == {k: {'all': v.all, 'failed': v.failed} for k, v in stats.per_method.items()}
+    duration, stats = timed(aggregation.Stats, report)
+    print("aggregation: %s cases by Stats in %.3f s" % (len(report), duration))
+
+
+def bench_stability(cases=2000, builds=300):
+    """
+    Build stability matrix of many builds and compute population stdev of
+    every test per test by statistics.pstdev and vectorized
+    """
+    reports = []
+    for build in range(builds):
+        reports.append([claims.Case(i) for i in fake_jenkins.generate_report(
+            cases, fail_ratio=0.2, stdout_lines=0, seed=build)['suites'][0]['cases']])
+        for i in reports[-1]:
+            i['distro'] = 'el7'
+    duration, matrix = timed(stability.Matrix.from_reports, list(range(builds)), reports)
+    print("stability: %s tests x %s builds matrix built in %.3f s" % (len(matrix.tests), builds, duration))
+
+    def per_test():
+        out = []
+        for row, present in zip(matrix.states.tolist(), matrix.present.tolist()):
+            try:
+                out.append(statistics.pstdev([s for s, p in zip(row, present) if p]))
+            except statistics.StatisticsError:
+                out.append(None)
+        return out
+
+    duration, out_per_test = timed(per_test)
+    print("stability: pstdev by statistics.pstdev in %.3f s" % duration)
+    duration, out_vectorized = timed(lambda: (matrix.pstdev(), matrix.pstdev(window=3), matrix.flip_rate()))
+    print("stability: pstdev, windowed pstdev and flip rate vectorized in %.3f s" % duration)
+    assert all(a is None and b is numpy.ma.masked or abs(a - b) < 1e-9
+        for a, b in zip(out_per_test, out_vectorized[0])), "Vectorized pstdev have to match"
+
+
+def bench_history(cases=500, builds=1000):
+    """
+    Store results of many builds into history, store them again and query
+    it: failing since, claim reasons in last builds and stability matrix
+    """
+    def build_cases(build):
+        out = []
+        for i in fake_jenkins.generate_report(cases, fail_ratio=0.2,
+                stdout_lines=0, seed=build)['suites'][0]['cases']:
+            case = claims.Case(i)
+            case['tier'], case['distro'] = 't1', 'el7'
+            if case['status'] in claims.Case.FAIL_STATUSES and i['name'].endswith('3'):
+                case['testActions'] = [{'reason': 'Issue %s' % (build % 20)}]
+            out.append(case)
+        return out
+
+    job = claims.config['job'].format(1, 7)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = history.History(os.path.join(tmp, 'history.sqlite'))
+        reports = [build_cases(build) for build in range(builds)]
+        duration, _ = timed(lambda: [store.ingest_build(job, b, r) for b, r in enumerate(reports)])
+        print("history: %s builds x %s cases stored in %.3f s" % (builds, cases, duration))
+
+        def counts():
+            return [store._db.execute('SELECT COUNT(*) FROM %s' % i).fetchone()[0]
+                for i in ('builds', 'cases', 'claims')]
+        before = counts()
+        duration, _ = timed(lambda: [store.ingest_build(job, b, r) for b, r in enumerate(reports)])
+        print("history: stored again in %.3f s, rows %s" % (duration, counts()))
+        assert counts() == before, "Storing build again have to be idempotent"
+
+        failing = [(r['className'], r['name']) for r in reports[-1]
+            if r['status'] in claims.Case.FAIL_STATUSES][:100]
+        duration, _ = timed(lambda: [store.first_failure(c, n, 'el7') for c, n in failing])
+        print("history: failing since of %s tests in %.3f s" % (len(failing), duration))
+        duration, reasons = timed(store.reasons, last=50)
+        print("history: %s claim reasons in last 50 builds in %.3f s" % (len(reasons), duration))
+
+        last = list(range(builds - 1, builds - 14, -1))
+        duration, matrix = timed(stability.Matrix.from_history, store, last)
+        print("history: %s tests x %s builds matrix from history in %.3f s" \
+            % (len(matrix.tests), len(last), duration))
+        expected = stability.Matrix.from_reports(last, [reports[i] for i in last])
+        assert matrix.tests == expected.tests and (matrix.states == expected.states).all() \
+            and (matrix.present == expected.present).all(), "Matrix from history have to match"
+        store.close()
+
+
+def bench_claimstats(cases=2000, rules=100, latency=0):
+    """
+    Run claimstats.py over all tiers x RHELs (kb.json of generated rules
+    in a temporary directory)
+    """
+    with fake_jenkins.FakeJenkins(latency=latency) as jenkins, \
+            tempfile.TemporaryDirectory() as tmp:
+        fake_builds(jenkins, cases)
+        with open(os.path.join(tmp, 'kb.json'), 'w') as fp:
+            json.dump(fake_jenkins.generate_kb(rules), fp)
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                duration, _ = timed(claimstats.main, [])
+        finally:
+            os.chdir(cwd)
+        print("claimstats: %s cases x %s jobs, %s rules in %.3f s (%s lines of output)" \
+            % (cases, len(jenkins.builds), rules, duration, len(out.getvalue().splitlines())))
+
+
+def bench_lane_packing(tests=5000, parallel=50):
+    """
+    Sort test runs into rungraph lanes by checking every interval of every
+    lane (as rungraph.py used to) and by rungraph.pack_lanes
+    """
+    rnd = random.Random(0)
+    intervals = []
+    for _ in range(tests):
+        start = rnd.randint(0, tests * 300 // parallel)
+        intervals.append((start, start + rnd.randint(1, 300)))
+
+    def old_way():
+        lanes = []
+        for interval in intervals:
+            lane_found = False
+            for lane in lanes:
+                lane_found = True
+                for i in lane:
+                    if i[0] <= interval[0] <= i[1] or i[0] <= interval[1] <= i[1]:
+                        lane_found = False
+                        break
+                if lane_found:
+                    break
+            if not lane_found:
+                lane = []
+                lanes.append(lane)
+            lane.append(interval)
+        return len(lanes)
+
+    duration, count = timed(old_way)
+    print("lane_packing: %s tests into %s lanes by checking all lanes in %.3f s"
+        " (it misses intervals containing each other)" % (tests, count, duration))
+    duration, lanes = timed(rungraph.pack_lanes, intervals)
+    # Intervals in a lane must not overlap (nor touch) and there must be
+    # as many lanes as tests running at once at the busiest moment
+    per_lane = collections.defaultdict(list)
+    for interval, lane in zip(intervals, lanes):
+        per_lane[lane].append(interval)
+    for lane in per_lane.values():
+        lane.sort()
+        assert all(a[1] < b[0] for a, b in zip(lane, lane[1:])), "overlapping intervals in a lane"
+    running = peak = 0
+    for _, change in sorted([(start, -1) for start, _ in intervals] + [(end, 1) for _, end in intervals]):
+        running -= change
+        peak = max(peak, running)
+    assert len(per_lane) == max(lanes) + 1 == peak, "%s lanes for %s tests at once" % (len(per_lane), peak)
+    print("lane_packing: %s tests into %s lanes by pack_lanes in %.3f s" % (tests, max(lanes) + 1, duration))
+
+
+def bench_timings(cases=100, stdout_lines=50000):
+    """
+    Find start and end of tests with big stdout by splitting stdout into
+    lines (as Case.load_timings used to) and by Case.timings
+    """
+    stdouts = [i['stdout'] + '\nsome trailing output without timestamp' for i in
+        fake_jenkins.generate_report(cases, stdout_lines=stdout_lines)['suites'][0]['cases']]
+
+    def old_way(stdout):
+        log = stdout.split("\n")
+        counter = 0
+        while True:
+            match = claims.Case.LOG_DATE_REGEXP.match(log[counter])
+            if match:
+                start = datetime.datetime.strptime(match.group(1), claims.Case.LOG_DATE_FORMAT)
+                break
+            counter += 1
+        counter = -1
+        while True:
+            match = claims.Case.LOG_DATE_REGEXP.match(log[counter])
+            if match:
+                end = datetime.datetime.strptime(match.group(1), claims.Case.LOG_DATE_FORMAT)
+                break
+            counter -= 1
+        return (start, end)
+
+    duration, out_old = timed(lambda: [old_way(i) for i in stdouts])
+    print("timings: %s stdouts of %s MB by splitting in %.3f s" \
+        % (cases, sum(len(i) for i in stdouts) // 1024 // 1024, duration))
+    duration, out_new = timed(lambda: [claims.Case.timings(i) for i in stdouts])
+    print("timings: %s stdouts by Case.timings in %.3f s" % (cases, duration))
+    assert out_old == out_new, "Both ways have to find same timings"
+
+
+BENCHMARKS = {
+    'lane_packing': bench_lane_packing,
+    'stability': bench_stability,
+    'history': bench_history,
+    'timings': bench_timings,
+    'unchanged': bench_unchanged,
+    'watch': bench_watch,
+    'aggregation': bench_aggregation,
+    'case_memory': bench_case_memory,
+    'claim_by_rules': bench_claim_by_rules,
+    'claimstats': bench_claimstats,
+    'cluster': bench_cluster,
+    'field_projection': bench_field_projection,
+    'foreman_debug': bench_foreman_debug,
+    'match_cache': bench_match_cache,
+    'metrics': bench_metrics,
+    'pipeline': bench_pipeline,
+    'push_claims': bench_push_claims,
+    'production_log': bench_production_log,
+    'production_log_parse': bench_production_log_parse,
+    'report_cache': bench_report_cache,
+    'report_fetch': bench_report_fetch,
+    'report_lazy': bench_report_lazy,
+    'report_stream': bench_report_stream,
+    'rule_profile': bench_rule_profile,
+}
+
+
+# Timings (and memory) in the printed results, e.g. "in 1.234 s"
+RESULT_REGEXP = re.compile(r'\b(\d+(?:\.\d+)?) (s|us|MB)\b')
+
+
+class Results(io.TextIOBase):
+    """
+    Stdout collecting printed results: {result line with timings replaced
+    by '#': [timings in seconds]} of every benchmark. Fastest timings are
+    kept when the same result is printed more times (repeated runs).
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.results = collections.OrderedDict()
+        self._line = ''
+
+    def write(self, text):
+        self.stdout.write(text)
+        lines = (self._line + text).split('\n')
+        self._line = lines.pop()
+        for line in lines:
+            name = line.split(':', 1)[0]
+            timings = [float(v) / (1e6 if unit == 'us' else 1)
+                for v, unit in RESULT_REGEXP.findall(line) if unit != 'MB']
+            if timings and name in BENCHMARKS:
+                results = self.results.setdefault(name, collections.OrderedDict())
+                key = RESULT_REGEXP.sub(lambda m: '# ' + m.group(2), line)
+                if key in results and len(results[key]) == len(timings):
+                    timings = [min(a, b) for a, b in zip(results[key], timings)]
+                results[key] = timings
+        return len(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+def compare(baseline, results, tolerance, noise=0.01):
+    """
+    Prints results next to the baseline, returns number of timings slower
+    than the baseline by more than 'tolerance' (ratio) and 'noise' seconds
+    """
+    rows = []
+    regressions = 0
+    for name, lines in results.items():
+        if name not in baseline:
+            continue
+        if baseline[name]['params'] != lines['params']:
+            print("%s: params differ from the baseline (%s), not compared" % (name, baseline[name]['params']))
+            continue
+        for line, timings in lines['results'].items():
+            before = baseline[name]['results'].get(line)
+            if before is None or len(before) != len(timings):
+                continue
+            for old, new in zip(before, timings):
+                slower = new > old * (1 + tolerance) and new - old > noise
+                regressions += slower
+                rows.append((line[:90], old, new, '%+.0f%%' % ((new / old - 1) * 100) if old else '',
+                    'REGRESSION' if slower else ''))
+    print(tabulate.tabulate(rows, headers=['result', 'baseline', 'now', 'change', ''], floatfmt='.3f'))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the claims machinery against local fake Jenkins')
+    parser.add_argument('args', nargs='*', metavar='benchmark|param=value',
+        help='benchmarks to run (all by default): %s' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--save', metavar='FILE', help='save results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare results with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='slow down (ratio) reported as regression (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='run every benchmark this many times, keep the fastest timings (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    names = [i for i in args.args if '=' not in i]
+    params = dict(i.split('=', 1) for i in args.args if '=' in i)
+    params = {k: float(v) if '.' in v else int(v) for k, v in params.items()}
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+    results = Results(sys.stdout)
+    out = collections.OrderedDict()
+    with contextlib.redirect_stdout(results):
+        for name in names or sorted(BENCHMARKS):
+            accepted = inspect.signature(BENCHMARKS[name]).parameters
+            kwargs = {k: v for k, v in params.items() if k in accepted}
+            for _ in range(args.repeat):
+                BENCHMARKS[name](**kwargs)
+            out[name] = {'params': kwargs, 'results': results.results.get(name, {})}
+    if args.save:
+        baseline = {}
+        if os.path.isfile(args.save):
+            with open(args.save) as fp:
+                baseline = json.load(fp)
+        baseline.update(out)
+        with open(args.save + '.tmp', 'w') as fp:
+            json.dump(baseline, fp, indent=2)
+        os.replace(args.save + '.tmp', args.save)
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(json.load(fp), out, args.tolerance)
+        if regressions:
+            print("%s timings regressed" % regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
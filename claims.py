@@ -10,198 +10,795 @@ import requests
 import yaml
 import pickle
 import collections
+import collections.abc
 import datetime
+import io
 import tempfile
-import subprocess
+import tarfile
 import shutil
+import concurrent.futures
+import bisect
+import mmap
+import array
+import hashlib
+import threading
+import time
+import functools
+import itertools
+import csv
+import multiprocessing
+import codecs
+try:
+    from re import _parser as sre_parse, _constants as sre_constants   # Python >= 3.11
+except ImportError:
+    import sre_parse
+    import sre_constants
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 
 class Config(collections.UserDict):
     def __init__(self):
         with open("config.yaml", "r") as file:
-            self.data = yaml.load(file)
+            self.data = yaml.safe_load(file)
 
-        # If cache is configured, save it into configuration
+        # If cache is configured, save it into configuration. Cache is
+        # a directory with one file per job and build number.
         if 'DEBUG_CLAIMS_CACHE' in os.environ:
             self.data['cache'] = os.environ['DEBUG_CLAIMS_CACHE']
         else:
-            self.data['cache'] = None
+            self.data.setdefault('cache', None)
 
         # Additional params when talking to Jenkins
+        self.data.setdefault('timeout', 60)
+        self.data.setdefault('fetch_workers', 1)
+        self.data.setdefault('download_chunk_size', 64 * 1024)
+        self.data.setdefault('parse_workers', 1)   # processes indexing production.log
+        self.data.setdefault('match_cache', None)
+        self.data.setdefault('match_cache_size', 100000)
+        self.data.setdefault('claim_workers', 4)
+        self.data.setdefault('claim_rate', None)   # claims per second
+        self.data.setdefault('claim_retries', 3)
+        self.data.setdefault('claim_backoff', 1)   # seconds, doubled on every retry
+        self.data.setdefault('cluster_failures', False)   # match rules once per cluster.py cluster
+        self.data.setdefault('rule_time_budget', None)   # seconds per search for risky patterns
+        self.data.setdefault('rule_profile', None)   # CSV or JSON file with stats of the rules
+        self.data.setdefault('state', None)   # builds processed by the last run
+        self.data.setdefault('history', None)   # SQLite file with results of the builds
+        self.data.setdefault('metrics', None)   # Prometheus text file or .jsonl trace
+        self.data.setdefault('watch_interval', 60)   # seconds between polls of watch.py
+        self.data.setdefault('watch_state', None)
+        # Matrix of the jobs
+        self.data.setdefault('tiers', [1, 2, 3, 4])
+        self.data.setdefault('rhels', [6, 7])
+        self._session = None
+        self._crumb_lock = threading.RLock()
         self['headers'] = None
         self['pull_params'] = {
-            u'tree': u'suites[cases[className,duration,name,status,stdout,errorDetails,errorStackTrace,testActions[reason]]]{0}'
+            u'tree': u'suites[cases[className,duration,name,status,stdout,errorDetails,errorStackTrace,testActions[reason]]]'
         }
 
-    def init_headers(self):
-        requests.packages.urllib3.disable_warnings()
+    @property
+    def session(self):
+        """
+        Keep-alive session shared by all requests to Jenkins, so we do not
+        do TLS handshake for every request. Pool is big enough to serve all
+        the threads pipeline.py runs at once: fetch workers, as many
+        fetching lazy fields and claim workers.
+        """
+        if self._session is None:
+            requests.packages.urllib3.disable_warnings()
+            self._session = requests.Session()
+            self._session.auth = requests.auth.HTTPBasicAuth(self['usr'], self['pwd'])
+            self._session.verify = False
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=max(2 * self['fetch_workers'] + self['claim_workers'], 10))
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
 
-        # Get the Jenkins crumb (csrf protection)
-        crumb_request = requests.get(
-                '{0}/crumbIssuer/api/json'.format(self['url']),
-                auth=requests.auth.HTTPBasicAuth(self['usr'], self['pwd']),
-                verify=False
-            )
+    def init_headers(self, expired=None):
+        """
+        Gets the Jenkins crumb. If 'expired' headers are given, crumb is
+        only refreshed when some other thread have not done it already.
+        """
+        with self._crumb_lock:
+            if expired is not None and self['headers'] is not expired:
+                return
+
+            # Get the Jenkins crumb (csrf protection)
+            with metrics.span('crumb'):
+                crumb_request = self.session.get(
+                        '{0}/crumbIssuer/api/json'.format(self['url']),
+                        timeout=self['timeout']
+                    )
+
+            if crumb_request.status_code != 200:
+                raise requests.HTTPError(
+                    'Failed to obtain crumb: {0}'.format(crumb_request.reason))
 
-        if crumb_request.status_code != 200:
+            crumb = json.loads(crumb_request.text)
+            self['headers'] = {crumb['crumbRequestField']: crumb['crumb']}
+
+    def crumb_headers(self):
+        with self._crumb_lock:
+            if self['headers'] is None:
+                self.init_headers()
+            return self['headers']
+
+    def job_labels(self, job, build=None):
+        """
+        Returns labels of metrics for given job and build: tier, distro and
+        build (or the job name if it is not one of tiers x RHELs)
+        """
+        for tier in self['tiers']:
+            for rhel in self['rhels']:
+                if self['job'].format(tier, rhel) == job:
+                    return {'tier': 't{}'.format(tier), 'distro': 'el{}'.format(rhel), 'build': build}
+        return {'job': job, 'build': build}
+
+    def completed_builds(self, job, count):
+        """
+        Returns numbers of (at most) 'count' last completed builds of the
+        job, newest first
+        """
+        job_req = self.session.get(
+            '{0}/job/{1}/api/json'.format(self['url'], job),
+            params={'tree': 'builds[number,building]{{0,{0}}}'.format(count + 1)},
+            timeout=self['timeout']
+        )
+
+        if job_req.status_code == 404:
+            return []
+        if job_req.status_code != 200:
             raise requests.HTTPError(
-                'Failed to obtain crumb: {0}'.format(crumb_request.reason))
+                'Failed to list builds: {0}'.format(job_req))
+
+        builds = json.loads(job_req.text)['builds']
+        return sorted([b['number'] for b in builds if not b['building']],
+            reverse=True)[:count]
+
+    def resolve_build(self, job, build):
+        """
+        Translates build alias (e.g. 'lastCompletedBuild') to a build number.
+        Returns tuple (number, building) or (None, None) if there is no
+        such build.
+        """
+        build_req = self.session.get(
+            '{0}/job/{1}/{2}/api/json'.format(self['url'], job, build),
+            params={'tree': 'number,building'},
+            timeout=self['timeout']
+        )
+
+        if build_req.status_code == 404:
+            return (None, None)
+        if build_req.status_code != 200:
+            raise requests.HTTPError(
+                'Failed to resolve build: {0}'.format(build_req))
+
+        build_info = json.loads(build_req.text)
+        return (build_info['number'], build_info['building'])
+
+    def report_size(self, job, build):
+        """
+        Returns number of results in the test report of given build of the
+        job (cheap to ask for often), None if there is no report (yet)
+        """
+        report_req = self.session.get(
+            '{0}/job/{1}/{2}/testReport/api/json'.format(self['url'], job, build),
+            params={'tree': 'failCount,passCount,skipCount'},
+            timeout=self['timeout']
+        )
+
+        if report_req.status_code == 404:
+            return None
+        if report_req.status_code != 200:
+            raise requests.HTTPError(
+                'Failed to get size of report: {0}'.format(report_req))
+
+        counts = json.loads(report_req.text)
+        return sum(counts.get(i) or 0 for i in ('failCount', 'passCount', 'skipCount'))
+
+    def cache_path(self, job, build, suffix):
+        """
+        Returns path to the cache file for given job and build number or
+        None if cache is not configured
+        """
+        if not self['cache']:
+            return None
+        return os.path.join(self['cache'], job, '{0}{1}'.format(build, suffix))
+
+
+class IterStream(io.RawIOBase):
+    """
+    Read-only file object reading from an iterator of bytes chunks
+    (e.g. requests' iter_content)
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            try:
+                self._buf = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buf))
+        b[:size] = self._buf[:size]
+        self._buf = self._buf[size:]
+        return size
 
-        crumb = json.loads(crumb_request.text)
-        self['headers'] = {crumb['crumbRequestField']: crumb['crumb']}
+
+JSON_CASES_REGEXP = re.compile(r'"cases"\s*:\s*\[')
+JSON_SEPARATORS_REGEXP = re.compile(r'[\s,]*')
+
+
+def iter_json_cases(chunks, sizes=None):
+    """
+    Parses test report JSON from an iterator of bytes chunks and yields
+    test cases (dicts) of all the suites one by one, as soon as they are
+    complete. Only the case being parsed is kept in memory. Number of
+    cases of every suite is appended to 'sizes' list if given.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    chunks = iter(chunks)
+    buf = u''
+    pos = 0
+    in_cases = False
+    eof = False
+    wanted = 0   # do not retry incomplete case until that much text is buffered
+    while True:
+        if in_cases:
+            pos = JSON_SEPARATORS_REGEXP.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                in_cases = False
+                pos += 1
+                continue
+            if pos < len(buf) and (eof or len(buf) - pos >= wanted):
+                try:
+                    case, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    # Case is not complete yet, wait until the buffered
+                    # text doubles, so long cases are not parsed too often
+                    wanted = 2 * (len(buf) - pos)
+                else:
+                    wanted = 0
+                    if sizes is not None:
+                        sizes[-1] += 1
+                    yield case
+                    continue
+        else:
+            match = JSON_CASES_REGEXP.search(buf, pos)
+            if match:
+                in_cases = True
+                if sizes is not None:
+                    sizes.append(0)
+                pos = match.end()
+                continue
+            # Keep only the text which can be the start of "cases" key
+            key = buf.rfind(u'"cases"', pos)
+            pos = key if key >= 0 else max(pos, len(buf) - len(u'"cases"'))
+        if eof:
+            if in_cases:
+                raise ValueError('Test report ends in the middle of cases')
+            return
+        buf = buf[pos:]
+        pos = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf += text.decode(b'', final=True)
+        else:
+            buf += text.decode(chunk)
 
 
 class ForemanDebug(object):
+    """
+    foreman-debug.tar.xz archive of a build. Archive is decompressed while
+    it is being downloaded and only the requested members are stored.
+    """
 
-    def __init__(self, tier, rhel):
-        self._url = "%s/job/%s/%s/artifact/foreman-debug.tar.xz" % (config['url'], config['job'].format(tier, rhel), config['bld'])
-        self._extracted = None
+    def __init__(self, job, build):
+        self._url = "%s/job/%s/%s/artifact/foreman-debug.tar.xz" % (config['url'], job, build)
+        self._labels = config.job_labels(job, build)
 
-    @property
-    def extracted(self):
-        if self._extracted is None:
-            logging.debug('Going to download %s' % self._url)
-            with tempfile.NamedTemporaryFile(mode='w+b', delete=False) as localfile:
-                logging.debug('Going to save to %s' % localfile.name)
-                self._download_file(localfile, self._url)
-            self._tmpdir = tempfile.TemporaryDirectory()
-            subprocess.call(['tar', '-xf', localfile.name, '--directory', self._tmpdir.name])
-            logging.debug('Extracted to %s' % self._tmpdir.name)
-            self._extracted = os.path.join(self._tmpdir.name, 'foreman-debug')
-        return self._extracted
-
-    def _download_file(self, localfile, url):
-        r = requests.get(url, stream=True, verify=False)
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk: # filter out keep-alive new chunks
-                localfile.write(chunk)
-        if r.status_code != 200:
-            raise requests.HTTPError("Failed to get foreman-debug %s" % url)
-        localfile.close()
-        logging.debug('File %s saved to %s' % (url, localfile.name))
+    VALIDATORS = (('ETag', 'If-None-Match'), ('Last-Modified', 'If-Modified-Since'))
+
+    def extract(self, member, localfile, validators=None):
+        """
+        Writes content of the member (path inside of the archive without
+        top level directory, e.g. 'var/log/foreman/production.log') into
+        given binary file object. Returns validators of the downloaded
+        archive (ETag and Last-Modified headers) or None if 'validators' of
+        previously downloaded archive were given and it did not change.
+        """
+        headers = {}
+        for name, condition in self.VALIDATORS:
+            if validators and validators.get(name):
+                headers[condition] = validators[name]
+        logging.debug('Going to download %s' % self._url)
+        # Time of the download is 'foreman_debug_download', self time of
+        # 'foreman_debug' is decompression and extraction
+        with metrics.span('foreman_debug', **self._labels):
+            r = config.session.get(self._url, stream=True, headers=headers,
+                timeout=config['timeout'])
+            try:
+                if r.status_code == 304:
+                    logging.debug('Not modified %s' % self._url)
+                    return None
+                if r.status_code != 200:
+                    raise requests.HTTPError("Failed to get foreman-debug %s" % self._url)
+                stream = IterStream(metrics.timed_iter(
+                    r.iter_content(chunk_size=config['download_chunk_size']),
+                    'foreman_debug_download', **self._labels))
+                with tarfile.open(fileobj=stream, mode='r|xz') as tar:
+                    for info in tar:
+                        if info.isfile() and info.name.split('/', 1)[-1] == member:
+                            shutil.copyfileobj(tar.extractfile(info), localfile)
+                            logging.debug('Extracted %s from %s' % (info.name, self._url))
+                            return {name: r.headers[name] for name, _ in self.VALIDATORS
+                                if name in r.headers}
+            finally:
+                r.close()
+        raise FileNotFoundError("There is no %s in %s" % (member, self._url))
 
 
 class ProductionLog(object):
+    """
+    Foreman production.log. File is memory mapped and only times and
+    offsets of the log records are kept in memory, records are decoded
+    when they are asked for.
+    """
 
     FILE_ENCODING = 'ISO-8859-1'   # guessed, that wile contains ugly binary mess as well
-    DATE_REGEXP = re.compile('^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2} ')   # 2018-06-13T07:37:26
+    DATE_REGEXP = re.compile(b'^([0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}) ', re.MULTILINE)   # 2018-06-13T07:37:26
+    LINE_DATE_REGEXP = re.compile(b'\n' + DATE_REGEXP.pattern[1:])   # same, preceded by newline
     DATE_FMT = '%Y-%m-%dT%H:%M:%S'   # 2018-06-13T07:37:26
+    DATE_LEN = 20   # length of the date prefix including trailing space
+    EPOCH = datetime.datetime(1970, 1, 1)
+    CHUNK_SIZE = 64 * 1024 * 1024   # indexed by one worker process
 
-    def __init__(self, tier, rhel):
-        self._log = None
-        self._logfile = None
+    def __init__(self, job, build, logfile=None):
+        self._mmap = None
+        self._times = None     # time of each record in seconds since EPOCH
+        self._offsets = None   # offset of each record in the file
+        self._index = None
+        self._tmpfile = None
+        self._logfile = logfile
         self._cache = None
+        self._foreman_debug = None
 
-        if 'cache' in config:
-            self._cache = '%s-t%s-el%s-production.log' \
-                % (config['cache'].replace('.pickle', ''), tier, rhel)
-            if self._cache and os.path.isfile(self._cache):
+        # Parse given local file instead of downloading it
+        if logfile is not None:
+            return None
+
+        self._cache = config.cache_path(job, build, '-production.log')
+
+        if self._cache:
+            if os.path.isfile(self._cache):
                 self._logfile = self._cache
-                logging.debug("Loading production.log from cached %s" % self._logfile)
-                return None
+                # Artifacts of a build number do not change, artifacts of
+                # an alias (e.g. lastCompletedBuild) are downloaded again
+                # only if conditional request says they changed
+                if str(build).isdigit():
+                    logging.debug("Loading production.log from cached %s" % self._logfile)
+                    return None
+                logging.debug("Revalidating cached production.log %s" % self._logfile)
             else:
                 logging.debug("Cache for production.log (%s) set, but not available. Will create it if we have a chance" % self._cache)
 
-        self._foreman_debug = ForemanDebug(tier, rhel)
+        self._foreman_debug = ForemanDebug(job, build)
 
     @property
     def log(self):
-        if self._log is None:
-            if self._logfile is None:
-                self._logfile = os.path.join(self._foreman_debug.extracted,
-                    'var', 'log', 'foreman', 'production.log')
-            self._log = []
-            buf = []
-            last = None
-            with open(self._logfile, 'r', encoding=self.FILE_ENCODING) as fp:
-                for line in fp:
-
-                    # This line starts with date - denotes first line of new log record
-                    if re.search(self.DATE_REGEXP, line):
-
-                        # This is a new log record, so firs save previous one
-                        if len(buf) != 0:
-                            self._log.append({'time': last, 'data': buf})
-                        last = datetime.datetime.strptime(line[:19], self.DATE_FMT)
-                        buf = []
-                        buf.append(re.sub(self.DATE_REGEXP, '', line, count=1))
-
-                    # This line does not start with line - comtains continuation of a log recorder started before
-                    else:
-                        buf.append(line)
-
-                # Save last line
-                if len(buf) != 0:
-                    self._log.append({'time': last, 'data': buf})
-
-            # Cache file we have downloaded
-            if self._cache and not os.path.isfile(self._cache):
-                logging.debug("Caching production.log %s to %s" % (self._logfile, self._cache))
-                shutil.copyfile(self._logfile, self._cache)
-
-            logging.debug("File %s parsed into memory and deleted" % self._logfile)
-        return self._log
+        """
+        All the log records as list of {'time': ..., 'data': [lines]}.
+        This decodes whole log, so prefer from_to().
+        """
+        return [self._record(i) for i in range(len(self.times))]
 
-    def from_to(self, from_time, to_time):
+    @property
+    def times(self):
+        if self._times is None:
+            self.load_all([self])
+        return self._times
+
+    @classmethod
+    def load_all(cls, logs, workers=None):
+        """
+        Downloads and indexes given logs (those which were not loaded yet).
+        If there are more 'workers' ('parse_workers' by default) than one,
+        logs are split into chunks of CHUNK_SIZE at line boundaries and
+        chunks of all the logs are indexed by pool of processes.
+        """
+        if workers is None:
+            workers = config['parse_workers']
+        logs = [i for i in logs if i._times is None]
+        if not logs:
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=config['fetch_workers']) as executor:
+            list(executor.map(lambda log: log._open(), logs))
+        with metrics.span('production_log_index') as span:
+            span.add_bytes(sum(len(i._mmap) for i in logs))
+            if workers <= 1:
+                for log in logs:
+                    log._set_index([cls.index_chunk(log._logfile, 0, len(log._mmap))])
+                return
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = [[executor.submit(cls.index_chunk, log._logfile, start, end)
+                    for start, end in log._chunks()] for log in logs]
+                for log, futures in zip(logs, parts):
+                    log._set_index([i.result() for i in futures])
+
+    def _open(self):
+        # Extract the log from foreman-debug straight into the cache (if
+        # configured) or into temporary file living as long as we do
+        if self._foreman_debug is not None:
+            if self._cache:
+                os.makedirs(os.path.dirname(self._cache), exist_ok=True)
+                validators = None
+                if self._logfile is not None and os.path.isfile(self._cache + '.json'):
+                    with open(self._cache + '.json') as fp:
+                        validators = json.load(fp)
+                try:
+                    with open(self._cache + '.tmp', 'wb') as fp:
+                        validators = self._foreman_debug.extract(
+                            'var/log/foreman/production.log', fp, validators)
+                except BaseException:
+                    # Do not leave partly extracted log in the cache
+                    os.remove(self._cache + '.tmp')
+                    raise
+                if validators is None:
+                    os.remove(self._cache + '.tmp')
+                else:
+                    os.replace(self._cache + '.tmp', self._cache)
+                    with open(self._cache + '.json', 'w') as fp:
+                        json.dump(validators, fp)
+                    logging.debug("Cached production.log to %s" % self._cache)
+                self._logfile = self._cache
+            else:
+                self._tmpfile = tempfile.NamedTemporaryFile(suffix='-production.log')
+                self._foreman_debug.extract(
+                    'var/log/foreman/production.log', self._tmpfile)
+                self._tmpfile.flush()
+                self._logfile = self._tmpfile.name
+            self._foreman_debug = None
+
+        with open(self._logfile, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                self._mmap = b''
+            else:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _chunks(self):
+        """
+        Returns list of (start, end) of parts of the file, about CHUNK_SIZE
+        long, split after the end of a line
+        """
         out = []
-        for i in self.log:
-            if from_time <= i['time'] <= to_time:
-                out.append(i)
-            # Do not do following as time is not sequentional in the log (or maybe some workers are off or with different TZ?):
-            # TODO: Fix ordering of the log and uncomment this
-            #
-            # E.g.:
-            #   2018-06-17T17:29:44 [I|dyn|] start terminating clock...
-            #   2018-06-17T21:34:49 [I|app|] Current user: foreman_admin (administrator)
-            #   2018-06-17T21:37:21 [...]
-            #   2018-06-17T17:41:38 [I|app|] Started POST "/katello/api/v2/organizations"...
-            #
-            #if i['time'] > to_time:
-            #    break
+        start = 0
+        while start < len(self._mmap):
+            end = self._mmap.find(b'\n', start + self.CHUNK_SIZE) + 1 or len(self._mmap)
+            out.append((start, end))
+            start = end
         return out
 
+    @classmethod
+    def index_chunk(cls, filename, start, end):
+        """
+        Returns times and offsets of the log records starting in given
+        part of the file (which starts at line boundary) as bytes of 'q'
+        and 'Q' arrays, which are cheap to send back from worker process
+        """
+        # Every line which starts with date denotes first line of new log
+        # record, lines which do not start with date are continuation of
+        # a record started before (anything before first record is ignored)
+        times = array.array('q')
+        offsets = array.array('Q')
+        if end <= start:
+            return times.tobytes(), offsets.tobytes()
+        days = {}   # seconds since EPOCH of the dates seen
+        with open(filename, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Searching for newline followed by date is much faster than
+            # for date at the beginning of a line, only the very first line
+            # has to be checked separately
+            matches = cls.LINE_DATE_REGEXP.finditer(data, max(start - 1, 0), end)
+            first = cls.DATE_REGEXP.match(data, 0, end) if start == 0 else None
+            if first is not None:
+                matches = itertools.chain([first], matches)
+            for match in matches:
+                stamp = match.group(1)
+                day = stamp[:10]
+                if day not in days:
+                    days[day] = (datetime.datetime.strptime(
+                        day.decode('ascii'), cls.DATE_FMT[:8]) - cls.EPOCH) \
+                        // datetime.timedelta(seconds=1)
+                times.append(days[day] + int(stamp[11:13]) * 3600
+                    + int(stamp[14:16]) * 60 + int(stamp[17:19]))
+                offsets.append(match.start(1))
+        return times.tobytes(), offsets.tobytes()
 
-class Case(collections.UserDict):
+    def _set_index(self, parts):
+        times = array.array('q')
+        offsets = array.array('Q')
+        for part_times, part_offsets in parts:
+            times.frombytes(part_times)
+            offsets.frombytes(part_offsets)
+        self._times = times
+        self._offsets = offsets
+        logging.debug("File %s indexed into %s records" % (self._logfile, len(times)))
+
+    def _seconds(self, time):
+        return (time - self.EPOCH) // datetime.timedelta(seconds=1)
+
+    def _record(self, position):
+        """
+        Decodes log record on given position in the log
+        """
+        start = self._offsets[position] + self.DATE_LEN
+        if position + 1 < len(self._offsets):
+            end = self._offsets[position + 1]
+        else:
+            end = len(self._mmap)
+        data = self._mmap[start:end].decode(self.FILE_ENCODING)
+        # Split to lines keeping line ends, as reading text file would do
+        data = data.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        lines = [i + '\n' for i in data[:-1]]
+        if data[-1]:
+            lines.append(data[-1])
+        return {
+            'time': self.EPOCH + datetime.timedelta(seconds=self._times[position]),
+            'data': lines,
+        }
+
+    @property
+    def index(self):
+        """
+        Tuple (times, positions) where times are times of all the log
+        records sorted and positions are indexes of these records in
+        the log. Time is not sequential in the log (maybe some workers
+        are off or with different TZ?), e.g.:
+
+            2018-06-17T17:29:44 [I|dyn|] start terminating clock...
+            2018-06-17T21:34:49 [I|app|] Current user: foreman_admin (administrator)
+            2018-06-17T21:37:21 [...]
+            2018-06-17T17:41:38 [I|app|] Started POST "/katello/api/v2/organizations"...
+
+        so we can not just bisect the log itself.
+        """
+        if self._index is None:
+            times = self.times
+            positions = array.array('Q', sorted(range(len(times)), key=times.__getitem__))
+            self._index = (array.array('q', (times[i] for i in positions)), positions)
+        return self._index
+
+    def from_to(self, from_time, to_time):
+        """
+        Returns log records with time in given interval (including
+        boundaries) in the order they are in the log
+        """
+        times, positions = self.index
+        first = bisect.bisect_left(times, self._seconds(from_time))
+        last = bisect.bisect_right(times, self._seconds(to_time))
+        return [self._record(i) for i in sorted(positions[first:last])]
+
+
+class Case(collections.abc.MutableMapping):
     """
-    Result of one test case
+    Result of one test case. Behaves as a dict of its fields, but fields
+    of the test report are stored in slots (repeated strings interned,
+    status as a small number) and URL is built from its parts on demand,
+    because we keep hundreds of thousands of these in memory. Any other
+    fields go to a dict created only when needed. Fields of the report
+    which were not fetched with it ('lazy') are fetched from the case URL
+    when they are asked for.
     """
 
     FAIL_STATUSES = ("FAILED", "ERROR", "REGRESSION")
-    LOG_DATE_REGEXP = re.compile('^([0-9]{4}-[01][0-9]-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}) -')
+    STATUSES = ("PASSED", "SKIPPED", "FIXED") + FAIL_STATUSES
+    STATUS_CODES = {s: i for i, s in enumerate(STATUSES)}
+    FIELDS = ('className', 'name', 'duration', 'stdout', 'errorDetails',
+        'errorStackTrace', 'testActions', 'tier', 'distro')
+    INTERNED_FIELDS = ('className', 'name', 'tier', 'distro')
+    DERIVED_FIELDS = ('start', 'end', 'production.log')   # computed for the build, not in the report
+    LOG_DATE_REGEXP = re.compile('^([0-9]{4}-[01][0-9]-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}) -', re.MULTILINE)
     LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
-    def __init__(self, data):
-        self.data = data
+    __slots__ = FIELDS + ('_status', '_build_url', '_url', '_production_log',
+        '_start', '_end', '_extra', '_lazy')
 
-    def __contains__(self, name):
-        return name in self.data or name in ('start', 'end', 'production.log')
+    def __init__(self, data, build_url=None, lazy=None):
+        self._status = None
+        self._build_url = build_url
+        self._url = None
+        self._production_log = None
+        self._extra = None
+        self._lazy = lazy or None
+        for name, value in data.items():
+            self[name] = value
 
     def __getitem__(self, name):
-        if name in ('start', 'end') and \
-            ('start' not in self.data or 'end' not in self.data):
-            self.load_timings()
-        if name == 'production.log':
+        if name in self.FIELDS:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                if self._lazy is None or name not in self._lazy:
+                    raise KeyError(name)
+            self.fetch_fields()
+            return self[name]
+        if name == 'status' and self._status is not None:
+            return self.STATUSES[self._status]
+        if name == 'url' and (self._url is not None or self._build_url is not None):
+            if self._url is None:
+                return self._build_url_for()
+            return self._url
+        if name == 'OBJECT:production.log' and self._production_log is not None:
+            return self._production_log
+        if name in ('start', 'end'):
+            if not hasattr(self, '_start'):
+                self.load_timings()
+            # Test without timestamps in stdout have no timings
+            value = getattr(self, '_' + name)
+            if value is None:
+                raise KeyError(name)
+            return value
+        if name == 'production.log' and \
+            (self._extra is None or 'production.log' not in self._extra):
             self['production.log'] = "\n".join(
                 ["\n".join(i['data']) for i in
-                    self.data['OBJECT:production.log'].from_to(
+                    self['OBJECT:production.log'].from_to(
                         self['start'], self['end'])])
-        return self.data[name]
+        if self._extra is None:
+            raise KeyError(name)
+        return self._extra[name]
+
+    def __setitem__(self, name, value):
+        if name in self.FIELDS:
+            if name == 'testActions' and not value:
+                value = ()   # do not keep an empty list for every passed test
+            elif name in self.INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, name, value)
+        elif name == 'status' and value in self.STATUS_CODES:
+            self._status = self.STATUS_CODES[value]
+            self._pop_extra(name)
+        elif name == 'url':
+            self._url = value
+        elif name == 'OBJECT:production.log':
+            self._production_log = value
+        elif name in ('start', 'end'):
+            setattr(self, '_' + name, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+            if name == 'status':
+                self._status = None
+
+    def __delitem__(self, name):
+        if name in self.FIELDS:
+            try:
+                delattr(self, name)
+            except AttributeError:
+                raise KeyError(name)
+        elif name == 'status' and self._status is not None:
+            self._status = None
+        elif name == 'url' and (self._url is not None or self._build_url is not None):
+            self._url = self._build_url = None
+        elif name == 'OBJECT:production.log' and self._production_log is not None:
+            self._production_log = None
+        elif name in ('start', 'end') and getattr(self, '_' + name, None) is not None:
+            delattr(self, '_' + name)
+        elif self._extra is not None and name in self._extra:
+            del self._extra[name]
+        else:
+            raise KeyError(name)
+
+    def lazy_fields(self, fields=None):
+        """
+        Returns set of (given) fields which were not fetched yet
+        """
+        if self._lazy is None:
+            return set()
+        if fields is None:
+            return set(self._lazy)
+        return self._lazy.intersection(fields)
+
+    def fetch_fields(self, fields=None):
+        """
+        Fetches (given) fields which were not fetched with the report. If
+        that fails, the fields stay unset (as if the case did not have
+        them), so one case does not stop processing of the others.
+        """
+        fields = self.lazy_fields(fields)
+        if not fields:
+            return
+        logging.debug("Getting {0} of {1}".format(sorted(fields), self['url']))
+        try:
+            with metrics.span('fields_fetch', tier=self.get('tier'), distro=self.get('distro')) as span:
+                req = config.session.get(
+                    self['url'] + '/api/json',
+                    params={u'tree': ','.join(Report.tree_fields(fields))},
+                    timeout=config['timeout']
+                )
+                span.add_bytes(len(req.content))
+            if req.status_code != 200:
+                raise requests.HTTPError(
+                    'Failed to obtain: {0}'.format(req))
+            data = json.loads(req.text)
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(u"Failed to get {0} of {1}::{2}: {3}".format(
+                sorted(fields), self['className'], self['name'], e))
+            data = {}
+        self._lazy = self._lazy.difference(fields) or None
+        for name in fields:
+            if name in data:
+                self[name] = data[name]
+
+    def _pop_extra(self, name):
+        if self._extra is not None:
+            self._extra.pop(name, None)
+
+    def _build_url_for(self):
+        class_name = self.className.split('.')
+        return u'{0}/testReport/junit/{1}/{2}/{3}'.format(
+            self._build_url, '.'.join(class_name[:-1]), class_name[-1], self.name)
+
+    def __iter__(self):
+        for name in self.FIELDS:
+            if hasattr(self, name):
+                yield name
+        if self._status is not None:
+            yield 'status'
+        if self._url is not None or self._build_url is not None:
+            yield 'url'
+        if self._production_log is not None:
+            yield 'OBJECT:production.log'
+        for name in ('start', 'end'):
+            if getattr(self, '_' + name, None) is not None:
+                yield name
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, name):
+        if name in self.DERIVED_FIELDS:
+            return True
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __repr__(self):
+        return repr(dict(self.items()))
 
     def matches_to_rule(self, rule, indentation=0):
         """
         Returns True if result matches to rule, otherwise returns False
         """
-        logging.debug("%srule_matches(%s, %s, %s)" % (" "*indentation, self, rule, indentation))
+        logging.debug("%srule_matches(%s, %s, %s)", " "*indentation, self, rule, indentation)
         if 'field' in rule and 'pattern' in rule:
             # This is simple rule, we can just check regexp against given field and we are done
             try:
                 field = '' if self[rule['field']] is None else self[rule['field']]
                 out = re.search(rule['pattern'], field) is not None
-                logging.debug("%s=> %s" % (" "*indentation, out))
+                logging.debug("%s=> %s", " "*indentation, out)
                 return out
             except KeyError:
-                logging.debug("%s=> Failed to get field %s from case" % (" "*indentation, rule['field']))
+                logging.debug("%s=> Failed to get field %s from case", " "*indentation, rule['field'])
                 return None
         elif 'AND' in rule:
             # We need to check if all sub-rules in list of rules rule['AND'] matches
@@ -232,20 +829,7 @@ class Case(collections.UserDict):
         '''
         logging.info('claiming {0}::{1} with reason: {2}'.format(self["className"], self["name"], reason))
 
-        if config['headers'] is None:
-            config.init_headers()
-
-        claim_req = requests.post(
-            u'{0}/claim/claim'.format(self['url']),
-            auth=requests.auth.HTTPBasicAuth(
-                config['usr'],
-                config['pwd']
-            ),
-            data={u'json': u'{{"assignee": "", "reason": "{0}", "sticky": {1}, "propagateToFollowingBuilds": {2}}}'.format(reason, sticky, propagate)},
-            headers=config['headers'],
-            allow_redirects=False,
-            verify=False
-        )
+        claim_req = self.post_claim(reason, sticky, propagate)
 
         if claim_req.status_code != 302:
             raise requests.HTTPError(
@@ -254,125 +838,1088 @@ class Case(collections.UserDict):
         self['testActions'][0]['reason'] = reason
         return(claim_req)
 
+    def post_claim(self, reason, sticky=False, propagate=False):
+        '''Sends the claim request and returns the response. When the crumb
+        is rejected (e.g. Jenkins was restarted), new one is obtained and the
+        request is sent once more.
+        '''
+        for attempt in range(2):
+            with metrics.span('claim', tier=self.get('tier'), distro=self.get('distro')):
+                headers = config.crumb_headers()
+                claim_req = config.session.post(
+                    u'{0}/claim/claim'.format(self['url']),
+                    data={u'json': json.dumps({
+                        u'assignee': u'',
+                        u'reason': reason,
+                        u'sticky': sticky,
+                        u'propagateToFollowingBuilds': propagate,
+                    })},
+                    headers=headers,
+                    allow_redirects=False,
+                    timeout=config['timeout']
+                )
+            if claim_req.status_code != 403:
+                break
+            config.init_headers(expired=headers)
+        return claim_req
+
     def load_timings(self):
-        if self['stdout'] is None:
-            return
-        log = self['stdout'].split("\n")
-        log_size = len(log)
-        log_used = 0
-        start = None
+        """
+        Sets 'start' and 'end' to times of the first and of the last
+        timestamped line in stdout
+        """
+        self['start'], self['end'] = self.timings(self['stdout'])
+
+    @classmethod
+    def timings(cls, stdout):
+        """
+        Returns tuple with times of the first and of the last timestamped
+        line in stdout, (None, None) if there is no such line. Only looks
+        at the lines from the beginning and from the end until it finds
+        them, stdout is not split into lines.
+        """
+        if stdout is None:
+            return (None, None)
+        match = cls.LOG_DATE_REGEXP.search(stdout)
+        if not match:
+            return (None, None)
+        start = cls.parse_log_date(match.group(1))
+        first = match.start()
         end = None
-        counter = 0
-        while start is None:
-            match = self.LOG_DATE_REGEXP.match(log[counter])
-            if match:
-                start = datetime.datetime.strptime(match.group(1),
-                    self.LOG_DATE_FORMAT)
-                break
-            counter += 1
-        log_used += counter
-        counter = -1
+        line_end = len(stdout)
         while end is None:
-            match = self.LOG_DATE_REGEXP.match(log[counter])
+            line_start = stdout.rfind('\n', first, line_end) + 1
+            if line_start <= first:
+                line_start = first
+            match = cls.LOG_DATE_REGEXP.match(stdout, line_start)
             if match:
-                end = datetime.datetime.strptime(match.group(1),
-                    self.LOG_DATE_FORMAT)
-                break
-            counter -= 1
-        log_used -= counter
-        assert log_used <= log_size, \
-            "Make sure detected start date is not below end date and vice versa"
-        self['start'] = start
-        self['end'] = end
+                end = cls.parse_log_date(match.group(1))
+            line_end = line_start - 1
+        return (start, end)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def parse_log_date(value):
+        """
+        Fast parser of LOG_DATE_FORMAT (same second repeats a lot)
+        """
+        return datetime.datetime(int(value[0:4]), int(value[5:7]),
+            int(value[8:10]), int(value[11:13]), int(value[14:16]),
+            int(value[17:19]))
 
 
 class Report(collections.UserList):
     """
-    Report is a list of Cases (i.e. test results)
+    Report is a list of Cases (i.e. test results) of jobs for tiers x RHELs.
+    Jobs are fetched lazily: iterating the report fetches one job after
+    another (when it is reached) and yields its cases as they arrive,
+    anything else (len, indexing, ...) fetches all the remaining jobs.
     """
 
-    TIERS = [1, 2, 3, 4]
-    RHELS = [6, 7]
+    FIELDS = ('className', 'duration', 'name', 'status', 'stdout',
+        'errorDetails', 'errorStackTrace', 'testActions')   # in the test report
+    BASE_FIELDS = ('className', 'name', 'status', 'testActions')   # always fetched
+    CACHE_BATCH = 1000   # reports pickled together
 
-    def __init__(self):
-        # Initialize production.log instance
+    def __init__(self, build=None, fields=None, tiers=None, rhels=None, state=None,
+            history=None):
+        """
+        Report of given build (number or alias) of the jobs, 'bld' from
+        config by default. Only jobs of given tiers and RHELs are loaded
+        ('tiers' and 'rhels' from config by default). Only given 'fields'
+        of the cases are fetched (all of them by default, see
+        fields_for()), the others are fetched per case when needed.
+        Completed builds recorded in BuildState 'state' are skipped.
+        Completed builds are stored to 'history' (history.History) as
+        they are loaded.
+        """
+        self.build = config['bld'] if build is None else build
+        self.fields = None if fields is None else set(fields).union(self.BASE_FIELDS)
+        self.tiers = list(config['tiers'] if tiers is None else tiers)
+        self.rhels = list(config['rhels'] if rhels is None else rhels)
+        self.state = state
+        self.history = history
+        self.builds = {}   # numbers of completed builds loaded per job
         self.production_logs = {}
-        for tier in self.TIERS:
+        for tier in self.tiers:
             self.production_logs[tier] = {}
-            for rhel in self.RHELS:
-                self.production_logs[tier][rhel] = ProductionLog(tier, rhel)
-        # If cache is configured, load data from it
-        if config['cache']:
-            if os.path.isfile(config['cache']):
-                logging.debug("Because cache is set to '{0}', loading data from there".format(
-                    config['cache']))
-                self.data = pickle.load(open(config['cache'], 'rb'))
-                return
-            else:
-                logging.debug("Cache set to '{0}' but that file does not exist, creating one".format(
-                    config['cache']))
 
-        self.data = []
-        for i in self.TIERS:
-            for j in self.RHELS:
-                for report in self.pull_reports(
-                                config['job'].format(i, j),
-                                config['bld']):
-                    report['tier'] = 't{}'.format(i)
-                    report['distro'] = 'el{}'.format(j)
-                    report['OBJECT:production.log'] = self.production_logs[i][j]
-                    self.data.append(Case(report))
+        self._loaded = []
+        self._jobs = collections.deque(
+            (i, j) for i in self.tiers for j in self.rhels)
+        self._current = None   # cases of the job being iterated
+
+    @property
+    def data(self):
+        if self._current is not None or self._jobs:
+            self.load()
+        return self._loaded
+
+    @data.setter
+    def data(self, value):
+        self._loaded = value
+        self._jobs.clear()
+        self._current = None
+
+    def load(self):
+        """
+        Loads all the remaining jobs. Reports are fetched by pool of
+        workers (configured by 'fetch_workers'), but map() returns them in
+        order of jobs, so list of cases is ordered the same way as when
+        iterating. Returns the report.
+        """
+        if self._current is not None:
+            self._loaded.extend(self._current)
+            self._current = None
+        jobs = list(self._jobs)
+        self._jobs.clear()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=config['fetch_workers']) as executor:
+            for cases in executor.map(
+                    lambda job: list(self.iter_cases(
+                        job[0], job[1], self.build, self.fields)),
+                    jobs):
+                self._loaded.extend(cases)
+        return self
+
+    def _load_next(self):
+        """
+        Loads one more case, returns False if there is none
+        """
+        while True:
+            if self._current is None:
+                if not self._jobs:
+                    return False
+                tier, rhel = self._jobs.popleft()
+                self._current = self.iter_cases(tier, rhel, self.build, self.fields)
+            case = next(self._current, None)
+            if case is not None:
+                self._loaded.append(case)
+                return True
+            self._current = None
+
+    def __iter__(self):
+        position = 0
+        while position < len(self._loaded) or self._load_next():
+            yield self._loaded[position]
+            position += 1
+
+    def iter_cases(self, tier, rhel, build, fields=None):
+        """
+        Yields Cases of given build of tier x RHEL job one by one, as they
+        are parsed from the test report (or loaded from cache)
+        """
+        job = config['job'].format(tier, rhel)
+        build, building = self.resolve_job(job, build)
+        if build is None:
+            return
+        if self.state is not None and not building \
+                and not self.state.changed(job, build):
+            logging.info("Skipping {0} build {1}, it did not change since last run".format(
+                job, build))
+            return
+        fields, reports = self.load_build(job, build, building, fields)
+        cases = []
+        for case in self.make_cases(tier, rhel, build, fields, reports):
+            if self.history is not None:
+                cases.append(case)
+            yield case
+        # All the cases of completed build were seen
+        if not building:
+            self.builds[job] = build
+            if self.history is not None:
+                self.history.ingest_build(job, build, cases)
+
+    def make_cases(self, tier, rhel, build, fields, reports):
+        """
+        Yields Cases of given build of tier x RHEL job made of its test
+        reports with given fields (the others are fetched lazily)
+        """
+        job = config['job'].format(tier, rhel)
+        # Initialize production.log instance
+        production_log = self.production_logs[tier][rhel] = ProductionLog(job, build)
+        build_url = '{0}/job/{1}/{2}'.format(config['url'], job, build)
+        lazy = frozenset(self.FIELDS).difference(fields)
+        for report in reports:
+            case = Case(report, build_url, lazy)
+            case['tier'] = 't{}'.format(tier)
+            case['distro'] = 'el{}'.format(rhel)
+            case['OBJECT:production.log'] = production_log
+            yield case
+
+    @classmethod
+    def fields_for(cls, rules=None, timings=False):
+        """
+        Returns fields of the cases needed to match given rules and to get
+        start and end of all the tests if 'timings' is True. Rules are only
+        matched against failures, so stdout they need (directly or for
+        timings and production.log) is fetched for them lazily.
+        """
+        fields = set(cls.BASE_FIELDS)
+        if rules is not None:
+            if not isinstance(rules, Ruleset):
+                rules = Ruleset(rules)
+            fields.update(i for i in rules.fields
+                if i in cls.FIELDS and i != 'stdout')
+        if timings:
+            fields.add('stdout')
+        return [i for i in cls.FIELDS if i in fields]
+
+    @staticmethod
+    def tree_fields(fields):
+        """
+        Returns given fields of a case as used in the 'tree' query
+        """
+        return [u'testActions[reason]' if i == 'testActions' else i
+            for i in Report.FIELDS if i in fields]
+
+    @staticmethod
+    def resolve_job(job, build):
+        """
+        Returns tuple (build number, building) for a given job and build
+        (alias), (None, None) if there is no such build. Builds already in
+        the cache are not looked up in Jenkins.
+        """
+        if str(build).isdigit():
+            cache = config.cache_path(job, build, '.pickle')
+            if cache and os.path.isfile(cache):
+                return (int(build), False)
+        return config.resolve_build(job, build)
+
+    def load_build(self, job, build, building, fields=None):
+        """
+        Returns tuple (fetched fields, iterator of test reports) for
+        a given job and build number. Reports of completed builds are
+        cached per job and build number if cache is configured, so only
+        new builds (or builds cached without some of the fields) are
+        fetched. Reports are streamed from Jenkins and to and from the
+        cache one by one. Claims are always fetched from Jenkins.
+        """
+        if fields is None:
+            fields = self.FIELDS
+        cache = config.cache_path(job, build, '.pickle')
+        if cache and os.path.isfile(cache):
+            cached_fields = self.cached_fields(cache)
+            if set(fields).issubset(cached_fields):
+                logging.debug("Loading {0} build {1} from cache '{2}'".format(
+                    job, build, cache))
+                return (cached_fields, self.with_claims(job, build, metrics.timed_iter(
+                    self.load_cache(cache), 'report_cache', **config.job_labels(job, build))))
+            # Fetch fields cached already once more, to keep them cached
+            fields = set(fields).union(cached_fields)
+            building = False
+
+        fields = [i for i in self.FIELDS if i in fields]
+        reports = self.with_timings(self.pull_reports(job, build, fields))
+
+        # Build which is still running can get more results later
+        if cache and not building:
+            reports = self.save_cache(cache, fields, reports)
+        return (fields, reports)
+
+    @staticmethod
+    def with_timings(reports):
+        """
+        Computes timings once, so they are cached together with reports
+        """
+        for report in reports:
+            if 'stdout' in report and 'start' not in report:
+                report['start'], report['end'] = Case.timings(report['stdout'])
+            yield report
+
+    @classmethod
+    def with_claims(cls, job, build, reports):
+        """
+        Yields cached reports with current claims ('testActions') fetched
+        from Jenkins. Claims of completed builds still change (by us and
+        by people), so they are not cached.
+        """
+        current = cls.pull_reports(job, build, ['className', 'name', 'testActions'])
+        pending = {}   # claims fetched ahead of their cached report
+        for report in reports:
+            key = (report['className'], report['name'])
+            actions = pending.pop(key, None)
+            while actions is None:
+                item = next(current, None)
+                if item is None:
+                    break
+                if (item['className'], item['name']) == key:
+                    actions = item.get('testActions')
+                    break
+                pending[(item['className'], item['name'])] = item.get('testActions')
+            if actions is None:
+                logging.warning("No claims of {0}::{1} in {2} build {3}".format(
+                    key[0], key[1], job, build))
+                actions = [{'reason': None}] if report['status'] in Case.FAIL_STATUSES else []
+            report['testActions'] = actions
+            yield report
 
-        if config['cache']:
-            pickle.dump(self.data, open(config['cache'], 'wb'))
+    @staticmethod
+    def cached_fields(cache):
+        """
+        Returns fields of the reports stored in the cache file. Cache is
+        a header {'fields': [...]} followed by pickled lists of reports.
+        Older caches are one pickled list of reports with all the fields
+        or a dict with 'fields' and 'reports'.
+        """
+        with open(cache, 'rb') as fp:
+            header = pickle.load(fp)
+        return Report.FIELDS if isinstance(header, list) else header['fields']
 
-    def pull_reports(self, job, build):
+    @staticmethod
+    def load_cache(cache):
         """
-        Fetches the test report for a given job and build
+        Yields reports stored in the cache file
+        """
+        with open(cache, 'rb') as fp:
+            header = pickle.load(fp)
+            if isinstance(header, list):
+                yield from header
+                return
+            if 'reports' in header:
+                yield from header['reports']
+                return
+            while True:
+                try:
+                    yield from pickle.load(fp)
+                except EOFError:
+                    return
+
+    @staticmethod
+    def save_cache(cache, fields, reports):
+        """
+        Yields given reports while storing them to the cache file, the
+        file is replaced only when all of them are stored. Claims are not
+        stored, see with_claims().
+        """
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(cache + '.tmp', 'wb') as fp:
+            pickle.dump({'fields': list(fields)}, fp)
+            batch = []
+            for report in reports:
+                batch.append({k: v for k, v in report.items() if k != 'testActions'})
+                if len(batch) == Report.CACHE_BATCH:
+                    pickle.dump(batch, fp)
+                    batch = []
+                yield report
+            if batch:
+                pickle.dump(batch, fp)
+        logging.debug("Cached reports to '{0}'".format(cache))
+        os.replace(cache + '.tmp', cache)
+
+    @classmethod
+    def pull_reports(cls, job, build, fields=None, suites=None, cases=None,
+            sizes=None):
+        """
+        Fetches the test report (given fields of the cases, all by
+        default) for a given job and build and yields cases of all its
+        suites one by one as they are downloaded and parsed, so whole
+        report is never in memory. Only given range of 'suites' and of
+        'cases' of each of them is fetched if given, in Jenkins' tree
+        syntax ('{M,N}' from M-th to N-th exclusive, '{M,}' from M-th on).
+        Number of cases fetched from every suite is appended to 'sizes'.
         """
         build_url = '{0}/job/{1}/{2}'.format(
             config['url'], job, build)
+        params = config['pull_params']
+        if fields is not None or suites or cases:
+            params = {u'tree': u'suites[cases[{0}]{1}]{2}'.format(
+                ','.join(cls.tree_fields(fields or cls.FIELDS)),
+                cases or '', suites or '')}
 
         logging.debug("Getting {}".format(build_url))
-        bld_req = requests.get(
-            build_url + '/testReport/api/json',
-            auth=requests.auth.HTTPBasicAuth(
-                config['usr'], config['pwd']),
-            params=config['pull_params'],
-            verify=False
-        )
+        labels = config.job_labels(job, build)
+        with metrics.span('report_request', **labels):
+            bld_req = config.session.get(
+                build_url + '/testReport/api/json',
+                params=params,
+                timeout=config['timeout'],
+                stream=True
+            )
 
-        if bld_req.status_code == 404:
-            return []
-        if bld_req.status_code != 200:
-            raise requests.HTTPError(
-                'Failed to obtain: {0}'.format(bld_req))
+        with bld_req:
+            if bld_req.status_code == 404:
+                return
+            if bld_req.status_code != 200:
+                raise requests.HTTPError(
+                    'Failed to obtain: {0}'.format(bld_req))
+
+            # URLs of individual reports are built by Case from build URL.
+            # Self time of 'report_decode' is parsing, without the download
+            yield from metrics.timed_iter(iter_json_cases(metrics.timed_iter(
+                bld_req.iter_content(config['download_chunk_size']),
+                'report_download', **labels), sizes), 'report_decode', **labels)
+
+
+def backtracking_risks(pattern):
+    """
+    Returns list of reasons why searching for the pattern may take
+    exponential time (nested unbounded quantifiers, quantified
+    alternation of branches which can start with the same character),
+    empty list if none were found
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return []
+    out = []
+
+    def first(items):
+        # Literal the items start with, None if it could be anything
+        if items and items[0][0] == sre_constants.LITERAL:
+            return items[0][1]
+        return None
+
+    def walk(items, repeated):
+        for op, av in items:
+            if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                unbounded = av[1] == sre_constants.MAXREPEAT
+                if repeated and unbounded:
+                    out.append('nested quantifier')
+                walk(av[2], repeated or unbounded)
+            elif op == sre_constants.SUBPATTERN:
+                walk(av[-1], repeated)
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                walk(av[1], repeated)
+            elif op == sre_constants.BRANCH:
+                starts = [first(list(i)) for i in av[1]]
+                if repeated and (None in starts or len(set(starts)) < len(starts)):
+                    out.append('quantified alternation of overlapping branches')
+                for branch in av[1]:
+                    walk(branch, repeated)
+
+    walk(parsed, False)
+    return sorted(set(out))
+
+
+def _search_worker(conn):
+    regexps = {}
+    while True:
+        try:
+            pattern, text = conn.recv()
+        except EOFError:
+            return
+        if pattern not in regexps:
+            regexps[pattern] = re.compile(pattern)
+        conn.send(regexps[pattern].search(text) is not None)
+
+
+class RegexGuard(object):
+    """
+    Searches for regexps in a worker process, which is killed (and
+    started again for next search) when a search takes longer than
+    'budget' seconds, including sending the text there
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.timeouts = 0
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+
+    def search(self, regexp, text):
+        """
+        Returns True if regexp was found in text, False if not and None
+        if the search took too long
+        """
+        with self._lock:
+            if self._process is None:
+                self._conn, child = multiprocessing.Pipe()
+                self._process = multiprocessing.Process(
+                    target=_search_worker, args=(child,), daemon=True)
+                self._process.start()
+                child.close()
+            self._conn.send((regexp.pattern, text))
+            if self._conn.poll(self.budget):
+                return self._conn.recv()
+            self.close()
+            self.timeouts += 1
+            return None
+
+    def close(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+            self._process = None
 
-        cases = json.loads(bld_req.text)['suites'][0]['cases']
 
-        # Enrich individual reports with URL
-        for c in cases:
-            className = c['className'].split('.')[-1]
-            testPath = '.'.join(c['className'].split('.')[:-1])
-            c['url'] = u'{0}/testReport/junit/{1}/{2}/{3}'.format(build_url, testPath, className, c['name'])
+class FieldMatcher(object):
+    """
+    Compiled simple rule: regexp to be searched for in a field of a case.
+    If 'guard' is set, search runs there and evaluation which did not fit
+    into its time budget is not a match (same as a missing field).
+    """
+
+    def __init__(self, field, pattern):
+        self.field = field
+        self.regexp = re.compile(pattern)
+        self.guard = None
+
+    def match(self, case):
+        try:
+            field = case[self.field]
+        except KeyError:
+            return None
+        if field is None:
+            field = ''
+        if self.guard is None:
+            return self.regexp.search(field) is not None
+        out = self.guard.search(self.regexp, field)
+        if out is None:
+            logging.warning("Search for %r in %s of %s::%s took more than %s s, not a match" \
+                % (self.regexp.pattern, self.field, case.get('className'), case.get('name'),
+                    self.guard.budget))
+        return out
+
 
-        return(cases)
+class AndMatcher(object):
+    """
+    Compiled AND rule: returns first result which is not true (False or
+    None when field is missing), True if all sub-rules matches
+    """
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+
+    def match(self, case):
+        for matcher in self.matchers:
+            out = matcher.match(case)
+            if not out:
+                return out
+        return True if self.matchers else None
+
+
+class OrMatcher(object):
+    """
+    Compiled OR rule: True if at least one of sub-rules matches
+    """
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+
+    def match(self, case):
+        for matcher in self.matchers:
+            if matcher.match(case):
+                return True
+        return False
 
 
 class Ruleset(collections.UserList):
+    """
+    List of rules from kb.json. Rules are compiled on first use, so we
+    do not walk rule dicts and compile regexps for every case. Patterns
+    which may backtrack catastrophically are searched under RegexGuard if
+    'budget' ('rule_time_budget' by default) is set.
+    """
 
-    def __init__(self):
-        with open('kb.json', 'r') as fp:
-            self.data = json.loads(fp.read())
+    def __init__(self, data=None, budget=None):
+        if data is None:
+            with open('kb.json', 'r') as fp:
+                data = json.loads(fp.read())
+        self.data = data
+        self.budget = config['rule_time_budget'] if budget is None else budget
+        self.profile = None   # RuleProfile, see enable_profile()
+        self._guard = None
+        self._matchers = None
+        self._fields = None
+        self._version = None
+
+    @classmethod
+    def compile(cls, rule):
+        """
+        Returns matcher for given rule. Nested AND in AND and OR in OR
+        rules are flattened.
+        """
+        if 'field' in rule and 'pattern' in rule:
+            return FieldMatcher(rule['field'], rule['pattern'])
+        elif 'AND' in rule or 'OR' in rule:
+            kind = AndMatcher if 'AND' in rule else OrMatcher
+            matchers = []
+            for r in rule['AND' if 'AND' in rule else 'OR']:
+                matcher = cls.compile(r)
+                # Empty AND is not true, so it can not be flattened
+                if isinstance(matcher, kind) and matcher.matchers:
+                    matchers += matcher.matchers
+                else:
+                    matchers.append(matcher)
+            return kind(matchers)
+        else:
+            raise Exception('Rule %s not formatted correctly' % rule)
+
+    @property
+    def matchers(self):
+        if self._matchers is None:
+            matchers = [self.compile(rule) for rule in self.data]
+            guard = self._guard = RegexGuard(self.budget) if self.budget else None
+            for matcher in self.field_matchers(matchers):
+                risks = backtracking_risks(matcher.regexp.pattern)
+                if risks:
+                    logging.warning("Pattern %r may backtrack catastrophically (%s)%s" \
+                        % (matcher.regexp.pattern, ', '.join(risks),
+                            ', searching for it with time budget' if guard else ''))
+                    matcher.guard = guard
+            self._matchers = matchers
+        return self._matchers
+
+    @staticmethod
+    def field_matchers(matchers):
+        """
+        Yields all the FieldMatchers in given matchers and their sub-rules
+        """
+        matchers = list(matchers)
+        while matchers:
+            matcher = matchers.pop()
+            if isinstance(matcher, FieldMatcher):
+                yield matcher
+            else:
+                matchers += matcher.matchers
+
+    @property
+    def timeouts(self):
+        """
+        Number of searches which did not fit into the time budget so far
+        """
+        self.matchers   # guard is created with them
+        return 0 if self._guard is None else self._guard.timeouts
+
+    def enable_profile(self):
+        """
+        Starts recording evaluations of the rules into RuleProfile, returns it
+        """
+        if self.profile is None:
+            self.profile = RuleProfile(self)
+        return self.profile
+
+    @property
+    def fields(self):
+        """
+        Sorted list of case fields rules are reading
+        """
+        if self._fields is None:
+            self._fields = sorted({i.field for i in self.field_matchers(self.matchers)})
+        return self._fields
+
+    @property
+    def version(self):
+        """
+        Hash of the rules, changes whenever kb.json changes
+        """
+        if self._version is None:
+            self._version = hashlib.sha1(
+                json.dumps(self.data, sort_keys=True).encode('utf-8')).hexdigest()
+        return self._version
+
+    def position(self, case, stop=None):
+        """
+        Returns index of the first rule case matches to or -1. Only the
+        rules before index 'stop' are tried if it is given.
+        """
+        matchers = self.matchers if self.profile is None else self.profile.matchers
+        for position, matcher in enumerate(matchers[:stop]):
+            if matcher.match(case):
+                return position
+        return -1
+
+    def match(self, case, cache=None):
+        """
+        Returns first rule case matches to or None. If MatchCache is
+        given, result is looked up there first.
+        """
+        if cache is not None:
+            position = cache.position(self, case)
+        else:
+            position = self.position(case)
+        return self.data[position] if position >= 0 else None
+
+
+class ProfiledMatcher(object):
+    """
+    Matcher recording its evaluations into given RuleProfile stats
+    """
+
+    def __init__(self, matcher, stats):
+        self.matcher = matcher
+        self.stats = stats
+
+    def match(self, case):
+        start = time.perf_counter()
+        out = self.matcher.match(case)
+        duration = time.perf_counter() - start
+        stats = self.stats
+        stats[2] += 1
+        if out:
+            stats[3] += 1
+        stats[4] += duration
+        if duration > stats[5]:
+            stats[5] = duration
+            stats[6] = "%s::%s" % (case.get('className'), case.get('name'))
+        return out
+
+
+class RuleProfile(object):
+    """
+    Evaluation count, hit count, cumulative time and the slowest case of
+    every rule and sub-rule of a Ruleset. Sub-rules are named by their
+    position in the compiled rule (nested AND in AND and OR in OR are
+    flattened), e.g. '12/0/1' is second sub-rule of the first sub-rule
+    of the 13th rule. Not thread safe, rules are matched in one thread.
+    """
+
+    COLUMNS = ('rule', 'matcher', 'evaluations', 'hits', 'seconds', 'slowest', 'slowest case')
+
+    def __init__(self, ruleset):
+        self.stats = collections.OrderedDict()   # rule: [COLUMNS...]
+        self.matchers = [self._wrap(m, str(i)) for i, m in enumerate(ruleset.matchers)]
+
+    def _wrap(self, matcher, path):
+        stats = self.stats[path] = [path, None, 0, 0, 0.0, 0.0, None]
+        if isinstance(matcher, FieldMatcher):
+            stats[1] = '%s =~ %s' % (matcher.field, matcher.regexp.pattern)
+        else:
+            stats[1] = '%s of %s' % ('AND' if isinstance(matcher, AndMatcher) else 'OR',
+                len(matcher.matchers))
+            matcher = type(matcher)([self._wrap(m, '%s/%s' % (path, i))
+                for i, m in enumerate(matcher.matchers)])
+        return ProfiledMatcher(matcher, stats)
+
+    def rows(self, top=None):
+        """
+        Returns list of [COLUMNS...] of the rules (just 'top' ones by
+        time if given)
+        """
+        out = [list(i) for i in self.stats.values()]
+        if top is not None:
+            out = sorted(out, key=lambda i: i[4], reverse=True)[:top]
+        return out
+
+    def save(self, filename):
+        """
+        Writes the profile as CSV or JSON (if filename ends with .json)
+        """
+        with open(filename + '.tmp', 'w', newline='') as fp:
+            if filename.endswith('.json'):
+                json.dump([dict(zip(self.COLUMNS, i)) for i in self.rows()], fp, indent=2)
+            else:
+                writer = csv.writer(fp)
+                writer.writerow(self.COLUMNS)
+                writer.writerows(self.rows())
+        os.replace(filename + '.tmp', filename)
+
+
+class MatchCache(object):
+    """
+    Persistent cache of rule matching results. Key is a fingerprint of the
+    case fields the rules are reading together with version of the
+    ruleset, so same failure is matched only once across distros, tiers
+    and builds. Least recently used results are evicted when there is
+    more than 'size' of them.
+    """
+
+    def __init__(self, filename=None, size=100000):
+        self.filename = filename
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+        self._data = collections.OrderedDict()
+        if filename and os.path.isfile(filename):
+            with open(filename, 'rb') as fp:
+                self._data = pickle.load(fp)
+            logging.debug("Loaded %s rule match results from %s" % (len(self._data), filename))
+
+    @classmethod
+    def from_config(cls):
+        """
+        Returns cache stored in 'match_cache' file, or in cache directory
+        if that is not set, or in memory only if there is no cache at all
+        """
+        filename = config['match_cache']
+        if filename is None and config['cache']:
+            filename = os.path.join(config['cache'], 'match-cache.pickle')
+        return cls(filename, config['match_cache_size'])
+
+    def fingerprint(self, ruleset, case):
+        out = hashlib.sha1(ruleset.version.encode('ascii'))
+        for field in ruleset.fields:
+            try:
+                value = case[field]
+            except KeyError:
+                out.update(b'\x00missing')
+                continue
+            if value is None:
+                out.update(b'\x00none')
+                continue
+            value = str(value).encode('utf-8')
+            out.update(b'\x00%d:' % len(value))
+            out.update(value)
+        return out.digest()
+
+    def position(self, ruleset, case, stop=None):
+        """
+        Returns index of the first rule case matches to or -1, same as
+        Ruleset.position() does (with 'stop' as well)
+        """
+        # Derived fields differ per build, so there is nothing to reuse
+        if any(i in Case.DERIVED_FIELDS for i in ruleset.fields):
+            self.uncached += 1
+            return ruleset.position(case, stop)
+        key = self.fingerprint(ruleset, case)
+        try:
+            position = self._data[key]
+            self._data.move_to_end(key)
+            self.hits += 1
+            if stop is not None and position >= stop:
+                position = -1
+        except KeyError:
+            timeouts = ruleset.timeouts
+            position = ruleset.position(case, stop)
+            self.misses += 1
+            # Result of a search cut off by the time budget or by 'stop'
+            # (when no rule matched) is not final
+            if ruleset.timeouts != timeouts or (stop is not None and position < 0):
+                return position
+            self._data[key] = position
+            if len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return position
+
+    def save(self):
+        if not self.filename:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename + '.tmp', 'wb') as fp:
+            pickle.dump(self._data, fp)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def __str__(self):
+        return "%s hits, %s misses, %s evictions, %s not cacheable (%s results cached)" \
+            % (self.hits, self.misses, self.evictions, self.uncached, len(self._data))
+
+
+class BuildState(object):
+    """
+    Numbers of the builds of the jobs processed by the previous run, so
+    script run repeatedly (e.g. from cron) can skip jobs without a new
+    build. State is kept for one 'version' (e.g. of the ruleset), all the
+    jobs are processed again when it changes.
+    """
+
+    def __init__(self, filename=None, version=None):
+        self.filename = filename
+        self.version = version
+        self.builds = {}
+        if filename and os.path.isfile(filename):
+            with open(filename) as fp:
+                state = json.load(fp)
+            if state.get('version') == version:
+                self.builds = state['builds']
+            else:
+                logging.debug("State in %s is for other version, ignoring it" % filename)
+
+    @classmethod
+    def from_config(cls, version=None):
+        """
+        Returns state stored in 'state' file, None if that is not set
+        """
+        if not config['state']:
+            return None
+        return cls(config['state'], version)
+
+    def changed(self, job, build):
+        return self.builds.get(job) != build
+
+    def update(self, builds, results=()):
+        """
+        Records build numbers of the jobs ({job: build}), e.g. builds of
+        a Report which was processed. Jobs with a failed claim in 'results'
+        (ClaimResults) are not recorded, so next run processes them again.
+        """
+        failed = {config['job'].format(i.case['tier'][1:], i.case['distro'][2:])
+            for i in results if not i.ok}
+        self.builds.update((job, build) for job, build in builds.items() if job not in failed)
+
+    def save(self):
+        if not self.filename:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename + '.tmp', 'w') as fp:
+            json.dump({'version': self.version, 'builds': self.builds}, fp,
+                indent=2, sort_keys=True)
+        os.replace(self.filename + '.tmp', self.filename)
 
 
 # Create shared config file
 config = Config()
+if config['metrics']:
+    metrics.enable(config['metrics'])
+
+ClaimResult = collections.namedtuple('ClaimResult',
+    ['case', 'reason', 'ok', 'status', 'error'])
+
+
+class RateLimiter(object):
+    """
+    Lets at most 'rate' callers per second through wait() (no limit if
+    rate is not set)
+    """
+
+    def __init__(self, rate=None):
+        self._interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            when = max(now, self._next)
+            self._next = when + self._interval
+        if when > now:
+            time.sleep(when - now)
+
+
+def retry_claim(case, reason, sticky=False, propagate=False, limiter=None):
+    """
+    Claims the case, waiting for RateLimiter 'limiter' before every
+    request. Failed requests are retried 'claim_retries' times with
+    exponential backoff. Does not raise on failed claim, returns
+    ClaimResult instead.
+    """
+    logging.info('claiming {0}::{1} with reason: {2}'.format(case["className"], case["name"], reason))
+    status = None
+    for attempt in range(config['claim_retries'] + 1):
+        if attempt:
+            time.sleep(config['claim_backoff'] * 2 ** (attempt - 1))
+        if limiter is not None:
+            limiter.wait()
+        try:
+            claim_req = case.post_claim(reason, sticky, propagate)
+        except requests.RequestException as e:
+            status, error = None, str(e)
+            continue
+        status = claim_req.status_code
+        if status == 302:
+            case['testActions'][0]['reason'] = reason
+            metrics.count('claims', ok='true', retried=str(attempt > 0).lower())
+            return ClaimResult(case, reason, True, status, None)
+        error = 'Failed to claim: {0}'.format(claim_req)
+        # Client errors will not go away by retrying
+        if status < 500 and status != 429:
+            break
+    logging.warning(u"Failed to claim {0}::{1}: {2}".format(case['className'], case['name'], error))
+    metrics.count('claims', ok='false', retried=str(attempt > 0).lower())
+    return ClaimResult(case, reason, False, status, error)
+
+
+def push_claims(to_claim, sticky=False, propagate=False):
+    """
+    Claims list of (case, reason) tuples by pool of 'claim_workers' sharing
+    one session, at most 'claim_rate' claims per second (see
+    retry_claim()). Returns list of ClaimResult in order of to_claim.
+    """
+    limiter = RateLimiter(config['claim_rate'])
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=config['claim_workers']) as executor:
+        return list(executor.map(
+            lambda item: retry_claim(item[0], item[1], sticky, propagate, limiter),
+            to_claim))
+
+
+def prefetch_fields(cases, fields):
+    """
+    Fetches given fields of the cases which were not fetched with the
+    report, by pool of 'fetch_workers'. Cases whose fields could not be
+    fetched are left without them (see Case.fetch_fields).
+    """
+    lazy = [i for i in cases if isinstance(i, Case) and i.lazy_fields(fields)]
+    if lazy:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=config['fetch_workers']) as executor:
+            list(executor.map(lambda case: case.fetch_fields(fields), lazy))
+
+
+def claim_by_rules(report, rules, dryrun=False, cache=None, clusters=None):
+    """
+    Claims unclaimed failures from the report by the first rule they
+    match. With 'clusters' ('cluster_failures' by default) failures with
+    the same normalized error (see cluster.py) are matched against all the
+    rules once, the others only against the rules up to the one the first
+    failure matched. Failures matching none of those (e.g. differing in a
+    number the rule reads) and failures of clusters matching no rule are
+    matched against all the rules one by one. If
+    'rule_profile' is set, evaluations of the rules are profiled (see
+    Ruleset.enable_profile) and the profile is saved there.
+    """
+    if not isinstance(rules, Ruleset):
+        rules = Ruleset(rules)
+    if config['rule_profile']:
+        rules.enable_profile()
+    if cache is None:
+        cache = MatchCache.from_config()
+    if clusters is None:
+        clusters = config['cluster_failures']
+    to_claim = []
+    failures = [i for i in report if i['status'] in Case.FAIL_STATUSES and not i['testActions'][0].get('reason')]
+    # Fields the rules read which were not fetched with the report are
+    # fetched for the failures up front
+    fields = set(rules.fields)
+    if fields.intersection(Case.DERIVED_FIELDS):
+        fields.add('stdout')
+        # Derived fields differ per build, nothing to share in a cluster
+        clusters = False
+    prefetch_fields(failures, fields)
+    if 'production.log' in fields:
+        ProductionLog.load_all({id(i): i['OBJECT:production.log'] for i in failures
+            if 'OBJECT:production.log' in i}.values())
+    if clusters:
+        import cluster
+        groups = [i.cases for i in cluster.clusters(failures,
+            [i for i in rules.fields if i in cluster.ERROR_FIELDS],
+            [i for i in rules.fields if i not in cluster.ERROR_FIELDS])]
+        logging.info("Matching {0} failures in {1} clusters".format(len(failures), len(groups)))
+    else:
+        groups = [[i] for i in failures]
+    def matched(case, position):
+        reason = rules[position]['reason']
+        logging.info(u"{0}::{1} matching pattern for '{2}' on {3}".format(case['className'], case['name'], reason, case['url']))
+        to_claim.append((case, reason))
 
-def claim_by_rules(report, rules, dryrun=False):
-    for rule in rules:
-        for case in [i for i in report if i['status'] in Case.FAIL_STATUSES and not i['testActions'][0].get('reason')]:
-            if case.matches_to_rule(rule):
-                logging.info(u"{0}::{1} matching pattern for '{2}' on {3}".format(case['className'], case['name'], rule['reason'], case['url']))
-                if not dryrun:
-                    case.push_claim(rule['reason'])
+    with metrics.span('match'):
+        unmatched = []
+        for group in groups:
+            position = cache.position(rules, group[0])
+            if position < 0:
+                unmatched += group[1:]
+                continue
+            matched(group[0], position)
+            for case in group[1:]:
+                # Rules before the one the first failure matched may
+                # still match the others, so they are tried as well
+                first = cache.position(rules, case, position + 1)
+                if first >= 0:
+                    matched(case, first)
+                else:
+                    unmatched.append(case)
+        for case in unmatched:
+            position = cache.position(rules, case)
+            if position >= 0:
+                matched(case, position)
+    metrics.count('failures', len(failures))
+    metrics.count('matched', len(to_claim))
+    cache.save()
+    logging.info("Rule match cache: %s" % cache)
+    if config['rule_profile']:
+        rules.profile.save(config['rule_profile'])
+        for row in rules.profile.rows(top=5):
+            logging.info("Rule {0} ({1}): {2} evaluations, {3} hits, {4:.3f} s, slowest {5:.3f} s on {6}".format(*row))
+    if dryrun:
+        return []
+    results = push_claims(to_claim)
+    logging.info("Claimed {0} of {1} matching failures".format(
+        len([i for i in results if i.ok]), len(results)))
+    return results
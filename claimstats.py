@@ -1,66 +1,81 @@
 #!/usr/bin/env python3
 
+import argparse
 import claims
+import aggregation
+import history
 import tabulate
 
-reports = claims.Report()
 
-stat_all = len(reports)
-reports_fails = [i for i in reports if i['status'] in claims.Case.FAIL_STATUSES]
-stat_failed = len(reports_fails)
-reports_claimed = [i for i in reports_fails if i['testActions'][0].get('reason')]
-stat_claimed = len(reports_claimed)
+def stored_or_fetched(store):
+    """
+    Yields results of the builds ('bld' from config) of all the jobs from
+    the history store, only builds which are not stored are fetched
+    """
+    for tier in claims.config['tiers']:
+        for rhel in claims.config['rhels']:
+            job = claims.config['job'].format(tier, rhel)
+            number, building = claims.Report.resolve_job(job, claims.config['bld'])
+            if number is not None and not building and number in store.numbers(job):
+                yield from store.cases(job, number)
+            else:
+                yield from claims.Report(fields=claims.Report.fields_for(),
+                    tiers=[tier], rhels=[rhel], history=store)
 
-print("\nOverall stats")
-print(tabulate.tabulate(
-    [[stat_all, stat_failed, stat_claimed]],
-    headers=['all reports', 'failures', 'claimed failures']))
 
-rules = claims.Ruleset()
-rules_reasons = [r['reason'] for r in rules]
-reports_per_reason = {'UNKNOWN': stat_failed-stat_claimed}
-reports_per_reason.update({r:0 for r in rules_reasons})
-for report in reports_claimed:
-    reason = report['testActions'][0]['reason']
-    if reason not in reports_per_reason:
-        reports_per_reason[reason] = 0
-    reports_per_reason[reason] += 1
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show statistics of results and claims')
+    parser.add_argument('--from-history', action='store_true',
+        help="count builds stored in 'history' instead of fetching their reports"
+            " again (claims made since they were stored are not counted)")
+    args = parser.parse_args(argv)
 
-print("\nHow various reasons for claims are used")
-reports_per_reason = sorted(reports_per_reason.items(), key=lambda x: x[1], reverse=True)
-reports_per_reason = [(r, c, r in rules_reasons) for r, c in reports_per_reason]
-print(tabulate.tabulate(
-    reports_per_reason,
-    headers=['claim reason', 'number of times', 'is it in current knowleadgebase?']))
+    store = history.History.from_config()
+    if args.from_history and store is None:
+        parser.error("--from-history needs 'history' in config.yaml")
+    if args.from_history:
+        stats = aggregation.Stats(stored_or_fetched(store))
+    else:
+        stats = aggregation.Stats(claims.Report(fields=claims.Report.fields_for(), history=store))
 
-reports_per_class = {}
-for report in reports:
-    class_name = report['className']
-    if class_name not in reports_per_class:
-        reports_per_class[class_name] = {'all': 0, 'failed': 0}
-    reports_per_class[class_name]['all'] += 1
-    if report in reports_fails:
-        reports_per_class[class_name]['failed'] += 1
+    print("\nOverall stats")
+    print(tabulate.tabulate(
+        [[stats.all, stats.failed, stats.claimed]],
+        headers=['all reports', 'failures', 'claimed failures']))
 
-print("\nHow many failures are there per class")
-print(tabulate.tabulate(
-    sorted([(c, r['all'], r['failed'], float(r['failed'])/r['all']) for c,r in reports_per_class.items()],
-        key=lambda x: x[3], reverse=True),
-    headers=['class name', 'number of reports', 'number of failures', 'failures ratio'],
-    floatfmt=".3f"))
+    rules = claims.Ruleset()
+    rules_reasons = [r['reason'] for r in rules]
+    reports_per_reason = {'UNKNOWN': stats.unclaimed}
+    reports_per_reason.update({r:0 for r in rules_reasons})
+    reports_per_reason.update(stats.per_reason)
 
-reports_per_method = {}
-for report in reports:
-    method = report['className'].split('.')[2]
-    if method not in reports_per_method:
-        reports_per_method[method] = {'all': 0, 'failed': 0}
-    reports_per_method[method]['all'] += 1
-    if report in reports_fails:
-        reports_per_method[method]['failed'] += 1
+    print("\nHow various reasons for claims are used")
+    reports_per_reason = sorted(reports_per_reason.items(), key=lambda x: x[1], reverse=True)
+    reports_per_reason = [(r, c, r in rules_reasons) for r, c in reports_per_reason]
+    print(tabulate.tabulate(
+        reports_per_reason,
+        headers=['claim reason', 'number of times', 'is it in current knowleadgebase?']))
 
-print("\nHow many failures are there per method (CLI vs. API vs. UI)")
-print(tabulate.tabulate(
-    sorted([(c, r['all'], r['failed'], float(r['failed'])/r['all']) for c,r in reports_per_method.items()],
-        key=lambda x: x[3], reverse=True),
-    headers=['method', 'number of reports', 'number of failures', 'failures ratio'],
-    floatfmt=".3f"))
+    print("\nHow many failures are there per class")
+    print(tabulate.tabulate(
+        sorted([(c, r.all, r.failed, r.ratio) for c,r in stats.per_class.items()],
+            key=lambda x: x[3], reverse=True),
+        headers=['class name', 'number of reports', 'number of failures', 'failures ratio'],
+        floatfmt=".3f"))
+
+    print("\nHow many failures are there per method (CLI vs. API vs. UI)")
+    print(tabulate.tabulate(
+        sorted([(c, r.all, r.failed, r.ratio) for c,r in stats.per_method.items()],
+            key=lambda x: x[3], reverse=True),
+        headers=['method', 'number of reports', 'number of failures', 'failures ratio'],
+        floatfmt=".3f"))
+
+    if store is not None:
+        print("\nMost common claim reasons in last 50 builds (from history)")
+        print(tabulate.tabulate(
+            store.reasons(last=50),
+            headers=['claim reason', 'number of times']))
+
+
+if __name__ == '__main__':
+    main()
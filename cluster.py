@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Clusters of failures with the same error. Error texts differing only in
+IDs, hostnames, timestamps, memory addresses or name of the test are
+normalized to the same text and have the same fingerprint:
+
+    for c in cluster.clusters(failures, threshold=0.8):
+        print(len(c), c.text)
+
+With 'threshold', clusters of similar errors (estimated Jaccard
+similarity of their word shingles by MinHash, candidates found by LSH)
+are merged as well. Run as a script it lists clusters of unclaimed
+failures, largest first:
+
+    ./cluster.py [--similarity 0.8]
+"""
+
+import sys
+import re
+import zlib
+import hashlib
+import argparse
+import collections
+import numpy
+import tabulate
+import claims
+
+
+ERROR_FIELDS = ('errorDetails', 'errorStackTrace')
+# Every placeholder starts at word boundary. Domain and hex are matched
+# without backtracking through the words which are not
+VOLATILE = (
+    ('TIME', r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'),
+    ('UUID', r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'),
+    ('ADDR', r'0x[0-9a-fA-F]+\b'),
+    ('IP', r'\d{1,3}(?:\.\d{1,3}){3}\b'),
+    ('HOST', r'(?<=://)[^/:\s]+|(?=(?P<domain>(?:[\w-]+\.)+))(?P=domain)(?:com|net|org|io|local|lan|test)\b'),
+    ('HEX', r'(?=[0-9a-f]{8,}\b)(?=[0-9a-f]*[0-9])(?=[0-9a-f]*[a-f])[0-9a-f]+'),
+    ('N', r'\d+\b'),
+)
+VOLATILE_REGEXP = re.compile(r'\b(?:%s)' % '|'.join('(?P<%s>%s)' % i for i in VOLATILE))
+SHINGLE = 3   # words
+PRIME = (1 << 31) - 1
+
+
+def normalize(text, case=None):
+    """
+    Returns text with volatile parts replaced by placeholders (e.g. <N>
+    for a number). Class and name of the test (if case is given) are
+    replaced by <TEST>.
+    """
+    if not text:
+        return ''
+    if case is not None:
+        for field in ('className', 'name'):
+            if case.get(field):
+                text = text.replace(case[field], '<TEST>')
+    return VOLATILE_REGEXP.sub(lambda m: '<%s>' % m.lastgroup, text)
+
+
+def fingerprint(case, fields=ERROR_FIELDS, exact=()):
+    """
+    Returns hash of normalized 'fields' and of exact values of 'exact'
+    fields of the case
+    """
+    out = hashlib.sha1()
+    for field in fields:
+        value = normalize(case.get(field), case).encode('utf-8')
+        out.update(b'\x00%d:' % len(value))
+        out.update(value)
+    for field in exact:
+        value = str(case.get(field)).encode('utf-8')
+        out.update(b'\x01%d:' % len(value))
+        out.update(value)
+    return out.hexdigest()
+
+
+class MinHash(object):
+    """
+    MinHash signatures of texts, share of equal values of two signatures
+    estimates Jaccard similarity of sets of word shingles of the texts
+    """
+
+    def __init__(self, num_perm=64, seed=0):
+        rnd = numpy.random.RandomState(seed)
+        self.a = rnd.randint(1, PRIME, num_perm).astype(numpy.int64)
+        self.b = rnd.randint(0, PRIME, num_perm).astype(numpy.int64)
+
+    def signature(self, text):
+        words = text.split()
+        shingles = {' '.join(words[i:i + SHINGLE])
+            for i in range(max(len(words) - SHINGLE + 1, 1))}
+        hashes = numpy.fromiter(
+            (zlib.crc32(i.encode('utf-8')) & PRIME for i in shingles),
+            dtype=numpy.int64, count=len(shingles))
+        return ((numpy.outer(hashes, self.a) + self.b) % PRIME).min(axis=0)
+
+    @staticmethod
+    def similarity(a, b):
+        return float((a == b).mean())
+
+
+class Cluster(object):
+    """
+    Failures with the same fingerprint (or with similar errors, when
+    clusters were merged), 'text' is the normalized error of the first one
+    """
+
+    def __init__(self, fingerprint, text):
+        self.fingerprint = fingerprint
+        self.text = text
+        self.cases = []
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __iter__(self):
+        return iter(self.cases)
+
+    @property
+    def tests(self):
+        """
+        Distinct className::name of the failures
+        """
+        return sorted({"%s::%s" % (i['className'], i['name']) for i in self.cases})
+
+
+def clusters(cases, fields=ERROR_FIELDS, exact=(), threshold=None, num_perm=64, rows=4):
+    """
+    Returns list of Clusters of given cases by fingerprint of 'fields'
+    (and 'exact' fields), largest first. If 'threshold' is given, clusters
+    whose errors have estimated similarity at least 'threshold' are merged
+    (signatures of 'num_perm' values split into bands of 'rows' for LSH).
+    """
+    out = collections.OrderedDict()
+    for case in cases:
+        key = fingerprint(case, fields, exact)
+        if key not in out:
+            out[key] = Cluster(key, '\n'.join(normalize(case.get(i), case) for i in fields))
+        out[key].cases.append(case)
+    out = list(out.values())
+    if threshold is not None and len(out) > 1:
+        out = merge_similar(out, threshold, num_perm, rows)
+    return sorted(out, key=len, reverse=True)
+
+
+def merge_similar(groups, threshold, num_perm=64, rows=4):
+    """
+    Merges clusters with similar errors. Candidates are clusters with
+    equal band of the MinHash signatures, they are merged into the first
+    one of them if the whole signatures are similar enough.
+    """
+    minhash = MinHash(num_perm)
+    signatures = [minhash.signature(i.text) for i in groups]
+    parent = list(range(len(groups)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(0, num_perm, rows):
+        buckets = {}
+        for i, signature in enumerate(signatures):
+            buckets.setdefault(signature[band:band + rows].tobytes(), []).append(i)
+        for members in buckets.values():
+            for i in members[1:]:
+                a, b = find(members[0]), find(i)
+                if a != b and MinHash.similarity(signatures[a], signatures[b]) >= threshold:
+                    parent[max(a, b)] = min(a, b)
+    out = collections.OrderedDict()
+    for i, group in enumerate(groups):
+        root = find(i)
+        if root in out:
+            out[root].cases += group.cases
+        else:
+            out[root] = group
+    return list(out.values())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='List clusters of unclaimed failures with the same error, largest first')
+    parser.add_argument('--similarity', type=float,
+        help='merge clusters of errors similar at least this much (0 to 1)')
+    parser.add_argument('--limit', type=int, default=50,
+        help='number of clusters to list (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    # Errors come with the report, not by a request per failure
+    fields = claims.Report.fields_for() + list(ERROR_FIELDS)
+    failures = [i for i in claims.Report(fields=fields)
+        if i['status'] in claims.Case.FAIL_STATUSES and not i['testActions'][0].get('reason')]
+    out = clusters(failures, threshold=args.similarity)
+    print("%s unclaimed failures in %s clusters" % (len(failures), len(out)))
+    print(tabulate.tabulate(
+        [(len(c), len(c.tests), ' '.join(sorted({i['distro'] for i in c})),
+            c.fingerprint[:12], c.text.split('\n', 1)[0][:100])
+            for c in out[:args.limit]],
+        headers=['failures', 'tests', 'distros', 'fingerprint', 'error']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Local stand-in for the parts of Jenkins API claims.py talks to, together
+with generators of synthetic data. Used for benchmarking without real
+Jenkins:
+
+    with fake_jenkins.FakeJenkins(latency=0.1) as jenkins:
+        jenkins.add_build('automation-6.2-tier1-rhel7', 42,
+            fake_jenkins.generate_report(1000))
+        claims.config['url'] = jenkins.url
+"""
+
+import datetime
+import email.utils
+import hashlib
+import io
+import json
+import random
+import re
+import tarfile
+import threading
+import time
+import http.server
+import urllib.parse
+
+
+MODULES = ('api', 'cli', 'ui')
+STATUSES = ('PASSED', 'FIXED', 'SKIPPED')
+FAIL_STATUSES = ('FAILED', 'REGRESSION')
+ERRORS = (
+    'AssertionError: Repository contains invalid number of content entities',
+    'HTTPError: 500 Server Error: Internal Server Error for url: https://sat.example.com/katello/api/v2/repositories/{0}',
+    'TaskTimedOutError: Timed out waiting for task {0} (action Manifest)',
+    'SSHCommandTimeoutError: hammer subscription list --organization-id {0}',
+    'StaleElementReferenceException: element {0} is not attached to the page document',
+)
+
+
+def generate_report(cases, fail_ratio=0.1, stdout_lines=20, seed=0):
+    """
+    Return testReport structure (as returned by Jenkins JSON API) with
+    given number of synthetic test cases
+    """
+    rnd = random.Random(seed)
+    out = []
+    start = 1528874246   # 2018-06-13T07:17:26
+    for i in range(cases):
+        module = MODULES[i % len(MODULES)]
+        class_name = 'tests.foreman.{0}.test_area{1}.Area{1}TestCase'.format(
+            module, i // 50)
+        duration = rnd.randint(1, 300)
+        stdout = '\n'.join(
+            '{0} - robottelo - DEBUG - step {1} of test {2}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                    time.gmtime(start + duration * j // max(stdout_lines - 1, 1))),
+                j, i)
+            for j in range(stdout_lines))
+        if rnd.random() < fail_ratio:
+            error = rnd.choice(ERRORS).format(rnd.randint(1, 10000))
+            case = {
+                'className': class_name,
+                'name': 'test_positive_{0}'.format(i),
+                'status': rnd.choice(FAIL_STATUSES),
+                'duration': duration,
+                'stdout': stdout,
+                'errorDetails': error,
+                'errorStackTrace': 'self = <{0}>\n\n    def test():\n>       raise\nE       {1}'.format(class_name, error),
+                'testActions': [{'reason': None}],
+            }
+        else:
+            case = {
+                'className': class_name,
+                'name': 'test_positive_{0}'.format(i),
+                'status': rnd.choice(STATUSES),
+                'duration': duration,
+                'stdout': stdout,
+                'errorDetails': None,
+                'errorStackTrace': None,
+                'testActions': [],
+            }
+        out.append(case)
+        start += duration
+    return {'suites': [{'cases': out}]}
+
+
+def generate_production_log(filename, size, skew=0.01, seed=0):
+    """
+    Write synthetic foreman production.log of (approximately) given size
+    in bytes. Fraction 'skew' of records is logged with time four hours
+    off, as it happens in real logs. Returns tuple with time of the first
+    and of the last record.
+    """
+    rnd = random.Random(seed)
+    start = now = 1528874246   # 2018-06-13T07:17:26
+    written = 0
+    with open(filename, 'w', encoding='ISO-8859-1') as fp:
+        while written < size:
+            buf = []
+            for _ in range(1000):
+                now += rnd.randint(0, 2)
+                when = now - 4 * 3600 if rnd.random() < skew else now
+                request = '%08x' % rnd.getrandbits(32)
+                buf.append('%s [I|app|%s] Started GET "/katello/api/v2/repositories/%s" for 127.0.0.1\n' % (
+                    time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(when)),
+                    request, rnd.randint(1, 10000)))
+                for _ in range(rnd.randint(0, 3)):
+                    buf.append('  Parameters: {"id"=>"%s", "organization_id"=>"1"}\n' % rnd.randint(1, 10000))
+            data = ''.join(buf)
+            fp.write(data)
+            written += len(data)
+    return (datetime.datetime.utcfromtimestamp(start),
+        datetime.datetime.utcfromtimestamp(now))
+
+
+def generate_kb(rules, seed=0):
+    """
+    Return kb.json ruleset with given number of rules. Only a few of them
+    (one per error in ERRORS) match failures from generate_report().
+    """
+    rnd = random.Random(seed)
+    out = []
+    for i in range(rules):
+        pattern = 'Error%s: [a-z]+ failed on host-%s' % (i, rnd.randint(1, 1000))
+        kind = i % 3
+        if kind == 0:
+            rule = {'field': 'errorDetails', 'pattern': pattern}
+        elif kind == 1:
+            rule = {'AND': [
+                {'field': 'errorDetails', 'pattern': pattern},
+                {'field': 'errorStackTrace', 'pattern': 'def test'},
+            ]}
+        else:
+            rule = {'OR': [
+                {'field': 'errorDetails', 'pattern': pattern},
+                {'field': 'errorStackTrace', 'pattern': pattern},
+            ]}
+        rule['reason'] = 'https://bugzilla.example.com/show_bug.cgi?id=%s' % i
+        out.append(rule)
+    for i, error in enumerate(ERRORS):
+        position = (i + 1) * len(out) // (len(ERRORS) + 1)
+        out.insert(position, {
+            'field': 'errorDetails',
+            'pattern': re.escape(error.split(':')[0]) + ':',
+            'reason': 'known_error_%s' % i,
+        })
+    return out
+
+
+def generate_foreman_debug(production_log, other=20*1024*1024, seed=0):
+    """
+    Return foreman-debug.tar.xz content with given production.log file
+    and other members of total size 'other' bytes
+    """
+    rnd = random.Random(seed)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:xz', preset=0) as tar:
+        for i in range(10):
+            data = ''.join('%08x some other log line\n' % rnd.getrandbits(32)
+                for _ in range(other // 10 // 32)).encode('ascii')
+            info = tarfile.TarInfo('foreman-debug/var/log/other-%s.log' % i)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        tar.add(production_log, 'foreman-debug/var/log/foreman/production.log')
+    return buf.getvalue()
+
+
+class FakeJenkins(object):
+    """
+    Threaded HTTP server answering the Jenkins endpoints used by claims.py.
+    Every request is delayed by 'latency' seconds to simulate remote server.
+    Fields of the test cases are filtered by 'tree' parameter as Jenkins
+    does and number of bytes sent is counted in 'bytes_sent'. Artifacts
+    are sent with ETag and Last-Modified and conditional requests for
+    them are answered by 304.
+    Crumb expires after 'crumb_ttl' claims and 'error_ratio' of claims
+    fails with 500, next claims fail with status codes put in
+    'claim_errors' first. Claims are recorded in 'claims' and in the
+    reports.
+    """
+
+    CRUMB_FIELD = 'Jenkins-Crumb'
+
+    def __init__(self, latency=0.0, crumb_ttl=None, error_ratio=0.0, seed=0):
+        self.latency = latency
+        self.crumb_ttl = crumb_ttl
+        self.error_ratio = error_ratio
+        self.builds = {}
+        self.claims = []   # list of (url of the test, claim)
+        self.claim_errors = []   # status codes the next claims fail with
+        self.requests = 0
+        self.bytes_sent = 0
+        self._crumb = None
+        self._crumb_uses = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self._server.server_address
+
+    def add_build(self, job, number, report, building=False, artifacts=None):
+        self.builds[(job, number)] = {'report': report, 'building': building,
+            'artifacts': artifacts or {}, 'modified': time.time()}
+
+    def resolve(self, job, build):
+        """
+        Returns build number for build number or alias as used in URLs
+        """
+        if build.isdigit():
+            return int(build) if (job, int(build)) in self.builds else None
+        numbers = [n for (j, n), b in self.builds.items() if j == job
+            and (build == 'lastBuild' or not b['building'])]
+        return max(numbers) if numbers else None
+
+    def find_case(self, job, build, path):
+        """
+        Returns test case of the build for 'testReport/junit/...' path of
+        its URL, None if there is no such case
+        """
+        match = re.match('^testReport/junit/(.*)/([^/]+)/([^/]+)$', path)
+        number = self.resolve(job, build)
+        if not match or number is None:
+            return None
+        class_name = '.'.join(match.group(1, 2))
+        for suite in self.builds[(job, number)]['report']['suites']:
+            for case in suite['cases']:
+                if case['className'] == class_name and case['name'] == match.group(3):
+                    return case
+        return None
+
+    @staticmethod
+    def tree_fields(tree):
+        """
+        Returns names of the case fields selected by 'tree' parameter, e.g.
+        suites[cases[name,testActions[reason]]]{0} => ['name', 'testActions']
+        (None if all of them are selected)
+        """
+        if not tree:
+            return None
+        match = re.search(r'cases\[(.*)\](\{[0-9,]*\})?\](\{[0-9,]*\})?$', tree)
+        if match:
+            tree = match.group(1)
+        fields = []
+        depth = 0
+        for part in re.split(r'([\[\],])', tree):
+            if part == '[':
+                depth += 1
+            elif part == ']':
+                depth -= 1
+            elif part and part != ',' and depth == 0:
+                fields.append(part)
+        return fields
+
+    @staticmethod
+    def tree_ranges(tree):
+        """
+        Returns slices of the suites and of the cases of every suite
+        selected by 'tree' parameter, e.g. suites[cases[name]{5,}]{1,2} =>
+        (slice(1, 2), slice(5, None))
+        """
+        def to_slice(text):
+            if not text:
+                return slice(None)
+            if ',' not in text:
+                return slice(int(text[1:-1]), int(text[1:-1]) + 1)
+            start, stop = text[1:-1].split(',')
+            return slice(int(start) if start else None, int(stop) if stop else None)
+
+        match = re.search(r'cases\[.*\](\{[0-9,]*\})?\](\{[0-9,]*\})?$', tree or '')
+        if not match:
+            return slice(None), slice(None)
+        return to_slice(match.group(2)), to_slice(match.group(1))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _handler(self):
+        jenkins = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'   # keep-alive
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                # Clients can stop reading in the middle of the response
+                # (e.g. iteration of a lazy report stopped early)
+                try:
+                    super().handle()
+                except ConnectionError:
+                    pass
+
+            def do_GET(self):
+                with jenkins._lock:
+                    jenkins.requests += 1
+                if jenkins.latency:
+                    time.sleep(jenkins.latency)
+                url = urllib.parse.urlsplit(self.path)
+                match = re.match('^/job/([^/]+)/api/json$', url.path)
+                if match:
+                    builds = sorted(((n, b['building']) for (j, n), b
+                        in jenkins.builds.items() if j == match.group(1)), reverse=True)
+                    if not builds:
+                        return self.send_error(404)
+                    return self.send_json({'builds': [{'number': n, 'building': b}
+                        for n, b in builds]})
+                if url.path == '/crumbIssuer/api/json':
+                    with jenkins._lock:
+                        jenkins._crumb = '%032x' % jenkins._random.getrandbits(128)
+                        jenkins._crumb_uses = 0
+                    return self.send_json({'crumbRequestField': jenkins.CRUMB_FIELD,
+                        'crumb': jenkins._crumb})
+                match = re.match('^/job/([^/]+)/([^/]+)/(.*)$', url.path)
+                if not match:
+                    return self.send_error(404)
+                job, build, path = match.groups()
+                number = jenkins.resolve(job, build)
+                if number is None:
+                    return self.send_error(404)
+                build = jenkins.builds[(job, number)]
+                if path == 'api/json':
+                    return self.send_json(
+                        {'number': number, 'building': build['building']})
+                tree = urllib.parse.parse_qs(url.query).get('tree', [None])[0]
+                fields = jenkins.tree_fields(tree)
+                if path == 'testReport/api/json':
+                    report = build['report']
+                    if tree and 'cases' not in tree:   # just the counts
+                        statuses = [case['status'] for suite in report['suites']
+                            for case in suite['cases']]
+                        counts = {'failCount': sum(i in FAIL_STATUSES for i in statuses),
+                            'skipCount': statuses.count('SKIPPED')}
+                        counts['passCount'] = len(statuses) - sum(counts.values())
+                        return self.send_json({k: v for k, v in counts.items() if k in fields})
+                    if fields is not None:
+                        suites, cases = jenkins.tree_ranges(tree)
+                        report = {'suites': [{'cases': [
+                            {k: v for k, v in case.items() if k in fields}
+                            for case in suite['cases'][cases]]}
+                            for suite in report['suites'][suites]]}
+                    return self.send_json(report)
+                if path.startswith('testReport/junit/') and path.endswith('/api/json'):
+                    case = jenkins.find_case(job, str(number), path[:-len('/api/json')])
+                    if case is None:
+                        return self.send_error(404)
+                    return self.send_json({k: v for k, v in case.items()
+                        if fields is None or k in fields})
+                if path.startswith('artifact/') and path[9:] in build['artifacts']:
+                    body = build['artifacts'][path[9:]]
+                    headers = {'ETag': '"%s"' % hashlib.sha1(body).hexdigest(),
+                        'Last-Modified': email.utils.formatdate(build['modified'], usegmt=True)}
+                    if 'If-None-Match' in self.headers:   # takes precedence
+                        modified = self.headers['If-None-Match'] != headers['ETag']
+                    else:
+                        modified = self.headers.get('If-Modified-Since') != headers['Last-Modified']
+                    if not modified:
+                        self.send_response(304)
+                        for name, value in headers.items():
+                            self.send_header(name, value)
+                        self.send_header('Content-Length', '0')
+                        return self.end_headers()
+                    return self.send_body(body, 'application/octet-stream', headers)
+                self.send_error(404)
+
+            def do_POST(self):
+                with jenkins._lock:
+                    jenkins.requests += 1
+                if jenkins.latency:
+                    time.sleep(jenkins.latency)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                url = urllib.parse.urlsplit(self.path)
+                if not url.path.endswith('/claim/claim'):
+                    return self.send_error(404)
+                with jenkins._lock:
+                    crumb = jenkins._crumb
+                    if crumb is not None:
+                        jenkins._crumb_uses += 1
+                        if jenkins.crumb_ttl and jenkins._crumb_uses > jenkins.crumb_ttl:
+                            jenkins._crumb = None
+                    error = 500 if jenkins._random.random() < jenkins.error_ratio else None
+                if crumb is None or self.headers.get(jenkins.CRUMB_FIELD) != crumb:
+                    return self.send_error(403, 'No valid crumb was included in the request')
+                with jenkins._lock:
+                    if jenkins.claim_errors:
+                        error = jenkins.claim_errors.pop(0)
+                if error:
+                    return self.send_error(error)
+                claim = json.loads(urllib.parse.parse_qs(body.decode('utf-8'))['json'][0])
+                match = re.match('^/job/([^/]+)/([^/]+)/(.*)/claim/claim$', url.path)
+                with jenkins._lock:
+                    jenkins.claims.append((url.path[:-len('/claim/claim')], claim))
+                    case = match and jenkins.find_case(*match.groups())
+                    if case is not None:
+                        case['testActions'] = [{'reason': claim['reason']}]
+                self.send_response(302)
+                self.send_header('Location', url.path[:-len('/claim/claim')])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def send_json(self, data):
+                # Encoded and sent in chunks as Jenkins does, so big
+                # reports are not in memory of the server twice
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json;charset=utf-8')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                buf = []
+                size = 0
+                for part in json.JSONEncoder().iterencode(data):
+                    buf.append(part)
+                    size += len(part)
+                    if size >= 64 * 1024:
+                        self.send_chunk(''.join(buf).encode('utf-8'))
+                        buf = []
+                        size = 0
+                self.send_chunk(''.join(buf).encode('utf-8'))
+                self.wfile.write(b'0\r\n\r\n')
+
+            def send_chunk(self, chunk):
+                if not chunk:
+                    return
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                with jenkins._lock:
+                    jenkins.bytes_sent += len(chunk)
+
+            def send_body(self, body, content_type, headers=None):
+                self.send_response(200)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with jenkins._lock:
+                    jenkins.bytes_sent += len(body)
+
+        return Handler
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Persistent history of test results across builds in SQLite:
+
+    store = history.History('history.sqlite')
+    report = claims.Report(history=store)   # completed builds are stored as they are loaded
+    print(store.first_failure('tests.foreman.api.test_x.XTestCase', 'test_y', 'el7'))
+    print(store.reasons(last=50))
+
+Storing a build again updates it (e.g. with claims made since), so the
+same build can be stored any number of times.
+"""
+
+import sqlite3
+import threading
+import claims
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    tier TEXT,
+    distro TEXT,
+    UNIQUE (job, number)
+);
+CREATE INDEX IF NOT EXISTS builds_number ON builds (number);
+CREATE TABLE IF NOT EXISTS cases (
+    build INTEGER NOT NULL REFERENCES builds (id),
+    className TEXT NOT NULL,
+    name TEXT NOT NULL,
+    distro TEXT,
+    status TEXT NOT NULL,
+    duration REAL,
+    PRIMARY KEY (build, className, name)
+);
+CREATE INDEX IF NOT EXISTS cases_test ON cases (className, name, distro);
+CREATE INDEX IF NOT EXISTS cases_status ON cases (status);
+CREATE TABLE IF NOT EXISTS claims (
+    build INTEGER NOT NULL REFERENCES builds (id),
+    className TEXT NOT NULL,
+    name TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    PRIMARY KEY (build, className, name)
+);
+CREATE INDEX IF NOT EXISTS claims_reason ON claims (reason);
+"""
+
+
+def field(case, name):
+    """
+    Returns field of the case, None if it is missing or was not fetched
+    (so it is not fetched just to be stored)
+    """
+    if isinstance(case, claims.Case) and case.lazy_fields([name]):
+        return None
+    return case.get(name)
+
+
+class History(object):
+    """
+    SQLite store of builds, their results (cases) and claims. It can be
+    shared by threads loading the Report, the connection is used by one
+    of them at a time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls):
+        """
+        Returns store in 'history' file, None if that is not set
+        """
+        if not claims.config['history']:
+            return None
+        return cls(claims.config['history'])
+
+    def close(self):
+        self._db.close()
+
+    def ingest_build(self, job, number, cases):
+        """
+        Stores results of given completed build of the job. Results and
+        claims stored for the build already are updated.
+        """
+        rows = []
+        claimed = []
+        unclaimed = []
+        tier = distro = None
+        for case in cases:
+            tier, distro = case.get('tier'), case.get('distro')
+            rows.append((case['className'], case['name'], distro, case['status'],
+                field(case, 'duration')))
+            if case['status'] in claims.Case.FAIL_STATUSES:
+                reason = case['testActions'][0].get('reason') if case['testActions'] else None
+                if reason:
+                    claimed.append((case['className'], case['name'], reason))
+                else:
+                    unclaimed.append((case['className'], case['name']))
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR IGNORE INTO builds (job, number, tier, distro) VALUES (?, ?, ?, ?)',
+                (job, number, tier, distro))
+            build, = self._db.execute(
+                'SELECT id FROM builds WHERE job = ? AND number = ?', (job, number)).fetchone()
+            self._db.executemany(
+                'INSERT INTO cases (build, className, name, distro, status, duration)'
+                ' VALUES (%s, ?, ?, ?, ?, ?) ON CONFLICT (build, className, name) DO UPDATE'
+                ' SET status = excluded.status, duration = COALESCE(excluded.duration, duration)'
+                % build, rows)
+            self._db.executemany(
+                'INSERT INTO claims (build, className, name, reason) VALUES (%s, ?, ?, ?)'
+                ' ON CONFLICT (build, className, name) DO UPDATE SET reason = excluded.reason'
+                % build, claimed)
+            self._db.executemany(
+                'DELETE FROM claims WHERE build = %s AND className = ? AND name = ?'
+                % build, unclaimed)
+
+    def numbers(self, job=None):
+        """
+        Returns set of build numbers stored (of given job)
+        """
+        with self._lock:
+            if job is None:
+                cursor = self._db.execute('SELECT DISTINCT number FROM builds')
+            else:
+                cursor = self._db.execute('SELECT number FROM builds WHERE job = ?', (job,))
+            return {i for i, in cursor}
+
+    def results(self, numbers, batch=1000):
+        """
+        Yields (className, name, distro, build number, status) of all the
+        results of given builds, ordered by build (newest first), job and
+        order in the report. Rows are read in batches, so the connection
+        is not held while they are processed.
+        """
+        numbers = list(numbers)
+        with self._lock:
+            cursor = self._db.execute(
+                'SELECT c.className, c.name, c.distro, b.number, c.status'
+                ' FROM builds b JOIN cases c ON c.build = b.id'
+                ' WHERE b.number IN (%s) ORDER BY b.number DESC, b.tier, b.distro, c.rowid'
+                % ','.join('?' * len(numbers)), numbers)
+            rows = cursor.fetchmany(batch)
+        while rows:
+            yield from rows
+            with self._lock:
+                rows = cursor.fetchmany(batch)
+
+    def cases(self, job, number):
+        """
+        Returns results of given build of the job as they were stored, as
+        dicts with className, name, tier, distro, status and testActions
+        (the claim), ordered as in the report
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT c.className, c.name, b.tier, c.distro, c.status, l.reason'
+                ' FROM builds b JOIN cases c ON c.build = b.id'
+                ' LEFT JOIN claims l ON l.build = c.build AND l.className = c.className AND l.name = c.name'
+                ' WHERE b.job = ? AND b.number = ? ORDER BY c.rowid', (job, number)).fetchall()
+        return [{'className': class_name, 'name': name, 'tier': tier, 'distro': distro,
+                'status': status, 'testActions': [{'reason': reason}]
+                if status in claims.Case.FAIL_STATUSES else []}
+            for class_name, name, tier, distro, status, reason in rows]
+
+    def history(self, class_name, name, distro=None):
+        """
+        Returns list of (build number, distro, status, reason) of the test,
+        newest first
+        """
+        query = 'SELECT b.number, c.distro, c.status, l.reason' \
+            ' FROM cases c JOIN builds b ON c.build = b.id' \
+            ' LEFT JOIN claims l ON l.build = c.build AND l.className = c.className AND l.name = c.name' \
+            ' WHERE c.className = ? AND c.name = ?'
+        params = [class_name, name]
+        if distro is not None:
+            query += ' AND c.distro = ?'
+            params.append(distro)
+        with self._lock:
+            return self._db.execute(query + ' ORDER BY b.number DESC, c.distro', params).fetchall()
+
+    def first_failure(self, class_name, name, distro):
+        """
+        Returns number of the build since which the test fails, None if it
+        did not fail last time
+        """
+        first = None
+        for number, _, status, _ in self.history(class_name, name, distro):
+            if status not in claims.Case.FAIL_STATUSES:
+                break
+            first = number
+        return first
+
+    def reasons(self, last=None):
+        """
+        Returns list of (reason, number of claims) in last 'last' builds
+        (all by default), most common first
+        """
+        query = 'SELECT l.reason, COUNT(*) FROM claims l JOIN builds b ON l.build = b.id'
+        params = []
+        if last is not None:
+            query += ' WHERE b.number IN (SELECT DISTINCT number FROM builds ORDER BY number DESC LIMIT ?)'
+            params.append(last)
+        with self._lock:
+            return self._db.execute(
+                query + ' GROUP BY l.reason ORDER BY 2 DESC, 1', params).fetchall()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Timing of the phases of claims.py (crumb, report download and decoding,
+foreman-debug download and extraction, production.log indexing, rule
+matching, claims) together with bytes transferred, peak RSS and
+counters:
+
+    with metrics.span('claim', tier='t1', distro='el7', build=42):
+        ...
+    for chunk in metrics.timed_iter(response.iter_content(), 'report_download'):
+        ...
+    metrics.count('claims', ok='true')
+
+Nothing is recorded until metrics.enable() is called ('metrics' file in
+config.yaml), span() returns shared do-nothing span and timed_iter()
+returns the iterable itself until then. Enabled metrics are saved at exit
+as Prometheus text file (e.g. for textfile collector of node_exporter) or
+appended to JSON lines trace if the file name ends with .jsonl.
+
+Phase nested in another one (e.g. crumb fetched while claiming) counts
+in 'seconds' of both, 'self_seconds' of the outer one do not include it.
+"""
+
+import os
+import json
+import time
+import atexit
+import resource
+import threading
+import collections
+
+
+_metrics = None
+_local = threading.local()
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class NoSpan(object):
+    """
+    Span of disabled metrics
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, count):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Span(object):
+    """
+    One run of a phase, recorded when it ends. It can be entered more
+    times (see timed_iter()), time of all of them is summed up.
+    """
+
+    __slots__ = ('metrics', 'name', 'labels', 'start', 'seconds', 'children',
+        'bytes', 'error', '_entered')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+        self.seconds = 0.0
+        self.children = 0.0   # seconds of phases nested in this one
+        self.bytes = 0
+        self.error = False
+        self._entered = None
+
+    def add_bytes(self, count):
+        self.bytes += count
+
+    def enter(self):
+        if self.start is None:
+            self.start = time.time()
+        stack = _local.__dict__.setdefault('stack', [])
+        stack.append(self)
+        self._entered = time.perf_counter()
+
+    def exit(self):
+        duration = time.perf_counter() - self._entered
+        self.seconds += duration
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].children += duration
+
+    def __enter__(self):
+        self.enter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.exit()
+        self.error = exc_type is not None
+        self.metrics.record(self)
+        return False
+
+
+class Metrics(object):
+    """
+    Phases and counters recorded so far, aggregated by name and labels
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.phases = collections.OrderedDict()     # (name, labels): [calls, seconds, self seconds, bytes, errors]
+        self.counters = collections.OrderedDict()   # (name, labels): value
+        self._lock = threading.Lock()
+        self._trace = None
+        if filename.endswith('.jsonl'):
+            self._trace = open(filename, 'a')
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def record(self, span):
+        key = self.key(span.name, span.labels)
+        own = span.seconds - span.children
+        with self._lock:
+            phase = self.phases.get(key)
+            if phase is None:
+                phase = self.phases[key] = [0, 0.0, 0.0, 0, 0]
+            phase[0] += 1
+            phase[1] += span.seconds
+            phase[2] += own
+            phase[3] += span.bytes
+            phase[4] += span.error
+            if self._trace is not None:
+                self._trace.write(json.dumps({'phase': span.name, 'labels': dict(key[1]),
+                    'start': span.start, 'seconds': span.seconds, 'self_seconds': own,
+                    'bytes': span.bytes, 'error': span.error, 'peak_rss': peak_rss()}) + '\n')
+
+    def count(self, name, value=1, labels=None):
+        key = self.key(name, labels or {})
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def save(self):
+        """
+        Appends counters and peak RSS to the trace, or writes all the
+        metrics to Prometheus text file
+        """
+        with self._lock:
+            if self._trace is not None:
+                for (name, labels), value in self.counters.items():
+                    self._trace.write(json.dumps({'counter': name, 'labels': dict(labels),
+                        'value': value}) + '\n')
+                self._trace.write(json.dumps({'end': time.time(), 'peak_rss': peak_rss()}) + '\n')
+                self._trace.flush()
+                self.counters.clear()
+                return
+            with open(self.filename + '.tmp', 'w') as fp:
+                fp.write(self.prometheus())
+            os.replace(self.filename + '.tmp', self.filename)
+
+    def prometheus(self):
+        """
+        Returns the metrics in Prometheus text format
+        """
+        def labels(name, items):
+            items = (('phase', name),) + items if name is not None else items
+            return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', r'\\')
+                .replace('"', r'\"').replace('\n', r'\n')) for k, v in items)
+
+        out = []
+        for column, metric, help in ((0, 'calls', 'Times the phase ran'),
+                (1, 'seconds', 'Time spent in the phase including nested phases'),
+                (2, 'self_seconds', 'Time spent in the phase itself'),
+                (3, 'bytes', 'Bytes transferred in the phase'),
+                (4, 'errors', 'Times the phase failed')):
+            out.append('# HELP claims_phase_%s_total %s' % (metric, help))
+            out.append('# TYPE claims_phase_%s_total counter' % metric)
+            for (name, items), values in self.phases.items():
+                out.append('claims_phase_%s_total%s %s' % (metric, labels(name, items), values[column]))
+        for name in sorted({i[0] for i in self.counters}):
+            out.append('# TYPE claims_%s_total counter' % name)
+            for (counter, items), value in self.counters.items():
+                if counter == name:
+                    out.append('claims_%s_total%s %s' % (name, labels(None, items), value))
+        out.append('# HELP claims_peak_rss_bytes Peak resident set size')
+        out.append('# TYPE claims_peak_rss_bytes gauge')
+        out.append('claims_peak_rss_bytes %s' % peak_rss())
+        out.append('# TYPE claims_last_run_timestamp_seconds gauge')
+        out.append('claims_last_run_timestamp_seconds %s' % time.time())
+        return '\n'.join(out) + '\n'
+
+
+def enable(filename):
+    """
+    Starts recording, metrics are saved to given file at exit
+    """
+    global _metrics
+    if _metrics is None:
+        atexit.register(save)
+    _metrics = Metrics(filename)
+    return _metrics
+
+
+def disable():
+    global _metrics
+    _metrics = None
+
+
+def enabled():
+    return _metrics is not None
+
+
+def save():
+    if _metrics is not None:
+        _metrics.save()
+
+
+def span(name, **labels):
+    """
+    Returns context manager timing the phase
+    """
+    if _metrics is None:
+        return NO_SPAN
+    return Span(_metrics, name, labels)
+
+
+def count(name, value=1, **labels):
+    if _metrics is not None:
+        _metrics.count(name, value, labels)
+
+
+def timed_iter(iterable, name, **labels):
+    """
+    Returns the iterable, recording time spent getting its items (not
+    time spent by the caller with them) and their length (if they are
+    bytes) as one span of the phase
+    """
+    if _metrics is None:
+        return iterable
+    return _timed_iter(iter(iterable), Span(_metrics, name, labels))
+
+
+def _timed_iter(iterator, span):
+    try:
+        while True:
+            span.enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except BaseException:
+                span.error = True
+                raise
+            finally:
+                span.exit()
+            if isinstance(item, bytes):
+                span.bytes += len(item)
+            yield item
+    finally:
+        span.metrics.record(span)
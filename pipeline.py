@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Claims failures by rules from kb.json in a pipeline: reports of the jobs
+are fetched, failures matched and claims pushed at the same time, so
+claiming of the first job does not wait for the last one to download:
+
+    ./pipeline.py [--dry-run]
+
+Stages are asyncio tasks connected by bounded queues, so fast stage
+waits for slow one instead of piling up cases in memory. Blocking work
+(requests to Jenkins, matching) runs in thread pools: 'fetch_workers'
+for reports and as many for lazy fields, one thread for matching (it is
+CPU bound and MatchCache is not thread safe) and 'claim_workers' for
+claims.
+"""
+
+import sys
+import time
+import logging
+import argparse
+import asyncio
+import threading
+import concurrent.futures
+import claims
+import metrics
+
+
+BATCH = 100   # cases passed between stages at once
+STOP = None   # end of the stream in a queue
+
+
+class Pipeline(object):
+    """
+    One run of fetch -> match -> claim over the jobs of a Report
+    """
+
+    def __init__(self, rules, report=None, dryrun=False, cache=None, queue_size=10):
+        if not isinstance(rules, claims.Ruleset):
+            rules = claims.Ruleset(rules)
+        self.rules = rules
+        if report is None:
+            report = claims.Report(fields=claims.Report.fields_for(rules))
+        self.report = report
+        self.dryrun = dryrun
+        self.cache = claims.MatchCache.from_config() if cache is None else cache
+        self.queue_size = queue_size   # batches waiting for every stage
+        self.results = []     # ClaimResult (or (case, reason) in dry run)
+        self.latencies = []   # seconds from fetching a failure to its claim
+        self.counts = {'cases': 0, 'failures': 0, 'matched': 0}
+        self._fields = set(rules.fields)
+        if self._fields.intersection(claims.Case.DERIVED_FIELDS):
+            self._fields.add('stdout')
+        self._stop = threading.Event()
+
+    def run(self):
+        """
+        Runs the pipeline in a new event loop, returns the results
+        """
+        return asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        Runs all the stages until all the jobs are claimed. If any stage
+        fails, the others are cancelled and the error is raised.
+        """
+        loop = asyncio.get_running_loop()
+        fetched = asyncio.Queue(self.queue_size)
+        matched = asyncio.Queue(self.queue_size)
+        fetch_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=claims.config['fetch_workers'])
+        # Own pool, fetching threads may be blocked waiting for matching
+        lazy_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=claims.config['fetch_workers'])
+        match_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        claim_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=claims.config['claim_workers'])
+        limiter = claims.RateLimiter(claims.config['claim_rate'])
+        jobs = [(i, j) for i in self.report.tiers for j in self.report.rhels]
+        prefetchers = claims.config['fetch_workers']
+        tasks = [
+            asyncio.ensure_future(self._fetch(loop, fetch_pool, jobs, fetched, prefetchers)),
+            asyncio.ensure_future(self._match(loop, lazy_pool, match_pool, fetched, matched, prefetchers)),
+        ] + [asyncio.ensure_future(self._claim(loop, claim_pool, limiter, matched))
+            for _ in range(claims.config['claim_workers'])]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Fetching threads blocked on a full queue give up as well
+            self._stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            for pool in (fetch_pool, lazy_pool, match_pool, claim_pool):
+                pool.shutdown(wait=False)
+            self.cache.save()
+        logging.info("Pipeline: %s cases, %s failures, %s matched, rule match cache: %s" \
+            % (self.counts['cases'], self.counts['failures'], self.counts['matched'], self.cache))
+        return self.results
+
+    def _fetch_job(self, loop, job, fetched):
+        """
+        Iterates cases of the job (in a thread) and puts them to 'fetched'
+        queue in batches, blocking while the queue is full
+        """
+        def put(item):
+            # Returns False if the pipeline was stopped meanwhile
+            future = asyncio.run_coroutine_threadsafe(fetched.put(item), loop)
+            while not self._stop.is_set():
+                try:
+                    future.result(timeout=0.1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    pass
+            return False
+
+        batch = []
+        for case in self.report.iter_cases(job[0], job[1], self.report.build, self.report.fields):
+            batch.append(case)
+            if len(batch) >= BATCH:
+                if not put((time.monotonic(), batch)):
+                    return
+                batch = []
+        if batch:
+            put((time.monotonic(), batch))
+
+    async def _fetch(self, loop, pool, jobs, fetched, consumers):
+        await asyncio.gather(*[loop.run_in_executor(pool, self._fetch_job, loop, job, fetched)
+            for job in jobs])
+        for _ in range(consumers):
+            await fetched.put(STOP)
+
+    def _match_batch(self, cases):
+        """
+        Returns reasons of the first rules cases match (None if no rule)
+        """
+        with metrics.span('match'):
+            rules = [self.rules.match(i, self.cache) for i in cases]
+        return [None if i is None else i['reason'] for i in rules]
+
+    async def _match(self, loop, io_pool, match_pool, fetched, matched, workers):
+        """
+        Matches unclaimed failures of the fetched batches ('workers' of
+        them at once, as lazy fields are fetched for them first)
+        """
+        async def worker():
+            while True:
+                item = await fetched.get()
+                if item is STOP:
+                    return
+                start, batch = item
+                self.counts['cases'] += len(batch)
+                failures = [i for i in batch if i['status'] in claims.Case.FAIL_STATUSES
+                    and not i['testActions'][0].get('reason')]
+                if not failures:
+                    continue
+                self.counts['failures'] += len(failures)
+                await loop.run_in_executor(io_pool, claims.prefetch_fields, failures, self._fields)
+                to_claim = []
+                reasons = await loop.run_in_executor(match_pool, self._match_batch, failures)
+                for case, reason in zip(failures, reasons):
+                    if reason is not None:
+                        logging.info(u"{0}::{1} matching pattern for '{2}' on {3}".format(
+                            case['className'], case['name'], reason, case['url']))
+                        to_claim.append((start, case, reason))
+                self.counts['matched'] += len(to_claim)
+                metrics.count('failures', len(failures))
+                metrics.count('matched', len(to_claim))
+                for item in to_claim:
+                    await matched.put(item)
+
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        for _ in range(claims.config['claim_workers']):
+            await matched.put(STOP)
+
+    async def _claim(self, loop, pool, limiter, matched):
+        while True:
+            item = await matched.get()
+            if item is STOP:
+                return
+            start, case, reason = item
+            if self.dryrun:
+                result = (case, reason)
+            else:
+                result = await loop.run_in_executor(
+                    pool, claims.retry_claim, case, reason, False, False, limiter)
+            self.latencies.append(time.monotonic() - start)
+            self.results.append(result)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Claim failures by rules from kb.json, fetching, matching and claiming at once')
+    parser.add_argument('--dry-run', action='store_true',
+        help='only log what would be claimed')
+    args = parser.parse_args(argv)
+
+    rules = claims.Ruleset()
+    # Builds processed by the last run are skipped if 'state' is configured
+    state = claims.BuildState.from_config(rules.version)
+    report = claims.Report(fields=claims.Report.fields_for(rules), state=state)
+    pipeline = Pipeline(rules, report, dryrun=args.dry_run)
+    results = pipeline.run()
+    if not args.dry_run:
+        logging.info("Claimed {0} of {1} matching failures".format(
+            len([i for i in results if i.ok]), len(results)))
+    # Dry run processes nothing, jobs with failed claims are processed again
+    if state is not None and not args.dry_run:
+        state.update(report.builds, results)
+        state.save()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Profile of the rules from kb.json over unclaimed failures of the report:
+evaluations, hits, time spent and the slowest case of every rule and
+sub-rule, plus patterns which may backtrack catastrophically:
+
+    ./profile_rules.py [--top 20] [--output rule-profile.csv]
+
+Nothing is claimed. Match cache is not used, so every rule is evaluated.
+"""
+
+import sys
+import argparse
+import tabulate
+import claims
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Profile evaluations of the rules from kb.json, slowest first')
+    parser.add_argument('--top', type=int, default=20,
+        help='number of (sub-)rules to list (default: %(default)s)')
+    parser.add_argument('--output',
+        help='save the whole profile to CSV (or JSON if it ends with .json) file')
+    args = parser.parse_args(argv)
+
+    rules = claims.Ruleset()
+    risky = [(i.field, i.regexp.pattern, ', '.join(claims.backtracking_risks(i.regexp.pattern)))
+        for i in rules.field_matchers(rules.matchers) if claims.backtracking_risks(i.regexp.pattern)]
+    if risky:
+        print(tabulate.tabulate(risky, headers=['field', 'risky pattern', 'why']))
+        print()
+    profile = rules.enable_profile()
+    report = claims.Report(fields=claims.Report.fields_for(rules))
+    claims.claim_by_rules(report, rules, dryrun=True, cache=claims.MatchCache(size=0))
+    print(tabulate.tabulate(
+        [row[:1] + [row[1][:80]] + row[2:] for row in profile.rows(top=args.top)],
+        headers=profile.COLUMNS, floatfmt='.4f'))
+    if args.output:
+        profile.save(args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
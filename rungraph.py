@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import sys
+import heapq
 import logging
+import argparse
 import datetime
-import svgwrite
+import itertools
+import xml.sax.saxutils
 import claims
 
 
@@ -18,106 +22,182 @@ LANE_HEIGHT = 10
 LANES_START = LANE_HEIGHT   # we will place a timeline into the first lane
 HOUR = 3600
 X_CONTRACTION = 0.1
+TIME_FMT = '%Y-%m-%dT%H:%M:%S'
 
 
-def overlaps(a, b):
+def scale(a):
+    return (a[0] * X_CONTRACTION, a[1])
+
+
+def pack_lanes(intervals):
     """
-    Return true if two intervals overlap:
-        overlaps((1, 3), (2, 10)) => True
-        overlaps((1, 3), (5, 10)) => False
+    Assigns intervals (start, end) to lanes, so intervals in one lane do
+    not overlap (touching intervals overlap as well). Uses minimal number
+    of lanes: intervals are processed by their start and every interval
+    goes to the lane which got free first, if it is free already.
+    Returns list of lane numbers in order of given intervals.
+        pack_lanes([(1, 3), (2, 10), (5, 10)]) => [0, 1, 0]
     """
-    if b[0] <= a[0] <= b[1] or b[0] <= a[1] <= b[1]:
-        return True
-    else:
-        return False
+    lanes = [None] * len(intervals)
+    free = []   # heap of (end of the last interval in the lane, lane)
+    for i in sorted(range(len(intervals)), key=intervals.__getitem__):
+        start, end = intervals[i]
+        if free and free[0][0] < start:
+            lanes[i] = free[0][1]
+            heapq.heapreplace(free, (end, lanes[i]))
+        else:
+            lanes[i] = len(free)
+            heapq.heappush(free, (end, lanes[i]))
+    return lanes
 
 
-def scale(a):
-    return (a[0] * X_CONTRACTION, a[1])
+class SvgWriter(object):
+    """
+    Writes SVG elements into a file as they come, without building the
+    document in memory
+    """
+
+    def __init__(self, fp, size):
+        self._fp = fp
+        self._fp.write('<svg baseProfile="full" height="%s" version="1.1" width="%s" '
+            'xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink"><defs />\n' % (size[1], size[0]))
+
+    def _element(self, name, text=None, **attrs):
+        attrs = ' '.join('%s=%s' % (k, xml.sax.saxutils.quoteattr(str(v)))
+            for k, v in sorted(attrs.items()))
+        if text is None:
+            self._fp.write('<%s %s />\n' % (name, attrs))
+        else:
+            self._fp.write('<%s %s>%s</%s>\n' % (name, attrs,
+                xml.sax.saxutils.escape(text), name))
+
+    def line(self, start, end, style):
+        self._element('line', x1=start[0], y1=start[1], x2=end[0], y2=end[1], style=style)
+
+    def rect(self, insert, size, style):
+        self._element('rect', x=insert[0], y=insert[1], width=size[0], height=size[1], style=style)
+
+    def text(self, text, insert, style, transform=None):
+        attrs = {'x': insert[0], 'y': insert[1], 'style': style}
+        if transform is not None:
+            attrs['transform'] = transform
+        self._element('text', text, **attrs)
+
+    def close(self):
+        self._fp.write('</svg>\n')
 
 
-reports = [i for i in claims.Report() if i['tier'] == 't4']
-
-# Load all the reports and sort them in lanes
-###counter = 0
-lanes = []
-start = None
-end = None
-for r in reports:
-    # Get start and end time. If unknown, skip the result
-    try:
-        r_start = r['start'].timestamp()
-        r_end = r['end'].timestamp()
-    except KeyError:
-        logging.info("No start time for %s::%s" % (r['className'], r['name']))
-        continue
-    # Find overal widtht of time line
-    if start is None or r_start < start:
-        logging.debug("Test %s started before current minimum of %s" % (r['name'], start))
-        start = r_start
-    if end is None or r_end > end:
-        end = r_end
-    r['interval'] = (r_start, r_end)
-    # Check if there is a free lane for us, if not, create a new one
-    lane_found = False
-    for lane in lanes:
-        lane_found = True
-        for interval in lane:
-            if overlaps(r['interval'], interval['interval']):
-                lane_found = False
-                break
-        if lane_found:
-            break
-    if not lane_found:
-        logging.debug("Adding lane %s" % (len(lanes)+1))
-        lane = []
-        lanes.append(lane)
-    lane.append(r)
-    ###counter += 1
-    ###if counter > 10: break
-
-# Create a drawing with timeline
-dwg = svgwrite.Drawing('/tmp/rungraph.svg',
-    size=scale((end-start, LANE_HEIGHT*(len(lanes)+1))))
-dwg.add(dwg.line(
-    scale((0, LANE_HEIGHT)),
-    scale((end-start, LANE_HEIGHT)),
-    style="stroke: black; stroke-width: 1;"
-))
-start_full_hour = int(start / HOUR) * HOUR
-timeline = start_full_hour - start
-while start + timeline <= end:
-    if timeline >= 0:
-        dwg.add(dwg.line(
-            scale((timeline, LANE_HEIGHT)),
-            scale((timeline, 2*LANE_HEIGHT/3)),
+def render(reports, filename, window_start=None, window_end=None):
+    """
+    Draws tests from reports (which ran in given time window, given as
+    timestamps) into lanes of SVG file
+    """
+    # Get start and end time of the tests. If unknown, skip the result
+    tests = []
+    for r in reports:
+        try:
+            r_start = r['start'].timestamp()
+            r_end = r['end'].timestamp()
+        except KeyError:
+            logging.info("No start time for %s::%s" % (r['className'], r['name']))
+            continue
+        if window_start is not None and r_end < window_start:
+            continue
+        if window_end is not None and r_start > window_end:
+            continue
+        tests.append((r, (r_start, r_end)))
+    if not tests:
+        logging.warning("No tests to draw into %s" % filename)
+        return
+
+    # Find overal width of time line and sort tests in lanes
+    start = window_start if window_start is not None else min(i[1][0] for i in tests)
+    end = window_end if window_end is not None else max(i[1][1] for i in tests)
+    lanes = pack_lanes([i[1] for i in tests])
+    logging.debug("Placed %s tests into %s lanes" % (len(tests), max(lanes) + 1))
+
+    # Create a drawing with timeline
+    with open(filename, 'w') as fp:
+        dwg = SvgWriter(fp, scale((end-start, LANE_HEIGHT*(max(lanes)+2))))
+        dwg.line(
+            scale((0, LANE_HEIGHT)),
+            scale((end-start, LANE_HEIGHT)),
             style="stroke: black; stroke-width: 1;"
-        ))
-        dwg.add(dwg.text(
-            datetime.datetime.fromtimestamp(start+timeline) \
-                .strftime('%Y-%m-%d %H:%M:%S'),
-            insert=scale((timeline, 2*LANE_HEIGHT/3)),
-            style="fill: black; font-size: 3pt;"
-        ))
-    timeline += HOUR/4
-
-# Draw tests
-for lane_no in range(len(lanes)):
-    for r in lanes[lane_no]:
-        logging.debug("In lane %s adding %s::%s %s" \
-            % (lane_no, r['className'], r['name'], r['interval']))
-        s, e = r['interval']
-        dwg.add(dwg.rect(
-            insert=scale((s - start, LANES_START + LANE_HEIGHT*lane_no + LANE_HEIGHT/2)),
-            size=scale((e - s, LANE_HEIGHT/2)),
-            style="fill: %s; stroke: %s; stroke-width: 0;" \
-                % (STATUS_COLOR[r['status']], STATUS_COLOR[r['status']])
-        ))
-        dwg.add(dwg.text(
-            "%s::%s" % (r['className'], r['name']),
-            insert=scale((s - start, LANES_START + LANE_HEIGHT*lane_no + LANE_HEIGHT/2)),
-            transform="rotate(-30, %s, %s)" \
-                % scale((s - start, LANES_START + LANE_HEIGHT*lane_no + LANE_HEIGHT/2)),
-            style="fill: gray; font-size: 2pt;"
-        ))
-dwg.save()
+        )
+        start_full_hour = int(start / HOUR) * HOUR
+        timeline = start_full_hour - start
+        while start + timeline <= end:
+            if timeline >= 0:
+                dwg.line(
+                    scale((timeline, LANE_HEIGHT)),
+                    scale((timeline, 2*LANE_HEIGHT/3)),
+                    style="stroke: black; stroke-width: 1;"
+                )
+                dwg.text(
+                    datetime.datetime.fromtimestamp(start+timeline) \
+                        .strftime('%Y-%m-%d %H:%M:%S'),
+                    insert=scale((timeline, 2*LANE_HEIGHT/3)),
+                    style="fill: black; font-size: 3pt;"
+                )
+            timeline += HOUR/4
+
+        # Draw tests
+        for (r, (s, e)), lane_no in zip(tests, lanes):
+            logging.debug("In lane %s adding %s::%s %s" \
+                % (lane_no, r['className'], r['name'], (s, e)))
+            dwg.rect(
+                insert=scale((s - start, LANES_START + LANE_HEIGHT*lane_no + LANE_HEIGHT/2)),
+                size=scale((e - s, LANE_HEIGHT/2)),
+                style="fill: %s; stroke: %s; stroke-width: 0;" \
+                    % (STATUS_COLOR[r['status']], STATUS_COLOR[r['status']])
+            )
+            dwg.text(
+                "%s::%s" % (r['className'], r['name']),
+                insert=scale((s - start, LANES_START + LANE_HEIGHT*lane_no + LANE_HEIGHT/2)),
+                transform="rotate(-30, %s, %s)" \
+                    % scale((s - start, LANES_START + LANE_HEIGHT*lane_no + LANE_HEIGHT/2)),
+                style="fill: gray; font-size: 2pt;"
+            )
+        dwg.close()
+    logging.info("Graph of %s tests written to %s" % (len(tests), filename))
+
+
+def timestamp(value):
+    return datetime.datetime.strptime(value, TIME_FMT).timestamp()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Draw when tests of a build ran into SVG')
+    parser.add_argument('--tier', nargs='+', default=['t4'],
+        help='tiers to draw (default: t4)')
+    parser.add_argument('--distro', nargs='+',
+        help='distros to draw (default: all)')
+    parser.add_argument('--build',
+        help='build number or alias (default: bld from config)')
+    parser.add_argument('--output', default='/tmp/rungraph.svg',
+        help='output file; if it contains {tier} or {distro}, one graph'
+            ' per tier/distro is drawn (e.g. /tmp/rungraph-{tier}-{distro}.svg)')
+    parser.add_argument('--from', dest='window_start', type=timestamp,
+        help='draw only tests running after this time (%s)' % TIME_FMT.replace('%', '%%'))
+    parser.add_argument('--to', dest='window_end', type=timestamp,
+        help='draw only tests running before this time (%s)' % TIME_FMT.replace('%', '%%'))
+    args = parser.parse_args(argv)
+
+    # Only jobs of the tiers and distros to draw are fetched
+    reports = list(claims.Report(args.build, claims.Report.fields_for(timings=True),
+        tiers=[int(i.lstrip('t')) for i in args.tier],
+        rhels=None if args.distro is None else [int(i.lstrip('el')) for i in args.distro]))
+
+    if '{tier}' in args.output or '{distro}' in args.output:
+        key = lambda r: (r['tier'], r['distro'])
+        for (tier, distro), group in itertools.groupby(sorted(reports, key=key), key=key):
+            render(list(group), args.output.format(tier=tier, distro=distro),
+                args.window_start, args.window_end)
+    else:
+        render(reports, args.output, args.window_start, args.window_end)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
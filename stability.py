@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Stability of the tests over last builds:
+
+    matrix = stability.Matrix.fetch(stability.last_builds(13))
+    for test, pstdev in zip(matrix.tests, matrix.pstdev()):
+        print(test, pstdev)
+
+States of the tests are kept in tests x builds NumPy arrays together with
+mask of missing results, so the statistics are computed for all the tests
+at once.
+"""
+
+import logging
+import concurrent.futures
+import numpy
+import claims
+
+
+PASSED = 0
+FAILED = 1
+
+
+def sanitize_state(state):
+    """
+    Returns PASSED or FAILED for given test status, None for statuses
+    which says nothing about stability (e.g. SKIPPED)
+    """
+    if state in ('PASSED', 'FIXED'):
+        return PASSED
+    if state in ('FAILED', 'REGRESSION'):
+        return FAILED
+    return None
+
+
+def last_builds(count):
+    """
+    Returns numbers of last 'count' completed builds of the jobs, newest
+    first
+    """
+    jobs = [claims.config['job'].format(i, j)
+        for i in claims.config['tiers'] for j in claims.config['rhels']]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=claims.config['fetch_workers']) as executor:
+        builds = set()
+        for numbers in executor.map(
+                lambda job: claims.config.completed_builds(job, count), jobs):
+            builds.update(numbers)
+    return sorted(builds, reverse=True)[:count]
+
+
+class Matrix(object):
+    """
+    States of tests (rows, named "className::name@distro") in builds
+    (columns, newest first)
+    """
+
+    def __init__(self, builds, tests, states, present):
+        self.builds = builds
+        self.tests = tests
+        self.states = states     # PASSED or FAILED
+        self.present = present   # False where there is no result
+
+    @classmethod
+    def fetch(cls, builds, workers=None, history=None):
+        """
+        Fetches reports of given builds in parallel (by 'workers' threads,
+        'fetch_workers' by default) and builds the matrix from them. If
+        'history' store is given, only builds missing there are fetched
+        (and stored) and the matrix is built from the store.
+        """
+        if workers is None:
+            workers = claims.config['fetch_workers']
+        missing = builds
+        if history is not None:
+            stored = history.numbers()
+            missing = [i for i in builds if i not in stored]
+        fields = claims.Report.fields_for()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            reports = list(executor.map(
+                lambda build: claims.Report(build, fields, history=history).load(), missing))
+        if history is not None:
+            return cls.from_history(history, builds)
+        return cls.from_reports(builds, reports)
+
+    @classmethod
+    def from_reports(cls, builds, reports):
+        def results():
+            for column, report in enumerate(reports):
+                logging.debug("Processing %s results of build %s" % (len(report), builds[column]))
+                for r in report:
+                    yield ("%s::%s@%s" % (r['className'], r['name'], r['distro']),
+                        column, r['status'])
+        return cls.from_results(builds, results())
+
+    @classmethod
+    def from_history(cls, history, builds):
+        """
+        Builds the matrix from results of given builds in history.History
+        store
+        """
+        columns = {b: i for i, b in enumerate(builds)}
+        return cls.from_results(builds, (("%s::%s@%s" % (class_name, name, distro),
+            columns[build], status) for class_name, name, distro, build, status
+            in history.results(builds)))
+
+    @classmethod
+    def from_results(cls, builds, results):
+        """
+        Builds the matrix from (test, column, status) of all the results
+        """
+        rows = {}
+        out = []   # (row, column, state)
+        for test, column, status in results:
+            row = rows.setdefault(test, len(rows))
+            state = sanitize_state(status)
+            if state is not None:
+                out.append((row, column, state))
+        states = numpy.zeros((len(rows), len(builds)), dtype=numpy.int8)
+        present = numpy.zeros((len(rows), len(builds)), dtype=bool)
+        if out:
+            row, column, state = numpy.array(out, dtype=numpy.int64).T
+            states[row, column] = state
+            present[row, column] = True
+        return cls(list(builds), list(rows), states, present)
+
+    def _masked(self, window=None):
+        states = self.states if window is None else self.states[:, :window]
+        present = self.present if window is None else self.present[:, :window]
+        return numpy.ma.masked_array(states, mask=~present, dtype=float)
+
+    def pstdev(self, window=None):
+        """
+        Population standard deviation of the states of every test (in
+        newest 'window' builds), 0 is best (stable), 0.5 is worst
+        (unstable). Masked where test have no result.
+        """
+        return self._masked(window).std(axis=1)
+
+    def flip_rate(self):
+        """
+        How often the state of every test changes from one result to the
+        next one (ignoring missing results), 0 is stable, 1 flips every
+        time. Masked where test have less than two results.
+        """
+        # Move present results to the left keeping their order
+        order = numpy.argsort(~self.present, axis=1, kind='stable')
+        states = numpy.take_along_axis(self.states, order, axis=1)
+        counts = self.present.sum(axis=1)
+        pairs = numpy.arange(self.states.shape[1] - 1) < (counts - 1)[:, None]
+        flips = ((states[:, 1:] != states[:, :-1]) & pairs).sum(axis=1)
+        return numpy.ma.masked_array(flips / numpy.maximum(counts - 1, 1),
+            mask=counts < 2)
+
+    def rows(self, *columns):
+        """
+        Returns list of [test, states..., columns...] with None in place
+        of missing values, for printing
+        """
+        out = []
+        states = numpy.where(self.present, self.states, -1).tolist()
+        columns = [[None if m else v for v, m in zip(
+            c.data.tolist(), numpy.ma.getmaskarray(c).tolist())] for c in columns]
+        for i, test in enumerate(self.tests):
+            out.append([test] + [s if s >= 0 else None for s in states[i]]
+                + [c[i] for c in columns])
+        return out
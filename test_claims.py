@@ -1,43 +1,307 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import os
+import json
+import datetime
+import time
+import tempfile
+import contextlib
 import claims
+import history
+import cluster
+import watch
+import rungraph
+import metrics
+import fake_jenkins
+
+def rule_matches(data, rule):
+    """
+    Matches rule both by Case.matches_to_rule and by compiled Ruleset
+    and checks they agree
+    """
+    case = claims.Case(data)
+    out = case.matches_to_rule(rule)
+    assert claims.Ruleset.compile(rule).match(case) == out
+    assert (claims.Ruleset([rule]).match(case) is rule) == bool(out)
+    return out
 
 checkme = {
     'greeting': 'Hello world',
     'area': 'IT Crowd',
 }
 
-assert claims.rule_matches(checkme, {'field': 'greeting', 'pattern': 'Hel+o'}) == True
-assert claims.rule_matches(checkme, {'field': 'greeting', 'pattern': 'This is not there'}) == False
-assert claims.rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}]}) == True
-assert claims.rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}) == True
-assert claims.rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}) == True
-assert claims.rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'This is not there'}]}) == False
-assert claims.rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}]}) == False
-assert claims.rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
-assert claims.rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}]}]}) == True
-assert claims.rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}]}) == True
-assert claims.rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}]}) == True
-assert claims.rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}]}]}) == False
-assert claims.rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}]}) == False
-assert claims.rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}]}) == False
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'This is not there'}]}) == False
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'IT'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'This is not there'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'This is not there'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'IT'}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
-assert claims.rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}, {'AND': [{'field': 'area', 'pattern': 'IT'}]}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'AND': [{'field': 'area', 'pattern': 'IT'}]}]}) == True
-assert claims.rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'AND': [{'field': 'area', 'pattern': 'This is not there'}]}]}) == False
-assert claims.rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
-assert claims.rule_matches(checkme, {'AND': [{'OR': [{'field': 'greeting', 'pattern': 'Hel*o'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
-assert claims.rule_matches(checkme, {'AND': [{'OR': [{'field': 'greeting', 'pattern': 'Hel*o'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'IT'}]}) == True
-assert claims.rule_matches(checkme, {'AND': [{'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'field': 'greeting', 'pattern': 'Hel+o'}) == True
+assert rule_matches(checkme, {'field': 'greeting', 'pattern': 'This is not there'}) == False
+assert rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}]}) == True
+assert rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}) == True
+assert rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'This is not there'}]}) == False
+assert rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}]}) == False
+assert rule_matches(checkme, {'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
+assert rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}]}]}) == True
+assert rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}]}) == True
+assert rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}]}) == True
+assert rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}]}]}) == False
+assert rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}]}) == False
+assert rule_matches(checkme, {'AND': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}]}) == False
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'This is not there'}]}) == False
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}, {'field': 'area', 'pattern': 'This is not there'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'This is not there'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
+assert rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'Hel+o'}, {'field': 'greeting', 'pattern': 'world'}]}, {'AND': [{'field': 'area', 'pattern': 'IT'}]}]}) == True
+assert rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'AND': [{'field': 'area', 'pattern': 'IT'}]}]}) == True
+assert rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'AND': [{'field': 'area', 'pattern': 'This is not there'}]}]}) == False
+assert rule_matches(checkme, {'OR': [{'AND': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
+assert rule_matches(checkme, {'AND': [{'OR': [{'field': 'greeting', 'pattern': 'Hel*o'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'This is not there'}]}) == False
+assert rule_matches(checkme, {'AND': [{'OR': [{'field': 'greeting', 'pattern': 'Hel*o'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'AND': [{'OR': [{'field': 'greeting', 'pattern': 'This is not there'}, {'field': 'greeting', 'pattern': 'world'}]}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'field': 'missing', 'pattern': 'IT'}) is None
+assert rule_matches(checkme, {'AND': [{'field': 'area', 'pattern': 'IT'}, {'field': 'missing', 'pattern': 'IT'}]}) is None
+assert rule_matches(checkme, {'OR': [{'OR': [{'field': 'missing', 'pattern': 'IT'}]}, {'field': 'area', 'pattern': 'IT'}]}) == True
+assert rule_matches(checkme, {'AND': [{'field': 'area', 'pattern': 'IT'}, {'AND': []}]}) is None
+
+ruleset = claims.Ruleset([{'field': 'area', 'pattern': 'Crowd', 'reason': 'first'}, {'field': 'greeting', 'pattern': 'Hel+o', 'reason': 'second'}])
+cache = claims.MatchCache(size=1)
+assert ruleset.match(claims.Case(dict(checkme)), cache)['reason'] == 'first'
+assert ruleset.match(claims.Case(dict(checkme)), cache)['reason'] == 'first'
+assert ruleset.match(claims.Case({'greeting': 'Hello', 'area': 'HR'}), cache)['reason'] == 'second'
+assert ruleset.match(claims.Case({'greeting': 'Bye', 'area': 'HR'}), cache) is None
+assert (cache.hits, cache.misses, cache.evictions) == (1, 3, 2)
+
+assert claims.Case.timings('') == claims.Case.timings('no timestamps\nhere\n') == claims.Case.timings(None) == (None, None)
+assert claims.Case.timings('x\n2018-06-13 07:17:26 - a\nb\n2018-06-13 07:17:28 - c\nd') == (datetime.datetime(2018, 6, 13, 7, 17, 26), datetime.datetime(2018, 6, 13, 7, 17, 28))
+for stdout in ('', 'no timestamps\nhere\n'):
+    for name in ('start', 'end'):
+        try:
+            claims.Case({'stdout': stdout})[name]
+        except KeyError:
+            pass
+        else:
+            assert False, 'KeyError expected'
+    assert claims.Case({'stdout': stdout}).get('start') is None
+
+report = json.dumps({'suites': [{'cases': [{'name': 'a', 'stdout': '"cases": ['}, {'name': 'b'}]}, {'name': 'cases', 'cases': []}, {'cases': [{'name': 'c'}]}]}).encode()
+assert [i['name'] for i in claims.iter_json_cases(report[i:i+3] for i in range(0, len(report), 3))] == ['a', 'b', 'c']
+
+store = history.History(':memory:')
+build = [claims.Case({'className': 'A', 'name': 'a', 'status': 'FAILED', 'testActions': [{'reason': 'bug'}], 'distro': 'el7'}), claims.Case({'className': 'A', 'name': 'b', 'status': 'PASSED', 'testActions': [], 'distro': 'el7'})]
+store.ingest_build('job', 1, build)
+store.ingest_build('job', 1, build)
+store.ingest_build('job', 2, build[:1])
+assert list(store.results([2, 1])) == [('A', 'a', 'el7', 2, 'FAILED'), ('A', 'a', 'el7', 1, 'FAILED'), ('A', 'b', 'el7', 1, 'PASSED')]
+assert store.reasons() == [('bug', 2)] and store.reasons(last=1) == [('bug', 1)]
+assert store.first_failure('A', 'a', 'el7') == 1 and store.first_failure('A', 'b', 'el7') is None
+assert [(i['name'], i['status'], i['testActions']) for i in store.cases('job', 1)] == [('a', 'FAILED', [{'reason': 'bug'}]), ('b', 'PASSED', [])]
+assert list(store.results([2, 1], batch=1)) == list(store.results([2, 1]))
+
+assert cluster.normalize('Timed out on host1.example.com at 2018-06-13 07:17:26 waiting for task 4f9e1c2a-1b2c-4d5e-8f90-123456789abc (0x7f3a2b)') == 'Timed out on <HOST> at <TIME> waiting for task <UUID> (<ADDR>)'
+assert cluster.normalize('self = <tests.a.ATestCase>, 500 Error', {'className': 'tests.a.ATestCase', 'name': 'test_a'}) == 'self = <<TEST>>, <N> Error'
+failures = [{'className': 'A', 'name': 'a%s' % i, 'errorDetails': 'Task %s failed' % i, 'errorStackTrace': None} for i in range(3)] + [{'className': 'B', 'name': 'b', 'errorDetails': 'Other', 'errorStackTrace': None}]
+assert [len(i) for i in cluster.clusters(failures)] == [3, 1]
+assert [len(i) for i in cluster.clusters(failures, exact=['name'])] == [1, 1, 1, 1]
+similar = [{'className': 'A', 'name': 'a', 'errorDetails': 'Could not sync repository content from the upstream server in time, %s' % i, 'errorStackTrace': None} for i in ('retrying', 'giving up')]
+assert [len(i) for i in cluster.clusters(failures + similar, threshold=0.6)] == [3, 2, 1]
+assert [len(i) for i in cluster.clusters(failures + similar, threshold=0.8)] == [3, 1, 1, 1]
+
+with tempfile.NamedTemporaryFile() as fp:
+    fp.write(b'garbage\n2018-06-13T07:17:27 [I] a\r\n  b\n2018-06-14T00:00:01 [I] c\n2018-06-14T00:00:0 d\n2018-06-13T23:59:59 [I] e')
+    fp.flush()
+    logs = [claims.ProductionLog(None, None, logfile=fp.name) for _ in range(2)]
+    claims.ProductionLog.load_all(logs[:1], workers=1)
+    claims.ProductionLog.CHUNK_SIZE, chunk_size = 10, claims.ProductionLog.CHUNK_SIZE
+    claims.ProductionLog.load_all(logs[1:], workers=2)
+    claims.ProductionLog.CHUNK_SIZE = chunk_size
+    assert list(logs[0].times) == list(logs[1].times) == [1528874247, 1528934401, 1528934399]
+    assert list(logs[0]._offsets) == list(logs[1]._offsets) == [8, 39, 86]
+
+assert claims.backtracking_risks(r'(a+)+$') == ['nested quantifier']
+assert claims.backtracking_risks(r'(?:x|xy)*z') == ['quantified alternation of overlapping branches']
+assert claims.backtracking_risks(r'TaskTimedOutError[^$]+action') == claims.backtracking_risks(r'(\d{1,3}\.){3}') == []
+ruleset = claims.Ruleset([{'field': 'area', 'pattern': 'Crowd', 'reason': 'first'}, {'AND': [{'field': 'area', 'pattern': 'HR'}, {'field': 'greeting', 'pattern': 'Hel+o'}], 'reason': 'second'}])
+profile = ruleset.enable_profile()
+for area in ('Crowd', 'HR', 'IT'):
+    ruleset.match(claims.Case({'className': 'A', 'name': area, 'greeting': 'Hello', 'area': area}))
+assert [i[:4] for i in profile.rows()] == [['0', 'area =~ Crowd', 3, 1], ['1', 'AND of 2', 2, 1], ['1/0', 'area =~ HR', 2, 1], ['1/1', 'greeting =~ Hel+o', 1, 1]]
+assert profile.rows(top=1)[0][6].startswith('A::')
+ruleset = claims.Ruleset([{'field': 'greeting', 'pattern': '(a+)+$', 'reason': 'evil'}, {'field': 'greeting', 'pattern': 'a', 'reason': 'fine'}], budget=0.5)
+cache = claims.MatchCache()
+assert ruleset.match(claims.Case({'greeting': 'a' * 40 + '!'}), cache)['reason'] == 'fine'
+assert ruleset.timeouts == 1 and len(cache._data) == 0
+assert ruleset.match(claims.Case({'greeting': 'aa'}), cache)['reason'] == 'evil'
+assert ruleset.timeouts == 1 and len(cache._data) == 1
+ruleset.matchers[0].guard.close()
+
+assert metrics.span('anything', tier='t1') is metrics.NO_SPAN
+with tempfile.TemporaryDirectory() as tmp:
+    for name in ('claims.prom', 'claims.jsonl'):
+        recorder = metrics.enable(os.path.join(tmp, name))
+        with metrics.span('claim', tier='t1', distro='el7'):
+            with metrics.span('crumb'):
+                time.sleep(0.01)
+        assert list(metrics.timed_iter([b'ab', b'c'], 'report_download', build=1)) == [b'ab', b'c']
+        metrics.count('claims', ok='true')
+        claim, crumb = recorder.phases[('claim', (('distro', 'el7'), ('tier', 't1')))], recorder.phases[('crumb', ())]
+        assert claim[:1] == crumb[:1] == [1] and claim[1] >= crumb[1] >= 0.01 and claim[2] < 0.01
+        assert recorder.phases[('report_download', (('build', '1'),))][3] == 3
+        metrics.save()
+        metrics.disable()
+    with open(os.path.join(tmp, 'claims.prom')) as fp:
+        prom = fp.read()
+    assert 'claims_phase_bytes_total{phase="report_download",build="1"} 3\n' in prom
+    assert 'claims_claims_total{ok="true"} 1\n' in prom
+    with open(os.path.join(tmp, 'claims.jsonl')) as fp:
+        trace = [json.loads(i) for i in fp]
+    assert [i.get('phase', i.get('counter')) for i in trace] == ['crumb', 'claim', 'report_download', 'claims', None]
+
+
+@contextlib.contextmanager
+def jenkins_config(jenkins, **kwargs):
+    """
+    Points claims.config to fake Jenkins (with given settings) for a while
+    """
+    saved = dict(claims.config.data)
+    claims.config.update(dict(url=jenkins.url, tiers=[1], rhels=[7], bld='lastCompletedBuild',
+        cache=None, headers=None, claim_backoff=0), **kwargs)
+    claims.config._session = None
+    try:
+        yield
+    finally:
+        claims.config.data = saved
+        claims.config._session = None
+
+job = claims.config['job'].format(1, 7)
+kb = [{'field': 'errorDetails', 'pattern': '.', 'reason': 'known'}]
+with fake_jenkins.FakeJenkins() as jenkins, tempfile.TemporaryDirectory() as tmp:
+    jenkins.add_build(job, 1, fake_jenkins.generate_report(30, fail_ratio=0.5))
+    failed = [i for i in jenkins.builds[(job, 1)]['report']['suites'][0]['cases'] if i['testActions']]
+    with jenkins_config(jenkins, cache=tmp):
+        def claim(dryrun=False):
+            rules = claims.Ruleset(kb)
+            return claims.claim_by_rules(claims.Report(fields=claims.Report.fields_for(rules)),
+                rules, dryrun=dryrun, cache=claims.MatchCache())
+        claim(dryrun=True)   # build is cached with all the failures unclaimed
+        failed[0]['testActions'] = [{'reason': 'claimed by hand'}]
+        assert len(claim()) == len(failed) - 1
+        assert claim() == [] and len(jenkins.claims) == len(failed) - 1
+        assert failed[0]['testActions'][0]['reason'] == 'claimed by hand'
+
+kb = [{'field': 'errorDetails', 'pattern': 'HTTPError: 500 Server Error', 'reason': 'server error'}]
+for codes in ((500, 502, 500), (502, 500, 500)):
+    with fake_jenkins.FakeJenkins() as jenkins, jenkins_config(jenkins):
+        jenkins.add_build(job, 1, {'suites': [{'cases': [{'className': 'tests.a.ATestCase', 'name': 'test_%s' % i,
+            'status': 'FAILED', 'errorDetails': 'HTTPError: %s Server Error' % code, 'errorStackTrace': None,
+            'testActions': [{'reason': None}]} for i, code in enumerate(codes)]}]})
+        rules = claims.Ruleset(kb)
+        claims.claim_by_rules(claims.Report(fields=claims.Report.fields_for(rules)), rules,
+            cache=claims.MatchCache(), clusters=True)
+        assert sorted(url.rsplit('/', 1)[1] for url, _ in jenkins.claims) \
+            == ['test_%s' % i for i, code in enumerate(codes) if code == 500]
+
+state = claims.BuildState()
+results = [claims.ClaimResult(claims.Case({'className': 'A', 'name': 'a', 'tier': 't%s' % tier, 'distro': 'el7'}), 'bug', ok, 302 if ok else 500, None)
+    for tier, ok in ((1, True), (2, False), (2, True))]
+state.update({claims.config['job'].format(i, 7): 5 for i in (1, 2, 3)}, results)
+assert state.builds == {claims.config['job'].format(1, 7): 5, claims.config['job'].format(3, 7): 5}
+
+kb = [{'field': 'errorDetails', 'pattern': '.', 'reason': 'known'}]
+with fake_jenkins.FakeJenkins() as jenkins, jenkins_config(jenkins), tempfile.TemporaryDirectory() as tmp:
+    cases = fake_jenkins.generate_report(40, fail_ratio=0.5)['suites'][0]['cases']
+    jenkins.add_build(job, 1, {'suites': [{'cases': cases[:10]}]}, building=True)
+    suites = jenkins.builds[(job, 1)]['report']['suites']
+    with open(os.path.join(tmp, 'kb.json'), 'w') as fp:
+        json.dump(kb, fp)
+    watcher = watch.Watcher(kb=os.path.join(tmp, 'kb.json'))
+    for start, end, grow in ((0, 10, None), (10, 15, lambda: suites[-1]['cases'].extend(cases[10:15])),
+            (15, 30, lambda: suites.extend([{'cases': cases[15:20]}, {'cases': cases[20:30]}])),
+            (30, 40, lambda: (suites[-1]['cases'].extend(cases[30:35]), suites.append({'cases': cases[35:]})))):
+        if grow is not None:
+            grow()
+        expected = [i['name'] for i in cases[start:end] if i['testActions']]
+        assert sorted(i.case['name'] for i in watcher.cycle()) == sorted(expected)
+    assert watcher.jobs[job]['offset'] == [4, 5] and watcher.cycle() == []
+    assert len(jenkins.claims) == len([i for i in cases if i['testActions']])
+
+reason = 'Fails with "Error: C:\\tmp\n" on \\host'
+with fake_jenkins.FakeJenkins() as jenkins, jenkins_config(jenkins, claim_retries=2):
+    jenkins.add_build(job, 1, {'suites': [{'cases': [{'className': 'tests.a.ATestCase', 'name': 'test_%s' % i,
+        'status': 'FAILED', 'errorDetails': 'Error', 'errorStackTrace': None,
+        'testActions': [{'reason': None}]} for i in range(3)]}]})
+    cases = list(claims.Report(fields=claims.Report.fields_for()))
+    jenkins.claim_errors = [500, 429]
+    assert claims.retry_claim(cases[0], reason) == claims.ClaimResult(cases[0], reason, True, 302, None)
+    assert jenkins.claim_errors == [] and [i[1]['reason'] for i in jenkins.claims] == [reason]
+    assert [i['testActions'] for i in claims.Report(fields=claims.Report.fields_for())][0] == [{'reason': reason}]
+    jenkins.claim_errors = [404, 500]
+    result = claims.retry_claim(cases[1], 'bug')
+    assert (result.ok, result.status, jenkins.claim_errors) == (False, 404, [500])
+    assert result.error.startswith('Failed to claim') and cases[1]['testActions'] == [{'reason': None}]
+    jenkins.claim_errors = [500, 429, 500, 500]
+    result = claims.retry_claim(cases[2], 'bug')
+    assert (result.ok, result.status, jenkins.claim_errors) == (False, 500, [500])
+    assert len(jenkins.claims) == 1
+
+with fake_jenkins.FakeJenkins() as jenkins, tempfile.TemporaryDirectory() as tmp:
+    with open(os.path.join(tmp, 'production.log'), 'w') as fp:
+        fp.write('2018-06-13T07:17:26 [I] Started\n' * 1000)
+    archive = fake_jenkins.generate_foreman_debug(fp.name, other=0)
+    jenkins.add_build(job, 1, {'suites': []}, artifacts={'foreman-debug.tar.xz': archive[:len(archive) // 2]})
+    with jenkins_config(jenkins, cache=os.path.join(tmp, 'cache')):
+        try:
+            claims.ProductionLog(job, 1).times
+        except Exception:
+            pass
+        else:
+            assert False, 'truncated archive extracted'
+        assert [i for files in os.walk(os.path.join(tmp, 'cache')) for i in files[2]] == []
+
+assert rungraph.pack_lanes([(1, 3), (2, 10), (5, 10)]) == [0, 1, 0]
+assert rungraph.pack_lanes([(1, 3), (3, 5), (5, 7)]) == [0, 1, 0]   # touching ones overlap
+assert rungraph.pack_lanes([(1, 10), (2, 3), (4, 5), (6, 9)]) == [0, 1, 1, 1]   # nested
+assert rungraph.pack_lanes([(5, 6), (1, 10), (2, 7), (8, 9), (3, 4)]) == [2, 0, 1, 2, 2]
+assert rungraph.pack_lanes([(1, 2), (1, 2), (1, 2)]) == [0, 1, 2] and rungraph.pack_lanes([]) == []
+
+kb = [{'field': 'stdout', 'pattern': 'Error', 'reason': 'known'}]
+with fake_jenkins.FakeJenkins() as jenkins, jenkins_config(jenkins):
+    jenkins.add_build(job, 1, {'suites': [{'cases': [{'className': 'tests.a.ATestCase', 'name': 'test_%s' % i,
+        'status': 'FAILED', 'errorDetails': 'x', 'errorStackTrace': None, 'stdout': 'Error %s' % i,
+        'testActions': [{'reason': None}]} for i in range(3)]}]})
+    rules = claims.Ruleset(kb)
+    report = list(claims.Report(fields=claims.Report.fields_for(rules)))
+    del jenkins.builds[(job, 1)]['report']['suites'][0]['cases'][1]   # its stdout is 404 now
+    results = claims.claim_by_rules(report, rules, cache=claims.MatchCache())
+    assert sorted(i.case['name'] for i in results) == ['test_0', 'test_2'] and all(i.ok for i in results)
+    assert report[1].get('stdout') is None and not report[1].lazy_fields(['stdout'])
+
+def claimed(kb, errors, clusters):
+    """
+    Returns {test name: reason} claimed by the rules in a build failing
+    with given errors
+    """
+    with fake_jenkins.FakeJenkins() as jenkins, jenkins_config(jenkins):
+        jenkins.add_build(job, 1, {'suites': [{'cases': [{'className': 'tests.a.ATestCase', 'name': 'test_%s' % i,
+            'status': 'FAILED', 'errorDetails': error, 'errorStackTrace': None,
+            'testActions': [{'reason': None}]} for i, error in enumerate(errors)]}]})
+        rules = claims.Ruleset(kb)
+        claims.claim_by_rules(claims.Report(fields=claims.Report.fields_for(rules)), rules,
+            cache=claims.MatchCache(), clusters=clusters)
+        return {url.rsplit('/', 1)[1]: claim['reason'] for url, claim in jenkins.claims}
+
+errors = ['Task 1 failed', 'Task 2 failed', 'Task 3 failed on host2', 'Task 22 failed', 'Timeout 2 s']
+for kb in ([{'field': 'errorDetails', 'pattern': 'Task 2 failed', 'reason': 'specific'},
+            {'field': 'errorDetails', 'pattern': r'Task \d+ failed', 'reason': 'generic'}],
+        [{'field': 'errorDetails', 'pattern': 'host2', 'reason': 'host'},
+            {'field': 'errorDetails', 'pattern': r'Task [13]', 'reason': 'odd'},
+            {'field': 'errorDetails', 'pattern': r'^Task 2', 'reason': 'two'},
+            {'field': 'errorDetails', 'pattern': '2', 'reason': 'any two'}]):
+    for order in (errors, errors[::-1]):
+        assert claimed(kb, order, True) == claimed(kb, order, False)
+assert claimed(kb, errors, True)['test_1'] == 'two'
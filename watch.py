@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Watches the jobs and claims new failures by rules from kb.json as soon as
+they appear in the test reports:
+
+    ./watch.py [--interval SECONDS] [--once] [--dry-run]
+
+Every cycle asks Jenkins for the last build of every job and for size of
+its test report while it is running, so a cycle costs a few small
+requests when nothing changes. When the report grows, only the results
+after the ones processed already are fetched (using ranges of suites and
+cases in the 'tree' query) and matched. What was processed is kept in
+'watch_state' file, so restart does not process the builds again.
+kb.json is reloaded when it changes and failures of the last builds are
+matched again with the new rules.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import logging
+import argparse
+import concurrent.futures
+import requests
+import claims
+
+
+class Watcher(object):
+    """
+    Keeps track of the last build of every job and of the number of
+    results processed from its test report and where they end
+    """
+
+    def __init__(self, statefile=None, kb='kb.json', dryrun=False):
+        self.statefile = statefile
+        self.kb = kb
+        self.dryrun = dryrun
+        self.rules = None
+        self.cache = claims.MatchCache.from_config()
+        self.jobs = {}   # job: {'build': number, 'building': bool, 'size': results processed,
+                         #       'offset': [suites processed, cases processed in the last one]}
+        self.version = None   # of the rules the jobs were processed with
+        self.pending = []   # failures whose claiming failed, tried again next cycle
+        self._kb_mtime = None
+        if statefile and os.path.isfile(statefile):
+            with open(statefile) as fp:
+                state = json.load(fp)
+            self.jobs = state['jobs']
+            self.version = state['version']
+            logging.debug("Loaded state of %s jobs from %s" % (len(self.jobs), statefile))
+
+    def reload_rules(self):
+        """
+        Loads kb.json if it changed. If the rules are not the ones the jobs
+        were processed with, last builds are processed again.
+        """
+        mtime = os.stat(self.kb).st_mtime
+        if mtime == self._kb_mtime:
+            return
+        try:
+            with open(self.kb) as fp:
+                rules = claims.Ruleset(json.load(fp))
+        except ValueError as e:
+            # Probably caught in the middle of writing, try next time
+            logging.warning("Failed to load %s: %s" % (self.kb, e))
+            if self.rules is None:
+                raise
+            return
+        self.rules = rules
+        self._kb_mtime = mtime
+        if self.rules.version != self.version:
+            if self.version is not None:
+                logging.info("Rules in %s changed, matching last builds again" % self.kb)
+            for job in self.jobs.values():
+                job['size'] = job['offset'] = None
+            self.version = self.rules.version
+
+    def poll(self, tier, rhel):
+        """
+        Returns new cases of the last build of the job (and of the build
+        which was running last time, as it has finished since then)
+        """
+        job = claims.config['job'].format(tier, rhel)
+        last = self.jobs.get(job)
+        number, building = claims.config.resolve_build(job, 'lastBuild')
+        cases = []
+        if last is not None and last['building'] and last['build'] != number:
+            cases += self.ingest(tier, rhel,
+                *claims.config.resolve_build(job, last['build']))
+        if number is not None:
+            cases += self.ingest(tier, rhel, number, building)
+        return cases
+
+    def ingest(self, tier, rhel, build, building):
+        """
+        Returns cases of the build which were not processed yet. Report is
+        only fetched if the build is new or its report has grown, and then
+        only the suites and cases after the processed ones: the rest of
+        the last suite processed and the suites which were added.
+        """
+        job = claims.config['job'].format(tier, rhel)
+        if build is None:
+            return []
+        last = self.jobs.get(job)
+        if last is None or last['build'] != build:
+            last = self.jobs[job] = {'build': build, 'building': True, 'size': 0,
+                'offset': None}
+        elif not last['building'] and last['size'] is not None:
+            return []
+        size = claims.config.report_size(job, build)
+        new = []
+        if size is not None and size != last['size']:
+            suites, cases = last.get('offset') or (0, 0)
+            logging.debug("Report of %s build %s has %s results, %s processed (%s suites)" \
+                % (job, build, size, last['size'], suites))
+            fields = claims.Report.fields_for(self.rules)
+            reports = []
+            if suites:
+                sizes = []
+                reports += claims.Report.pull_reports(job, build, fields,
+                    suites='{%s,%s}' % (suites - 1, suites), cases='{%s,}' % cases, sizes=sizes)
+                cases += sum(sizes)
+            sizes = []
+            reports += claims.Report.pull_reports(job, build, fields,
+                suites='{%s,}' % suites, sizes=sizes)
+            if sizes:
+                suites, cases = suites + len(sizes), sizes[-1]
+            report = claims.Report(build, fields, tiers=[tier], rhels=[rhel])
+            new = list(report.make_cases(tier, rhel, build, fields,
+                claims.Report.with_timings(reports)))
+            last['size'] = size
+            last['offset'] = [suites, cases]
+        last['building'] = building
+        return new
+
+    def cycle(self):
+        """
+        Polls all the jobs once and claims new failures, returns results of
+        the claims. If anything fails, nothing from this cycle is recorded
+        as processed.
+        """
+        self.reload_rules()
+        jobs = copy.deepcopy(self.jobs)
+        try:
+            cases = list(self.pending)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=claims.config['fetch_workers']) as executor:
+                for new in executor.map(lambda job: self.poll(*job),
+                        [(i, j) for i in claims.config['tiers'] for j in claims.config['rhels']]):
+                    cases += new
+            results = []
+            if cases:
+                logging.info("Matching %s new results" % len(cases))
+                results = claims.claim_by_rules(cases, self.rules, self.dryrun, self.cache)
+        except Exception:
+            self.jobs = jobs
+            raise
+        self.pending = [i.case for i in results if not i.ok]
+        self.save()
+        return results
+
+    def save(self):
+        if not self.statefile:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.statefile)), exist_ok=True)
+        with open(self.statefile + '.tmp', 'w') as fp:
+            json.dump({'version': self.version, 'jobs': self.jobs}, fp,
+                indent=2, sort_keys=True)
+        os.replace(self.statefile + '.tmp', self.statefile)
+
+
+def main(argv):
+    statefile = claims.config['watch_state']
+    if statefile is None:
+        statefile = os.path.join(claims.config['cache'] or '', 'watch-state.json')
+    parser = argparse.ArgumentParser(
+        description='Claim new failures by rules from kb.json as soon as they appear')
+    parser.add_argument('--interval', type=float, default=claims.config['watch_interval'],
+        help='seconds between polls (default: %(default)s)')
+    parser.add_argument('--state', default=statefile,
+        help='file with what was processed already (default: %(default)s)')
+    parser.add_argument('--once', action='store_true',
+        help='poll just once and exit')
+    parser.add_argument('--dry-run', action='store_true',
+        help='only log what would be claimed')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    watcher = Watcher(args.state, dryrun=args.dry_run)
+    while True:
+        start = time.monotonic()
+        try:
+            watcher.cycle()
+        except (requests.RequestException, ValueError) as e:
+            # Jenkins being restarted, truncated report, ...
+            logging.warning("Poll failed, will try again: %s" % e)
+        if args.once:
+            break
+        time.sleep(max(0, args.interval - (time.monotonic() - start)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])